@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# MEDIAN/STDEV AGGREGATES BENCHMARK: PYTHON vs libsqlitefunctions
+#
+# Usage: PYTHONPATH=. python benchmarks/bench_aggregates.py [--rows <N>] [--names <N>]
+#                    [--per-day <N>] [--dbase <file>] [--extension <file>]
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+# Access  template withing the package
+from pkg_resources import resource_filename
+
+#--------------
+# local imports
+# -------------
+
+from tdbtool.utils     import SQLITE_MATH_MODULE
+from tdbtool.functions import register_functions
+
+# ----------------
+# Module constants
+# ----------------
+
+# Same query as stats_daily()
+DAILY_QUERY = '''
+    SELECT name, date_id, AVG(delta_T), MEDIAN(delta_T), STDEV(delta_T), COUNT(*), MIN(delta_T), MAX(delta_T)
+    FROM first_differences_t
+    GROUP BY name, date_id
+'''
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def populate(connection, rows, names, per_day):
+    '''Synthetic first_differences_t with ~60 second periods and some jitter'''
+    connection.executescript(open(resource_filename('tdbtool', 'sql/extra.sql')).read())
+    connection.execute('''
+        WITH RECURSIVE seq(i) AS (SELECT 0 UNION ALL SELECT i+1 FROM seq WHERE i < :rows - 1)
+        INSERT INTO first_differences_t(name, date_id, time_id, tstamp, rank, delta_seq, delta_T, period, N, control)
+        SELECT 'stars' || (i % :names), 20200101 + (i / :names) / :per_day, i, 'synthetic', i / :names,
+               1, 60 + abs(random() % 5) - 2, 60, 1, 0
+        FROM seq
+        ''', {'rows': rows, 'names': names, 'per_day': per_day})
+    connection.commit()
+
+
+def measure(connection):
+    start  = time.time()
+    result = connection.execute(DAILY_QUERY).fetchall()
+    return time.time() - start, result
+
+
+def same(result1, result2):
+    for r1, r2 in zip(result1, result2):
+        if r1[0:3] != r2[0:3] or r1[5:] != r2[5:]:
+            return False
+        if abs(r1[3] - r2[3]) > 1e-9 or abs(r1[4] - r2[4]) > 1e-6:
+            return False
+    return len(result1) == len(result2)
+
+
+def createParser():
+    parser = argparse.ArgumentParser(description="MEDIAN/STDEV daily statistics cost")
+    parser.add_argument('--rows',      type=int, default=50000000, metavar="<N>", help='first_differences_t rows')
+    parser.add_argument('--names',     type=int, default=500, metavar="<N>", help='Number of photometers')
+    parser.add_argument('--per-day',   type=int, default=1440, metavar="<N>", help='Differences per photometer and day')
+    parser.add_argument('--dbase',     type=str, default=None, metavar="<file>", help='Reuse/keep this database file')
+    parser.add_argument('--extension', type=str, default=SQLITE_MATH_MODULE, metavar="<file>", help='C extension library')
+    return parser
+
+
+def main():
+    options = createParser().parse_args(sys.argv[1:])
+    path = options.dbase or os.path.join(tempfile.mkdtemp(), "bench_aggregates.db")
+    existing = os.path.exists(path)
+    connection = sqlite3.connect(path)
+    if not existing:
+        print("Generating {0} rows in {1} ...".format(options.rows, path))
+        populate(connection, options.rows, options.names, options.per_day)
+
+    register_functions(connection)
+    python_time, python_result = measure(connection)
+    print("{0:<20} {1:>10.2f} s".format("Python aggregates", python_time))
+
+    try:
+        c_connection = sqlite3.connect(path)
+        c_connection.enable_load_extension(True)
+        c_connection.load_extension(options.extension)
+    except (AttributeError, sqlite3.OperationalError) as e:
+        print("{0:<20} {1:>12}  ({2})".format("C extension", "n/a", e))
+    else:
+        c_time, c_result = measure(c_connection)
+        print("{0:<20} {1:>10.2f} s".format("C extension", c_time))
+        print("Results match: {0}".format(same(python_result, c_result)))
+    if not options.dbase:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# INSTRUMENT (tess_id) RESOLUTION BENCHMARK: PER READING QUERIES vs INTERVAL SWEEP
+#
+# Usage: PYTHONPATH=. python benchmarks/bench_instrument.py [--names <N>] [--mac-changes <N>]
+#                    [--readings <N>]
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+from __future__ import print_function
+
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import datetime as Datetime
+
+#--------------
+# local imports
+# -------------
+
+import tdbtool.s4a
+from tdbtool            import BEFORE
+from tdbtool.instrument import registry_indexes, tstamp_key
+
+# ----------------
+# Module constants
+# ----------------
+
+START = Datetime.datetime(2016, 1, 1)
+END   = Datetime.datetime(2021, 1, 1)
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def registry(connection, names, mac_changes):
+    '''Synthetic reference registry where every photometer changes its MAC address mac_changes times'''
+    connection.execute("CREATE TABLE name_to_mac_t(name TEXT, mac_address TEXT, valid_since TEXT, valid_until TEXT)")
+    connection.execute("CREATE TABLE tess_t(tess_id INTEGER PRIMARY KEY, mac_address TEXT, valid_since TEXT, valid_until TEXT)")
+    connection.execute("CREATE INDEX name_to_mac_i ON name_to_mac_t(name)")
+    connection.execute("CREATE INDEX tess_mac_i ON tess_t(mac_address)")
+    span = (END - START) // (mac_changes + 1)
+    for n in range(names):
+        name = "stars{0}".format(n)
+        # The registry starts a bit later than the readings, to get BEFORE readings
+        since = START + span // 2
+        for m in range(mac_changes):
+            mac   = "AA:BB:{0:02X}:{1:02X}:{2:02X}".format(n, m // 256, m % 256)
+            until = since + span if m < mac_changes - 1 else Datetime.datetime(2999, 12, 31, 23, 59, 59)
+            # Mixes both ISO 8601 layouts found in the registry, sharing end points
+            connection.execute("INSERT INTO name_to_mac_t VALUES (?,?,?,?)", (name, mac, since.strftime("%Y-%m-%d %H:%M:%S"), until.strftime("%Y-%m-%dT%H:%M:%S")))
+            # Each MAC gets a couple of tess_id versions (calibration changes)
+            middle = since + span // 2
+            connection.execute("INSERT INTO tess_t(mac_address, valid_since, valid_until) VALUES (?,?,?)", (mac, since.strftime("%Y-%m-%dT%H:%M:%S"), middle.strftime("%Y-%m-%d %H:%M:%S")))
+            connection.execute("INSERT INTO tess_t(mac_address, valid_since, valid_until) VALUES (?,?,?)", (mac, middle.strftime("%Y-%m-%dT%H:%M:%S"), until.strftime("%Y-%m-%d %H:%M:%S")))
+            since = until
+    connection.commit()
+
+
+def readings(count):
+    '''Time ordered (date_id, time_id) readings across the registry span'''
+    seconds = sorted(random.randint(0, int((END - START).total_seconds())) for i in range(count))
+    result = []
+    for s in seconds:
+        t = START + Datetime.timedelta(seconds=s)
+        result.append((t.year*10000 + t.month*100 + t.day, t.hour*10000 + t.minute*100 + t.second))
+    return result
+
+
+def resolve_queries(connection, name, rows):
+    '''The former per reading get_mac() + find_tess_id() queries'''
+    result = []
+    for date_id, time_id in rows:
+        tstamp = tdbtool.s4a.iso8601_from_ids(date_id, time_id)
+        cursor = connection.execute('''
+            SELECT mac_address
+            FROM name_to_mac_t
+            WHERE name == :name
+            AND datetime(:tstamp) BETWEEN datetime(valid_since) AND datetime(valid_until)
+            ''', {'name': name, 'tstamp': tstamp})
+        mac = cursor.fetchone()
+        if mac is None:
+            result.append(BEFORE)
+            continue
+        cursor = connection.execute('''
+            SELECT tess_id
+            FROM tess_t
+            WHERE mac_address == :mac
+            AND datetime(:tstamp) BETWEEN datetime(valid_since) AND datetime(valid_until)
+            ''', {'mac': mac[0], 'tstamp': tstamp})
+        result.append(cursor.fetchone()[0])
+    return result
+
+
+def resolve_sweep(connection, name, rows):
+    macs, tess = registry_indexes(connection, name)
+    result = []
+    for date_id, time_id in rows:
+        key = tstamp_key(date_id, time_id)
+        mac = macs.find(key)
+        result.append(BEFORE if mac is None else tess[mac].find(key))
+    return result
+
+
+def createParser():
+    parser = argparse.ArgumentParser(description="tess_id resolution cost")
+    parser.add_argument('--names',       type=int, default=3, metavar="<N>", help='Number of photometers')
+    parser.add_argument('--mac-changes', type=int, default=500, metavar="<N>", help='MAC address changes per photometer')
+    parser.add_argument('--readings',    type=int, default=20000, metavar="<N>", help='Readings per photometer')
+    return parser
+
+
+def main():
+    options = createParser().parse_args(sys.argv[1:])
+    connection = sqlite3.connect(":memory:")
+    registry(connection, options.names, options.mac_changes)
+    rows = readings(options.readings)
+    before = after = 0.0
+    for n in range(options.names):
+        name = "stars{0}".format(n)
+        start = time.time()
+        expected = resolve_queries(connection, name, rows)
+        before += time.time() - start
+        start = time.time()
+        result = resolve_sweep(connection, name, rows)
+        after += time.time() - start
+        assert result == expected, name
+    total = options.names * options.readings
+    print("{0} photometers x {1} MAC changes, {2} readings".format(options.names, options.mac_changes, total))
+    print("{0:<20} {1:>10} {2:>14}".format("Method", "Time (s)", "Readings/s"))
+    print("{0:<20} {1:>10.2f} {2:>14.0f}".format("Per reading queries", before, total/before))
+    print("{0:<20} {1:>10.2f} {2:>14.0f}".format("Interval sweep", after, total/after))
+
+
+if __name__ == '__main__':
+    main()
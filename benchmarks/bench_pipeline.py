@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+# PIPELINE STEPS BENCHMARK OVER A SYNTHETIC TESS NETWORK, WITH ENGINE AND PARALLELISM VARIANTS
+#
+# Usage: PYTHONPATH=. python benchmarks/bench_pipeline.py [--names <N>] [--days <D>] [--jobs <N>]
+#                    [--only <STEP> [<STEP> ...]] [--work-dir <DIR>] [--command <CMD>]
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+#--------------
+# other imports
+# -------------
+
+import tabulate
+
+#--------------
+# local imports
+# -------------
+
+import synthetic
+
+# ----------------
+# Module constants
+# ----------------
+
+# Steps in pipeline order. Each variant is (label, global options, command).
+# The first variant result feeds the next step, the others run on a copy
+# of the same input database. Steps marked as fresh start from an empty database.
+SCENARIOS = [
+    ('input slurp', False, [
+        ('safe',        ['--db-profile', 'safe'],        ['input', 'slurp', '--csv-file', '{csv}']),
+        ('bulk-import', ['--db-profile', 'bulk-import'], ['input', 'slurp', '--csv-file', '{csv}']),
+        ('workers',     [],                              ['input', 'slurp', '--csv-file', '{csv}', '--workers', '{jobs}']),
+        ('mmap',        [],                              ['input', 'slurp', '--csv-file', '{csv}', '--mmap']),
+    ]),
+    ('db optimize', False, [
+        ('default', [], ['db', 'optimize']),
+    ]),
+    ('input differences', False, [
+        ('sql',    [], ['input', 'differences', '--engine', 'sql']),
+        ('numpy',  [], ['input', 'differences', '--engine', 'numpy']),
+        ('python', [], ['input', 'differences', '--engine', 'python']),
+    ]),
+    ('stats daily', False, [
+        ('default', [], ['stats', 'daily']),
+    ]),
+    ('stats global', False, [
+        ('sketch', [], ['stats', 'global']),
+        ('exact',  [], ['stats', 'global', '--exact']),
+    ]),
+    ('input retained', False, [
+        ('default', [], ['input', 'retained']),
+    ]),
+    ('metadata refresh', False, [
+        ('default', [], ['metadata', 'refresh']),
+    ]),
+    ('daylight detect', False, [
+        ('serial', [], ['daylight', 'detect']),
+        ('jobs',   [], ['daylight', 'detect', '--jobs', '{jobs}']),
+    ]),
+    ('metadata instrument', False, [
+        ('sql',    [], ['metadata', 'instrument', '--engine', 'sql']),
+        ('python', [], ['metadata', 'instrument', '--engine', 'python']),
+        ('jobs',   [], ['metadata', 'instrument', '--engine', 'python', '--jobs', '{jobs}']),
+    ]),
+    ('metadata location', False, [
+        ('serial', [], ['metadata', 'location']),
+        ('jobs',   [], ['metadata', 'location', '--jobs', '{jobs}']),
+    ]),
+    ('metadata flags', False, [
+        ('default', [], ['metadata', 'flags']),
+    ]),
+    ('readings compare', False, [
+        ('serial', [], ['readings', 'compare']),
+        ('jobs',   [], ['readings', 'compare', '--jobs', '{jobs}']),
+    ]),
+    ('pipeline full', True, [
+        ('serial', [], ['pipeline', 'full', '--csv-file', '{csv}']),
+        ('jobs',   [], ['pipeline', 'full', '--csv-file', '{csv}', '--jobs', '{jobs}', '--workers', '{jobs}']),
+    ]),
+]
+
+# Logged by tdbtool main() instead of exiting with an error status
+FATAL = "Fatal error"
+
+# Logged by tdbtool when the REGEXP SQLite extension cannot be loaded
+EXTENSION_WARNING = "REGEXP extension"
+
+# Variants of these steps must leave the same rows as the first one
+CHECKS = {
+    'input slurp': '''
+        SELECT name, rank, date_id, time_id, tstamp, sequence_number, frequency, magnitude,
+               ambient_temperature, sky_temperature, signal_strength, line_number
+        FROM raw_readings_t
+        ORDER BY name, date_id, time_id
+    ''',
+}
+
+# These steps must change some rows, or the synthetic data misses what they look for
+MARKS = ('input retained',)
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def copy_database(src, dst):
+    '''Copies the database with its WAL files, if any. No source gives an empty database'''
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(dst + suffix):
+            os.remove(dst + suffix)
+        if src is not None and os.path.exists(src + suffix):
+            shutil.copyfile(src + suffix, dst + suffix)
+    # tdbtool refuses to create the extra database file itself
+    if src is None:
+        open(dst, 'w').close()
+
+
+def timed_rows(path):
+    '''Rows changed by the per photometer functions, as recorded with --timings'''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return sum(json.loads(line)['rows'] for line in f)
+
+
+def rows_digest(path, sql):
+    connection = sqlite3.connect(path)
+    digest = hashlib.sha1()
+    for row in connection.execute(sql):
+        digest.update(repr(row).encode('utf-8'))
+    connection.close()
+    return digest.hexdigest()
+
+
+def run_variant(options, work_dir, snapshot, label, global_args, command):
+    '''Runs one CLI command on a copy of the snapshot database. Returns (database, seconds, rows, ok)'''
+    extra   = os.path.join(work_dir, "{0}.db".format(label))
+    timings = os.path.join(work_dir, "{0}.jsonl".format(label))
+    log     = os.path.join(work_dir, "{0}.log".format(label))
+    copy_database(snapshot, extra)
+    if os.path.exists(timings):
+        os.remove(timings)
+    values = {'csv': options.csv, 'jobs': str(options.jobs)}
+    argv = shlex.split(options.command) + ['-d', options.reference, '-x', extra, '--timings', timings] + global_args
+    argv += [arg.format(**values) for arg in command]
+    started = time.time()
+    with open(log, 'w') as f:
+        status = subprocess.call(argv, stdout=f, stderr=subprocess.STDOUT)
+    seconds = time.time() - started
+    with open(log) as f:
+        ok = status == 0 and FATAL not in f.read()
+    return extra, seconds, timed_rows(timings), ok
+
+
+def preflight(options, work_dir):
+    '''Runs tdbtool once on an empty database, so a broken setup fails before any timing'''
+    os.makedirs(work_dir)
+    extra, seconds, rows, ok = run_variant(options, work_dir, None, 'preflight', [], ['show', 'global'])
+    log = os.path.join(work_dir, 'preflight.log')
+    with open(log) as f:
+        lines = f.readlines()
+    for line in lines:
+        if EXTENSION_WARNING in line:
+            print(line.rstrip())
+    if not ok:
+        print("{0} does not run, see {1}".format(options.command, log))
+        print(''.join(lines[-10:]), end='')
+    return ok
+
+
+def run_scenarios(options, work_dir):
+    table    = []
+    snapshot = None
+    for step, fresh, variants in SCENARIOS:
+        selected = options.only is None or step in options.only
+        if fresh and not selected:
+            continue
+        step_dir = os.path.join(work_dir, step.replace(' ', '_'))
+        os.makedirs(step_dir)
+        source = None if fresh else snapshot
+        reference = None
+        # Steps left out still run once, to feed the next ones
+        for i, (label, global_args, command) in enumerate(variants if selected else variants[:1]):
+            extra, seconds, rows, ok = run_variant(options, step_dir, source, label, global_args, command)
+            if not ok:
+                status = "FAILED (see {0})".format(os.path.join(step_dir, label + '.log'))
+            elif step in MARKS and not rows:
+                status = "NO ROWS MARKED"
+            elif step in CHECKS:
+                digest = rows_digest(extra, CHECKS[step])
+                reference = reference or (label, digest)
+                status = "ok" if digest == reference[1] else "ROWS DIFFER from {0}".format(reference[0])
+            else:
+                status = "ok"
+            if selected:
+                rate = round(options.readings / seconds) if seconds > 0 else None
+                table.append((step, label, round(seconds, 2), rate, rows, status))
+                print("{0:<20} {1:<12} {2:>8.2f} s".format(step, label, seconds))
+            if i == 0 and not fresh:
+                snapshot = extra
+    return table
+
+
+def createParser():
+    parser = argparse.ArgumentParser(description="Pipeline steps benchmark over a synthetic TESS network")
+    synthetic.add_arguments(parser)
+    parser.add_argument('--jobs', type=int, default=4, metavar="<N>", help='Worker processes for the parallel variants')
+    parser.add_argument('--only', type=str, nargs='+', metavar="<STEP>", help='Only report these steps, i.e. "input differences"')
+    parser.add_argument('--work-dir', type=str, metavar="<DIR>", help='Keep synthetic data, databases and logs in this directory')
+    parser.add_argument('--command', type=str, default="{0} -m tdbtool".format(sys.executable), metavar="<CMD>", help='tdbtool command line')
+    return parser
+
+
+def main():
+    options = createParser().parse_args(sys.argv[1:])
+    work_dir = options.work_dir or tempfile.mkdtemp()
+    data_dir = os.path.join(work_dir, 'data')
+    options.output_dir = data_dir
+    options.csv        = os.path.join(data_dir, 'readings.csv')
+    options.reference  = os.path.join(data_dir, 'tess.db')
+    print("Generating {0} photometers over {1} days in {2} ...".format(options.names, options.days, data_dir))
+    options.readings = synthetic.generate(options)
+    print("{0} readings".format(options.readings))
+    run_dir = os.path.join(work_dir, 'runs')
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    if not preflight(options, os.path.join(run_dir, 'preflight')):
+        sys.exit(1)
+    table = run_scenarios(options, run_dir)
+    print(tabulate.tabulate(table, headers=["Step", "Variant", "Time (s)", "Readings/s", "Rows", "Status"], tablefmt='grid'))
+    if not options.work_dir:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# TIMESTAMP PARSING MICRO-BENCHMARK
+#
+# Usage: PYTHONPATH=. python benchmarks/bench_timestamp.py [--number <N>]
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+from __future__ import print_function
+
+import sys
+import timeit
+import argparse
+import datetime as Datetime
+
+#--------------
+# local imports
+# -------------
+
+import tdbtool.s4a
+from tdbtool import TSTAMP_FORMAT
+
+# ----------------
+# Module constants
+# ----------------
+
+SAMPLES = [
+    "2020-01-31T23:59:59Z",
+    "2019-06-15T03:07:42Z",
+    "2021-12-01T00:00:00Z",
+]
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def csv_before(timestamp):
+    '''Per row work done by csv_generator before the fixed layout parser'''
+    t  = Datetime.datetime.strptime(timestamp, TSTAMP_FORMAT)
+    dt = tdbtool.s4a.datetime(t.year, t.month, t.day, t.hour, t.minute, t.second)
+    date_id, time_id = dt.to_dbase_ids()
+    return date_id, time_id, 3600*dt.hour + 60*dt.minute + dt.second
+
+
+def csv_after(timestamp):
+    return tdbtool.s4a.ids_from_iso8601(timestamp, TSTAMP_FORMAT)
+
+
+def ids_before(date_id, time_id):
+    '''Per row work done by readings/instrument/location before iso8601_from_ids'''
+    return tdbtool.s4a.datetime.from_dbase_ids(date_id, time_id).to_iso8601()
+
+
+def ids_after(date_id, time_id):
+    return tdbtool.s4a.iso8601_from_ids(date_id, time_id)
+
+
+def measure(func, args_list, number):
+    def loop():
+        for args in args_list:
+            func(*args)
+    best = min(timeit.repeat(loop, number=number, repeat=3))
+    return 1e6 * best / (number * len(args_list))
+
+
+def createParser():
+    parser = argparse.ArgumentParser(description="Timestamp parsing per row cost")
+    parser.add_argument('--number', type=int, default=20000, metavar="<N>", help='Loops per measurement')
+    return parser
+
+
+def main():
+    options = createParser().parse_args(sys.argv[1:])
+    ids = [tdbtool.s4a.ids_from_iso8601(s, TSTAMP_FORMAT)[0:2] for s in SAMPLES]
+    assert [csv_before(s) for s in SAMPLES] == [csv_after(s) for s in SAMPLES]
+    assert [ids_before(*i) for i in ids] == [ids_after(*i) for i in ids]
+    rows = [
+        ("ISO8601 -> ids", measure(csv_before, [(s,) for s in SAMPLES], options.number), measure(csv_after, [(s,) for s in SAMPLES], options.number)),
+        ("ids -> ISO8601", measure(ids_before, ids, options.number), measure(ids_after, ids, options.number)),
+    ]
+    print("{0:<16} {1:>12} {2:>12} {3:>8}".format("Conversion", "Before (us)", "After (us)", "Speedup"))
+    for label, before, after in rows:
+        print("{0:<16} {1:>12.3f} {2:>12.3f} {3:>7.1f}x".format(label, before, after, before/after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# SYNTHETIC TESS NETWORK GENERATOR: RAW CSV READINGS AND A MATCHING REFERENCE DATABASE
+#
+# Usage: PYTHONPATH=. python benchmarks/synthetic.py --output-dir <DIR> [--names <N>] [--days <D>]
+#                    [--periods <T> [<T> ...]] [--seed <N>]
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import sqlite3
+import argparse
+import datetime as Datetime
+
+#--------------
+# local imports
+# -------------
+
+from tdbtool import TSTAMP_FORMAT
+
+# ----------------
+# Module constants
+# ----------------
+
+START = Datetime.datetime(2020, 1, 1)
+
+CSV_HEADER = "timestamp;name;seq;freq;mag;tamb;tsky;rss"
+CSV_LINE    = "{0};{1};{2};{3};{4};{5};{6};{7}\n"
+QUOTED_LINE = "{0};\"{1}\";{2};\"{3}\";{4};{5};{6};\"{7}\"\n"
+
+# Daylight hours (UTC) where a photometer may send zero magnitudes
+DAYLIGHT_START = 10
+DAYLIGHT_END   = 14
+
+REFERENCE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS location_t
+(
+    location_id     INTEGER PRIMARY KEY,
+    site            TEXT,
+    longitude       REAL,
+    latitude        REAL
+);
+CREATE TABLE IF NOT EXISTS tess_t
+(
+    tess_id         INTEGER PRIMARY KEY,
+    mac_address     TEXT,
+    zero_point      REAL,
+    valid_since     TEXT,
+    valid_until     TEXT,
+    valid_state     TEXT
+);
+CREATE TABLE IF NOT EXISTS name_to_mac_t
+(
+    name            TEXT,
+    mac_address     TEXT,
+    valid_since     TEXT,
+    valid_until     TEXT,
+    valid_state     TEXT
+);
+CREATE TABLE IF NOT EXISTS tess_readings_t
+(
+    date_id         INTEGER,
+    time_id         INTEGER,
+    tess_id         INTEGER,
+    location_id     INTEGER,
+    sequence_number INTEGER,
+    frequency       REAL,
+    magnitude       REAL,
+    ambient_temperature REAL,
+    sky_temperature REAL,
+    signal_strength INTEGER,
+    PRIMARY KEY (date_id, time_id, tess_id)
+);
+CREATE INDEX IF NOT EXISTS name_to_mac_i ON name_to_mac_t(name);
+CREATE INDEX IF NOT EXISTS tess_mac_i ON tess_t(mac_address);
+CREATE INDEX IF NOT EXISTS tess_readings_i ON tess_readings_t(tess_id, date_id, time_id);
+'''
+
+# Far future end of validity, as in the real registry
+FOREVER = Datetime.datetime(2999, 12, 31, 23, 59, 59)
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def ids(tstamp):
+    return tstamp.year*10000 + tstamp.month*100 + tstamp.day, tstamp.hour*10000 + tstamp.minute*100 + tstamp.second
+
+
+def intervals(start, end, changes):
+    '''Splits [start, end) in changes+1 consecutive intervals, the last one open ended'''
+    span  = (end - start) // (changes + 1)
+    result = []
+    since = start
+    for i in range(changes + 1):
+        until = since + span if i < changes else FOREVER
+        result.append((since, until))
+        since = until
+    return result
+
+
+def find(table, tstamp):
+    for since, until, value in table:
+        if since <= tstamp < until:
+            return value
+    return None
+
+
+class Photometer(object):
+    '''Registry history of one photometer: MAC addresses, instrument versions and locations'''
+
+    def __init__(self, n, start, end, options, location_ids):
+        self.name   = "stars{0}".format(n)
+        self.period = random.choice(options.periods)
+        self.macs   = []
+        self.tess   = []
+        self.places = []
+        for m, (since, until) in enumerate(intervals(start + options.registry_lag, end, options.mac_changes)):
+            mac = "AA:BB:{0:02X}:{1:02X}:{2:02X}".format(n // 256, n % 256, m)
+            self.macs.append((since, until, mac))
+            # A calibration change halfway gives a new instrument version
+            middle = since + ((min(until, end) - since) // 2)
+            for a, b in ((since, middle), (middle, until)):
+                self.tess.append((a, b, mac))
+        for since, until in intervals(start, end, options.location_changes):
+            self.places.append((since, until, random.choice(location_ids)))
+
+
+def generate_registry(connection, photometers):
+    '''Fills name_to_mac_t and tess_t. Returns the tess_id lookup per photometer'''
+    lookups = {}
+    for p in photometers:
+        table = []
+        for since, until, mac in p.macs:
+            # Both ISO 8601 layouts are found in the real registry
+            connection.execute("INSERT INTO name_to_mac_t VALUES (?,?,?,?,'Current')",
+                (p.name, mac, since.strftime("%Y-%m-%d %H:%M:%S"), until.strftime("%Y-%m-%dT%H:%M:%S")))
+        for since, until, mac in p.tess:
+            cursor = connection.execute("INSERT INTO tess_t(mac_address, zero_point, valid_since, valid_until, valid_state) VALUES (?,?,?,?,'Current')",
+                (mac, round(random.uniform(20.0, 20.6), 2), since.strftime("%Y-%m-%dT%H:%M:%S"), until.strftime("%Y-%m-%d %H:%M:%S")))
+            table.append((since, until, cursor.lastrowid))
+        lookups[p.name] = table
+    connection.commit()
+    return lookups
+
+
+def photometer_readings(p, start, end, options):
+    '''
+    Time ordered (tstamp, seq, freq, mag, tamb, tsky, rss) readings of one photometer,
+    with retained values (some opening a new day), duplicated sequence numbers,
+    duplicated lines and daylight runs
+    '''
+    tstamp = start + Datetime.timedelta(seconds=random.uniform(0, p.period))
+    seq    = random.randint(1, 1000)
+    previous = None
+    while tstamp < end:
+        daylight = DAYLIGHT_START <= tstamp.hour < DAYLIGHT_END and tstamp.toordinal() % 100 < 100 * options.daylight
+        freq = round(random.uniform(1.0, 100.0), 2)
+        mag  = 0.0 if daylight else round(random.uniform(18.0, 22.0), 2)
+        rss  = random.choice([-70, -65, -80, None])
+        r = random.random()
+        rollover = previous is not None and previous[0].date() != tstamp.date()
+        if rollover and not daylight and random.random() < options.retained_rollover:
+            # A retained message opening a new day is left alone by the daily
+            # differences, so input retained is the step that confirms it
+            midnight = Datetime.datetime.combine(tstamp.date(), Datetime.time())
+            late = max(previous[0] + Datetime.timedelta(seconds=0.5 * p.period), midnight)
+            yield (late,) + previous[1:]
+            seq += 1
+        elif previous is not None and not daylight and r < options.retained:
+            # A retained message shows up halfway with the previous contents,
+            # and the next reading comes on time with a sequence number jump.
+            # Differences rejects it as a duplicated sequence number
+            late = previous[0] + Datetime.timedelta(seconds=0.5 * p.period)
+            yield (late,) + previous[1:]
+            seq += 1
+        elif r < options.retained + options.dup_seq:
+            seq -= 1
+        reading = (tstamp, seq, freq, mag, 10.5, -5.2, rss)
+        yield reading
+        if random.random() < options.duplicates:
+            yield reading
+        previous = reading
+        seq    += 1
+        tstamp += Datetime.timedelta(seconds=p.period + random.uniform(-0.5, 0.5))
+
+
+def generate(options):
+    '''Writes readings.csv and tess.db in options.output_dir. Returns the number of CSV readings'''
+    random.seed(options.seed)
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+    csv_path = os.path.join(options.output_dir, 'readings.csv')
+    ref_path = os.path.join(options.output_dir, 'tess.db')
+    if os.path.exists(ref_path):
+        os.remove(ref_path)
+    end = START + Datetime.timedelta(days=options.days)
+    connection = sqlite3.connect(ref_path)
+    connection.executescript(REFERENCE_SCHEMA)
+    location_ids = list(range(1, options.locations + 1))
+    connection.executemany("INSERT INTO location_t VALUES (?,?,?,?)",
+        [(i, "Site {0}".format(i), random.uniform(-10, 5), random.uniform(36, 44)) for i in location_ids])
+    connection.execute("INSERT INTO location_t VALUES (-1, 'Unknown', NULL, NULL)")
+    photometers = [Photometer(n, START, end, options, location_ids) for n in range(options.names)]
+    lookups = generate_registry(connection, photometers)
+    # One day at a time across all photometers, keeping the CSV in time order
+    streams = dict((p.name, photometer_readings(p, START, end, options)) for p in photometers)
+    pending = dict((name, next(stream, None)) for name, stream in streams.items())
+    count   = 0
+    day     = START
+    with open(csv_path, 'w') as f:
+        f.write(CSV_HEADER + '\n')
+        while day < end:
+            day_end = day + Datetime.timedelta(days=1)
+            lines = []
+            references = []
+            for p in photometers:
+                reading = pending[p.name]
+                while reading is not None and reading[0] < day_end:
+                    tstamp, seq, freq, mag, tamb, tsky, rss = reading
+                    stamp = tstamp.replace(microsecond=0)
+                    lines.append((stamp, p.name, seq, freq, mag, tamb, tsky, rss))
+                    tess_id = find(lookups[p.name], stamp)
+                    # The reference database already got part of the readings, a bit shifted
+                    if tess_id is not None and random.random() < options.coverage:
+                        shifted = stamp + Datetime.timedelta(seconds=random.choice([0, 0, 1, -1]))
+                        ref_seq = seq + 1 if random.random() < options.shifted else seq
+                        references.append(ids(shifted) + (tess_id, find(p.places, stamp), ref_seq, freq, mag, tamb, tsky, rss))
+                    reading = next(streams[p.name], None)
+                pending[p.name] = reading
+            lines.sort(key=lambda line: line[0])
+            for stamp, name, seq, freq, mag, tamb, tsky, rss in lines:
+                # Some exporters quote text and numeric fields alike
+                line_format = QUOTED_LINE if random.random() < options.quoted else CSV_LINE
+                f.write(line_format.format(stamp.strftime(TSTAMP_FORMAT), name, seq, freq, mag, tamb, tsky, '' if rss is None else rss))
+            connection.executemany("INSERT OR IGNORE INTO tess_readings_t VALUES (?,?,?,?,?,?,?,?,?,?)", references)
+            connection.commit()
+            count += len(lines)
+            day = day_end
+    connection.close()
+    return count
+
+
+def add_arguments(parser):
+    '''Network shape and anomaly options, shared with bench_pipeline.py'''
+    parser.add_argument('--names', type=int, default=10, metavar="<N>", help='Number of photometers')
+    parser.add_argument('--days', type=int, default=7, metavar="<D>", help='Number of days')
+    parser.add_argument('--periods', type=float, nargs='+', default=[60.0], metavar="<T>", help='Transmission periods to choose from (s)')
+    parser.add_argument('--mac-changes', type=int, default=2, metavar="<N>", help='MAC address changes per photometer')
+    parser.add_argument('--location-changes', type=int, default=1, metavar="<N>", help='Location changes per photometer')
+    parser.add_argument('--locations', type=int, default=20, metavar="<N>", help='Number of sites')
+    parser.add_argument('--registry-lag', type=lambda h: Datetime.timedelta(hours=float(h)), default=Datetime.timedelta(hours=6), metavar="<H>", help='Hours of readings before the registry starts')
+    parser.add_argument('--duplicates', type=float, default=0.005, metavar="<F>", help='Fraction of duplicated lines')
+    parser.add_argument('--dup-seq', type=float, default=0.005, metavar="<F>", help='Fraction of repeated sequence numbers')
+    parser.add_argument('--retained', type=float, default=0.002, metavar="<F>", help='Fraction of retained readings sent again')
+    parser.add_argument('--retained-rollover', type=float, default=0.5, metavar="<F>", help='Fraction of day rollovers with a retained reading')
+    parser.add_argument('--daylight', type=float, default=0.3, metavar="<F>", help='Fraction of days with zero magnitude daylight runs')
+    parser.add_argument('--coverage', type=float, default=0.7, metavar="<F>", help='Fraction of readings already in the reference database')
+    parser.add_argument('--shifted', type=float, default=0.01, metavar="<F>", help='Fraction of reference readings with another sequence number')
+    parser.add_argument('--quoted', type=float, default=0.01, metavar="<F>", help='Fraction of CSV lines with quoted fields')
+    parser.add_argument('--seed', type=int, default=1, metavar="<N>", help='Random seed')
+
+
+def createParser():
+    parser = argparse.ArgumentParser(description="Synthetic TESS network generator")
+    parser.add_argument('--output-dir', type=str, required=True, metavar="<DIR>", help='Directory for readings.csv and tess.db')
+    add_arguments(parser)
+    return parser
+
+
+def main():
+    options = createParser().parse_args(sys.argv[1:])
+    count = generate(options)
+    print("{0} readings from {1} photometers over {2} days in {3}".format(count, options.names, options.days, options.output_dir))
+
+
+if __name__ == '__main__':
+    main()
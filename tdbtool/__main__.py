@@ -27,16 +27,21 @@ from pkg_resources import resource_filename
 
 from . import __version__
 
-from .utils      import utf8, mkdate, percent, open_database
+from .utils      import utf8, mkdate, percent, open_database, load_regexp_extension, CONNECTION_PROFILES, DEFAULT_PROFILE, DEFAULT_REF_PROFILE
+from .functions  import register_functions
 from .input      import input_slurp, input_differences, input_retained
 from .stats      import stats_daily, stats_global
-from .show       import show_global, show_daily, show_differences, show_duplicated, show_count
+from .show       import show_global, show_daily, show_differences, show_duplicated, show_count, show_timings
 from .plot       import plot_period, plot_differences
 from .daylight   import daylight_detect
 from .metadata   import metadata_flags, metadata_refresh
 from .location   import metadata_location
 from .instrument import metadata_instrument
 from .readings   import readings_compare
+from .db         import db_optimize
+from .checkpoint import start_run, finish_run, run_step
+from .profiling  import configure
+from .           import tracing
 
 # ----------------
 # Module constants
@@ -45,9 +50,6 @@ from .readings   import readings_compare
 DEFAULT_DBASE = "/var/dbase/tess.db"
 EXTRA_DBASE   = "/var/dbase/extra.db"
 
-SQLITE_MATH_MODULE   = "/usr/local/lib/libsqlitefunctions.so"
-SQLITE_REGEXP_MODULE = "/usr/lib/sqlite3/pcre.so"
-
 # -----------------------
 # Module global variables
 # -----------------------
@@ -88,6 +90,11 @@ def createParser():
     parser.add_argument('--version', action='version', version='{0} {1}'.format(name, __version__))
     parser.add_argument('-d', '--dbase', default=DEFAULT_DBASE, help='SQLite database full file path')
     parser.add_argument('-x', '--extra-dbase', default=EXTRA_DBASE, help='SQLite extra database full file path')
+    parser.add_argument('--db-profile', choices=sorted(CONNECTION_PROFILES), default=DEFAULT_PROFILE, help='Connection profile for the extra database')
+    parser.add_argument('--ref-db-profile', choices=sorted(CONNECTION_PROFILES), default=DEFAULT_REF_PROFILE, help='Connection profile for the reference database')
+    parser.add_argument('--timings', type=str, metavar="<FILE>", help='Append per step and per TESS-W timings to a JSON lines file')
+    parser.add_argument('--trace-sql', action='store_true', help='Trace SQL statements and report the hottest ones at exit')
+    parser.add_argument('--trace-top', type=int, default=20, metavar="<N>", help='Number of statements in the --trace-sql report')
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument('-v', '--verbose', action='store_true', help='Verbose output.')
     group1.add_argument('-q', '--quiet',   action='store_true', help='Quiet output.')
@@ -105,6 +112,7 @@ def createParser():
     parser_pipe  = subparser.add_parser('pipeline', help='pipeline commands')
     parser_meta  = subparser.add_parser('metadata', help='metadata commands')
     parser_read  = subparser.add_parser('readings', help='readings commands')
+    parser_db    = subparser.add_parser('db', help='database commands')
 
     # ------------------------------------------
     # Create second level parsers for 'input'
@@ -112,11 +120,18 @@ def createParser():
   
     subparser = parser_input.add_subparsers(dest='subcommand')
     isl = subparser.add_parser('slurp', help='ingest input file')
-    isl.add_argument('--csv-file', required=True, type=str, help='CSV file to ingest')
-    isl.add_argument('--name', type=str, help='Optional TESS-W name to filter')
+    islex = isl.add_mutually_exclusive_group(required=True)
+    islex.add_argument('--csv-file', type=str, nargs='+', help='CSV files or glob patterns to ingest, optionally gzip/bz2/xz compressed. - reads from stdin')
+    islex.add_argument('--csv-dir', type=str, help='Directory with CSV files to ingest')
+    isl.add_argument('--name', type=str, action='append', help='Optional TESS-W name to filter. May be repeated')
+    isl.add_argument('--workers', type=int, default=1, metavar="<N>", help='Parse the CSV file with N worker processes')
+    isl.add_argument('--mmap', action='store_true', help='Parse single process plain CSV files through a memory map')
+    isl.add_argument('--incremental', action='store_true', help='Drop lines older than the last ingested timestamp per TESS-W before parsing them')
+    isl.add_argument('--sorted', action='store_true', help='CSV file is sorted by time. With --incremental and --name, seek past already ingested lines')
 
     ist = subparser.add_parser('differences', help='compute differences between consecutive readings')
     ist.add_argument('--name', type=str, help='Optional TESS-W name to filter')
+    ist.add_argument('--engine', choices=['auto', 'sql', 'numpy', 'python'], default='auto', help='Differences computation engine')
 
     isr = subparser.add_parser('retained', help='fix isolated out retained values')
     isr.add_argument('--name', type=str, help='Optional TESS-W name')
@@ -130,10 +145,13 @@ def createParser():
     subparser = parser_stats.add_subparsers(dest='subcommand')
     sdy = subparser.add_parser('daily',  help='compute daily period statistics')
     sdy.add_argument('--name', type=str, help='Optional TESS-W name')
+    sdy.add_argument('--full', action='store_true', help='Recompute all days, not only those with new differences')
     
     sgl = subparser.add_parser('global', help='compute global period statistics')
     sgl.add_argument('--name', type=str, help='Optional TESS-W name')
     sgl.add_argument('--period', type=float, metavar='<T>', help='Set global period for a given TESS-W')
+    sgl.add_argument('--full', action='store_true', help='Recompute all TESS-W, not only those with new daily statistics')
+    sgl.add_argument('--exact', action='store_true', help='Exact median over all daily statistics instead of the quantile sketch')
     
     # ------------------------------------------
     # Create second level parsers for 'plot'
@@ -160,6 +178,7 @@ def createParser():
     subparser = parser_day.add_subparsers(dest='subcommand')
     pdd = subparser.add_parser('detect', help='Detect daylight readings')
     pdd.add_argument('--name', type=str, help='Optional TESS-W name')
+    pdd.add_argument('--jobs', type=int, default=1, metavar="<N>", help='Process photometers with N worker processes and a single database writer')
 
     # ------------------------------------------
     # Create second level parsers for 'pipeline'
@@ -167,15 +186,35 @@ def createParser():
 
     subparser = parser_pipe.add_subparsers(dest='subcommand')
     pp1 = subparser.add_parser('stage1', help='Stage 1 Pipeline')
-    pp1.add_argument('--csv-file', required=True, type=str, help='CSV file to ingest')
+    pp1ex = pp1.add_mutually_exclusive_group(required=True)
+    pp1ex.add_argument('--csv-file', type=str, nargs='+', help='CSV files or glob patterns to ingest, optionally gzip/bz2/xz compressed. - reads from stdin')
+    pp1ex.add_argument('--csv-dir', type=str, help='Directory with CSV files to ingest')
     pp1.add_argument('--name', type=str, help='Optional TESS-W name')
+    pp1.set_defaults(engine='auto', full=False, exact=False, test=False, limit=10)
+    pp1.add_argument('--resume', action='store_true', help='Skip steps and photometers already completed by the last pipeline run')
+    pp1.add_argument('--workers', type=int, default=1, metavar="<N>", help='Parse the CSV file with N worker processes')
+    pp1.add_argument('--mmap', action='store_true', help='Parse single process plain CSV files through a memory map')
+    pp1.add_argument('--incremental', action='store_true', help='Drop lines older than the last ingested timestamp per TESS-W before parsing them')
+    pp1.add_argument('--sorted', action='store_true', help='CSV file is sorted by time. With --incremental and --name, seek past already ingested lines')
     
     pp2 = subparser.add_parser('stage2', help='Stage 2 Pipeline')
     pp2.add_argument('--name', type=str, help='Optional TESS-W name')
+    pp2.add_argument('--jobs', type=int, default=1, metavar="<N>", help='Process photometers with N worker processes and a single database writer')
+    pp2.set_defaults(engine='auto')
+    pp2.add_argument('--resume', action='store_true', help='Skip steps and photometers already completed by the last pipeline run')
    
     ppf = subparser.add_parser('full', help='Full Pipeline')
-    ppf.add_argument('--csv-file', required=True, type=str, help='CSV file to ingest')
+    ppfex = ppf.add_mutually_exclusive_group(required=True)
+    ppfex.add_argument('--csv-file', type=str, nargs='+', help='CSV files or glob patterns to ingest, optionally gzip/bz2/xz compressed. - reads from stdin')
+    ppfex.add_argument('--csv-dir', type=str, help='Directory with CSV files to ingest')
     ppf.add_argument('--name', type=str, help='Optional TESS-W name')
+    ppf.set_defaults(engine='auto', full=False, exact=False, test=False, limit=10)
+    ppf.add_argument('--resume', action='store_true', help='Skip steps and photometers already completed by the last pipeline run')
+    ppf.add_argument('--jobs', type=int, default=1, metavar="<N>", help='Process photometers with N worker processes and a single database writer')
+    ppf.add_argument('--workers', type=int, default=1, metavar="<N>", help='Parse the CSV file with N worker processes')
+    ppf.add_argument('--mmap', action='store_true', help='Parse single process plain CSV files through a memory map')
+    ppf.add_argument('--incremental', action='store_true', help='Drop lines older than the last ingested timestamp per TESS-W before parsing them')
+    ppf.add_argument('--sorted', action='store_true', help='CSV file is sorted by time. With --incremental and --name, seek past already ingested lines')
 
     # ------------------------------------------
     # Create second level parsers for 'metadata'
@@ -191,9 +230,12 @@ def createParser():
 
     pml = subparser.add_parser('location', help='Add location metadata to readings')
     pml.add_argument('--name', type=str, help='Optional TESS-W name')
+    pml.add_argument('--jobs', type=int, default=1, metavar="<N>", help='Process photometers with N worker processes and a single database writer')
 
     pmi = subparser.add_parser('instrument', help='Add instrument metadata to readings')
     pmi.add_argument('--name', type=str, help='Optional TESS-W name')
+    pmi.add_argument('--engine', choices=['auto', 'sql', 'python'], default='auto', help='Instrument resolution engine. auto uses sql for all photometers')
+    pmi.add_argument('--jobs', type=int, default=1, metavar="<N>", help='With the python engine, process photometers with N worker processes and a single database writer')
 
     # ------------------------------------------
     # Create second level parsers for 'readings'
@@ -203,6 +245,15 @@ def createParser():
     
     prc = subparser.add_parser('compare', help='Compare readings with the reference database')
     prc.add_argument('--name', type=str,  help='Optional TESS-W name')
+    prc.add_argument('--jobs', type=int, default=1, metavar="<N>", help='Process photometers with N worker processes and a single database writer')
+
+    # ------------------------------------------
+    # Create second level parsers for 'db'
+    # ------------------------------------------
+
+    subparser = parser_db.add_subparsers(dest='subcommand')
+    dop = subparser.add_parser('optimize', help='Create secondary indexes, run ANALYZE and report query plans')
+    dop.add_argument('--report-only', action='store_true', help='Only report query plans and full scans')
 
     # ------------------------------------------
     # Create second level parsers for 'show'
@@ -232,6 +283,12 @@ def createParser():
     sha.add_argument('--rank', required=True, type=int, metavar='<N>', help='rank order')
     sha.add_argument('--width', type=int, default= 3, metavar='<N>', help='display width')
 
+    sht = subparser.add_parser('timings', help='show step and per TESS-W timings, slowest first')
+    sht.add_argument('--name', type=str, help='Optional TESS-W name')
+    sht.add_argument('--step', type=str, help='Optional step or per TESS-W function')
+    sht.add_argument('--run', type=int, metavar='<N>', help='Only this pipeline run. Defaults to the last one plus the commands run outside pipelines')
+    sht.add_argument('--limit',  type=int, default=10, metavar="<N>", help='Optional limit')
+
     shc = subparser.add_parser('count', help='show counts')
     shc.add_argument('--name', type=str, help='Optional TESS-W name')
     shcex = shc.add_mutually_exclusive_group(required=True)
@@ -253,34 +310,43 @@ def createParser():
 # ================= #
 
 def pipeline_stage1(connection, options):
+    started = start_run(connection, options)
     logging.info("[{0}] =============== PIPELINE STAGE 1 STEP 1 ===============".format(__name__))
-    input_slurp(connection, options)
+    run_step(connection, options, input_slurp)
     logging.info("[{0}] =============== PIPELINE STAGE 1 STEP 2 ===============".format(__name__))
-    input_differences(connection, options)
+    run_step(connection, options, input_differences)
     logging.info("[{0}] =============== PIPELINE STAGE 1 STEP 3 ===============".format(__name__))
-    stats_daily(connection, options)
+    run_step(connection, options, stats_daily)
     logging.info("[{0}] =============== PIPELINE STAGE 1 STEP 4 ===============".format(__name__))
-    stats_global(connection, options)
+    run_step(connection, options, stats_global)
     logging.info("[{0}] =============== PIPELINE STAGE 1 STEP 5 ===============".format(__name__))
-    input_retained(connection, options)
+    run_step(connection, options, input_retained)
+    if started:
+        finish_run(connection, options)
 
 def pipeline_stage2(connection, options):
+    started = start_run(connection, options)
     logging.info("[{0}] =============== PIPELINE STAGE 2 STEP 1 ===============".format(__name__))
-    metadata_refresh(connection, options)
+    run_step(connection, options, metadata_refresh)
     logging.info("[{0}] =============== PIPELINE STAGE 2 STEP 2 ===============".format(__name__))
-    daylight_detect(connection, options)
+    run_step(connection, options, daylight_detect)
     logging.info("[{0}] =============== PIPELINE STAGE 2 STEP 3 ===============".format(__name__))
-    metadata_instrument(connection, options)
+    run_step(connection, options, metadata_instrument)
     logging.info("[{0}] =============== PIPELINE STAGE 2 STEP 4 ===============".format(__name__))
-    metadata_location(connection, options)
+    run_step(connection, options, metadata_location)
     logging.info("[{0}] =============== PIPELINE STAGE 2 STEP 5 ===============".format(__name__))
-    metadata_flags(connection, options)
+    run_step(connection, options, metadata_flags)
     logging.info("[{0}] =============== PIPELINE STAGE 2 STEP 6 ===============".format(__name__))
-    readings_compare(connection, options)
+    run_step(connection, options, readings_compare)
+    if started:
+        finish_run(connection, options)
 
 def pipeline_full(connection, options):
+    started = start_run(connection, options)
     pipeline_stage1(connection, options)
     pipeline_stage2(connection, options)
+    if started:
+        finish_run(connection, options)
 
 
 # ================ #
@@ -294,11 +360,12 @@ def main():
     try:
         options = createParser().parse_args(sys.argv[1:])
         configureLogging(options)
+        configure(options)
+        tracing.configure(options)
         logging.info("[{0}] Opening database {1}".format(__name__,options.extra_dbase))
-        connection = open_database(options.extra_dbase)
-        connection.enable_load_extension(True)
-        connection.load_extension(SQLITE_MATH_MODULE)
-        connection.load_extension(SQLITE_REGEXP_MODULE)
+        connection = open_database(options.extra_dbase, options.db_profile)
+        register_functions(connection)
+        load_regexp_extension(connection)
         create_datamodel(connection, options)
         command    = options.command
         subcommand = options.subcommand
@@ -311,6 +378,8 @@ def main():
         logging.error("[{0}] Fatal error => {1}".format(__name__, str(e) ))
         traceback.print_exc()
     finally:
-        pass
+        if tracing.enabled():
+            tracing.report(options.trace_top)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# PIPELINE CHECKPOINTS TO RESUME INTERRUPTED RUNS
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import time
+import logging
+
+# -------------
+# Local imports
+# -------------
+
+from .profiling import ALL_NAMES, Probe, enabled, record_timing, bookkeeping, iso8601
+
+# ----------------
+# Module constants
+# ----------------
+
+# pipeline_status_t states
+RUNNING  = 'running'
+FINISHED = 'finished'
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# --------------
+# Module classes
+# --------------
+
+class Checkpoint(object):
+    '''
+    Completed (step, name) units of a pipeline run, kept in pipeline_runs_t.
+    Units are recorded and committed as soon as they finish, so an interrupted
+    run can be resumed by skipping them.
+    '''
+
+    def __init__(self, connection, run_id):
+        self.connection = connection
+        self.run_id     = run_id
+
+    def done(self, step, name=ALL_NAMES):
+        row = {'run_id': self.run_id, 'step': step, 'name': name}
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT COUNT(*)
+            FROM pipeline_runs_t
+            WHERE run_id == :run_id
+            AND   step   == :step
+            AND   name   == :name
+            ''', row)
+        return cursor.fetchone()[0] > 0
+
+    def record(self, step, name, started, seconds, rows):
+        row = {
+            'run_id' : self.run_id,
+            'step'   : step,
+            'name'   : name,
+            'started': iso8601(started),
+            'seconds': seconds,
+            'rows'   : rows,
+        }
+        self.connection.execute('''
+            INSERT OR REPLACE INTO pipeline_runs_t(run_id, step, name, started, seconds, rows)
+            VALUES (:run_id, :step, :name, :started, :seconds, :rows)
+            ''', row)
+        self.connection.commit()
+        bookkeeping()
+
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def last_run_id(connection):
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT MAX(run_id) FROM (
+            SELECT run_id FROM pipeline_status_t
+            UNION ALL
+            SELECT run_id FROM pipeline_runs_t
+        )
+        ''')
+    return cursor.fetchone()[0]
+
+
+def unfinished_run_id(connection):
+    '''The last pipeline run if it did not finish, None otherwise'''
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT run_id, status
+        FROM pipeline_status_t
+        ORDER BY run_id DESC
+        LIMIT 1
+        ''')
+    result = cursor.fetchone()
+    return result[0] if result is not None and result[1] != FINISHED else None
+
+
+def start_run(connection, options):
+    '''
+    Sets options.run_id: the last run when resuming and it did not finish,
+    a new one otherwise. A new run is recorded as running before any step.
+    Nested pipelines (full = stage1 + stage2) share the run already started
+    and leave finishing it to the outer one. Returns True for the outer one.
+    '''
+    if getattr(options, 'run_id', None) is not None:
+        return False
+    run_id = unfinished_run_id(connection) if options.resume else None
+    if run_id is not None:
+        logging.info("[{0}] Resuming pipeline run {1}".format(__name__, run_id))
+    else:
+        if options.resume:
+            logging.info("[{0}] No unfinished pipeline run to resume".format(__name__))
+        run_id = last_run_id(connection)
+        run_id = 1 if run_id is None else run_id + 1
+        logging.info("[{0}] Starting pipeline run {1}".format(__name__, run_id))
+        row = {'run_id': run_id, 'command': options.subcommand, 'started': iso8601(time.time()), 'status': RUNNING}
+        connection.execute('''
+            INSERT INTO pipeline_status_t(run_id, command, started, status)
+            VALUES (:run_id, :command, :started, :status)
+            ''', row)
+        connection.commit()
+    options.run_id = run_id
+    return True
+
+
+def finish_run(connection, options):
+    row = {'run_id': options.run_id, 'finished': iso8601(time.time()), 'status': FINISHED}
+    connection.execute('''
+        UPDATE pipeline_status_t
+        SET    finished = :finished, status = :status
+        WHERE  run_id == :run_id
+        ''', row)
+    connection.commit()
+    logging.info("[{0}] Pipeline run {1} finished".format(__name__, options.run_id))
+
+
+def checkpoint(connection, options):
+    '''Checkpoint of the current pipeline run, None outside pipelines'''
+    run_id = getattr(options, 'run_id', None)
+    return None if run_id is None else Checkpoint(connection, run_id)
+
+
+def run_step(connection, options, step):
+    '''Runs a whole pipeline step unless already completed in this run, recording its timings'''
+    check = checkpoint(connection, options)
+    name  = options.name or ALL_NAMES
+    if check is not None and check.done(step.__name__, name):
+        logging.info("[{0}] Skipping {1}, already completed in run {2}".format(__name__, step.__name__, check.run_id))
+        return
+    probe = Probe(connection)
+    step(connection, options)
+    measure = probe.stop()
+    if enabled():
+        record_timing(connection, step.__name__, name, measure)
+    if check is not None:
+        check.record(step.__name__, name, measure['started'], measure['seconds'], measure['rows'])
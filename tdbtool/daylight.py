@@ -32,6 +32,8 @@ import tdbtool.s4a
 from .      import __version__
 from .      import DAYLIGHT
 from .utils import paging, shift_generator, candidate_names_iterable
+from .profiling import profiled
+from .parallel import run_by_name
 
 # ----------------
 # Module constants
@@ -40,6 +42,22 @@ from .utils import paging, shift_generator, candidate_names_iterable
 SHIFT_SIZE      = 7
 ROWS_PER_COMMIT = 50000
 
+CANDIDATES_SQL = '''
+    SELECT name, date_id, time_id, sequence_number, frequency, magnitude
+    FROM  raw_readings_t
+    WHERE name == :name
+    AND   rejected IS NULL
+    ORDER BY date_id ASC, time_id ASC
+'''
+
+MARK_DAYLIGHT_SQL = '''
+    UPDATE raw_readings_t
+    SET rejected = :reason
+    WHERE name == :name
+    AND   date_id == :date_id
+    AND   time_id == :time_id
+'''
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -49,8 +67,8 @@ def is_monotonic(aList):
     # Calculate first difference
     # Modified second difference with absolute values, to avoid cancellation 
     # in final sum due to symmetric differences
-    first_diff  = tuple(aList[i+1] - aList[i] for i in xrange(len(aList)-1))
-    second_diff = tuple(abs(first_diff[i+1] - first_diff[i])  for i in xrange(len(first_diff)-1))
+    first_diff  = tuple(aList[i+1] - aList[i] for i in range(len(aList)-1))
+    second_diff = tuple(abs(first_diff[i+1] - first_diff[i])  for i in range(len(first_diff)-1))
     return sum(second_diff) == 0
 
 
@@ -64,31 +82,18 @@ def is_invalid(iterable):
 def candidates_iterable(connection, name):
     row = {'name': name}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT name, date_id, time_id, sequence_number, frequency, magnitude
-        FROM  raw_readings_t 
-        WHERE name == :name
-        AND   rejected IS NULL
-        ORDER BY date_id ASC, time_id ASC
-        ''', row)
+    cursor.execute(CANDIDATES_SQL, row)
     return cursor
 
 
 def mark_daylight(connection, iterable):
     logging.debug("[{0}] Marking daylight for {1} rows".format(__name__, len(iterable)))
     cursor = connection.cursor()
-    cursor.executemany(
-        '''
-        UPDATE raw_readings_t
-        SET rejected = :reason
-        WHERE name == :name
-        AND   date_id == :date_id
-        AND   time_id == :time_id
-         ''', iterable)
+    cursor.executemany(MARK_DAYLIGHT_SQL, iterable)
     connection.commit()
 
 
+@profiled
 def daylight_detect_by_name(connection, name):
     logging.debug("[{0}] detecting daylight readings for {1}".format(__name__, name))
     count = 0
@@ -119,10 +124,6 @@ def daylight_detect_by_name(connection, name):
 # ==============
 
 def daylight_detect(connection, options):
-    if options.name is not None:
-        daylight_detect_by_name(connection, options.name)
-    else:
-        for name in candidate_names_iterable(connection):
-            daylight_detect_by_name(connection, name[0])
+    run_by_name(connection, options, daylight_detect_by_name)
 
 
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+# TESS UTILITY TO PERFORM SOME MAINTENANCE COMMANDS
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2014 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+from __future__ import print_function
+
+import os
+import re
+import logging
+import sqlite3
+import importlib
+
+# Access  template withing the package
+from pkg_resources import resource_filename
+
+#--------------
+# other imports
+# -------------
+
+import tabulate
+
+# -------------
+# Local imports
+# -------------
+
+from .input      import create_staging_table
+from .instrument import attach_reference_database, detach_reference_database, READING_MAC_TABLE_SQL
+
+# ----------------
+# Module constants
+# ----------------
+
+# Pipeline step modules whose *_SQL constants hold the statements of the steps.
+# Step code executes those very constants, so the plans report cannot drift from them.
+SQL_MODULES = ('utils', 'input', 'stats', 'daylight', 'metadata', 'instrument', 'location', 'readings')
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# --------------
+# Module classes
+# --------------
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def statements():
+    '''(label, sql) pairs for all *_SQL constants in SQL_MODULES'''
+    result = []
+    for name in SQL_MODULES:
+        module = importlib.import_module('.' + name, __package__)
+        for attr in sorted(vars(module)):
+            if attr.endswith('_SQL'):
+                result.append(("{0}.{1}".format(name, attr), getattr(module, attr)))
+    return result
+
+
+def query_plan(connection, sql):
+    '''Returns the EXPLAIN QUERY PLAN detail lines, binding NULL to all parameters'''
+    names = re.findall(r':(\w+)', sql)
+    params = dict.fromkeys(names) if names else (None,) * sql.count('?')
+    cursor = connection.cursor()
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    except sqlite3.Error as e:
+        return ["not planned: {0}".format(e)]
+    return [row[-1] for row in cursor]
+
+
+def is_full_scan(detail):
+    '''A SCAN visits every row of a table or index, unlike a SEARCH'''
+    return detail.startswith('SCAN') and 'CONSTANT ROW' not in detail
+
+
+def attach_plan_tables(connection, options):
+    '''
+    Reference database and temporary tables some statements need to be planned.
+    Reference statements are planned against the attached (read-only) tess.db.
+    Returns True if the reference database could be attached.
+    '''
+    create_staging_table(connection)
+    if not os.path.exists(options.dbase):
+        logging.warning("[{0}] No reference database at {1}, its statements will not be planned".format(__name__, options.dbase))
+        return False
+    try:
+        attach_reference_database(connection, options.dbase, options.ref_db_profile)
+        connection.execute("CREATE TEMP TABLE reading_mac_t AS " + READING_MAC_TABLE_SQL + " LIMIT 0", {'name': None})
+    except Exception:
+        detach_reference_database(connection)
+        raise
+    return True
+
+
+def plans_report(connection, options):
+    attached = attach_plan_tables(connection, options)
+    rows = []
+    try:
+        for label, sql in statements():
+            plan = query_plan(connection, sql)
+            scans = [detail for detail in plan if is_full_scan(detail)]
+            rows.append((label, '\n'.join(plan), 'FULL SCAN' if scans else ''))
+    finally:
+        if attached:
+            detach_reference_database(connection)
+    return rows
+
+
+def create_indexes(connection):
+    indexes_path = resource_filename(__name__, 'sql/indexes.sql')
+    with open(indexes_path) as f:
+        script = f.read()
+    logging.info("[{0}] Creating indexes from {1}".format(__name__, indexes_path))
+    connection.executescript(script)
+
+
+# ==============
+# MAIN FUNCTIONS
+# ==============
+
+def db_optimize(connection, options):
+    headers = ["Statement", "Query Plan", "Full scan"]
+    rows = plans_report(connection, options)
+    if options.report_only:
+        print(tabulate.tabulate(rows, headers=headers, tablefmt='grid'))
+        return
+    before = sum(1 for row in rows if row[2])
+    create_indexes(connection)
+    logging.info("[{0}] Gathering planner statistics with ANALYZE".format(__name__))
+    connection.execute("ANALYZE main")
+    connection.commit()
+    rows = plans_report(connection, options)
+    after = sum(1 for row in rows if row[2])
+    print(tabulate.tabulate(rows, headers=headers, tablefmt='grid'))
+    logging.info("[{0}] Statements with full scans: {1} before, {2} after".format(__name__, before, after))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# SQLITE USER DEFINED FUNCTIONS IMPLEMENTED IN PYTHON
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import math
+import heapq
+
+#--------------
+# local imports
+# -------------
+
+from .s4a import iso8601_from_ids
+
+# ----------------
+# Module constants
+# ----------------
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# --------------
+# Module classes
+# --------------
+
+class Median(object):
+    '''
+    Streaming MEDIAN() aggregate.
+    Keeps two heaps: a max-heap (stored negated) with the lower half
+    and a min-heap with the upper half, so each step is O(log n)
+    and the median is read from the heap tops at the end.
+    NULLs are ignored, as with the rest of SQLite aggregates.
+    '''
+
+    def __init__(self):
+        self.low  = []
+        self.high = []
+
+    def step(self, value):
+        if value is None:
+            return
+        if not self.low or value <= -self.low[0]:
+            heapq.heappush(self.low, -value)
+        else:
+            heapq.heappush(self.high, value)
+        # Rebalance so that len(low) is len(high) or len(high) + 1
+        if len(self.low) > len(self.high) + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+        elif len(self.high) > len(self.low):
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+
+    def finalize(self):
+        if not self.low:
+            return None
+        if len(self.low) > len(self.high):
+            return -self.low[0]
+        return (-self.low[0] + self.high[0]) / 2.0
+
+
+class Stdev(object):
+    '''
+    Streaming STDEV() aggregate (sample standard deviation).
+    Uses Welford's online algorithm, numerically stable in a single pass.
+    Returns 0.0 for groups with less than two values, as libsqlitefunctions does.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.mean  = 0.0
+        self.m2    = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2   += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def iso8601fromids(date_id, time_id):
+    if date_id is None or time_id is None:
+        return None
+    return iso8601_from_ids(date_id, time_id)
+
+
+def register_functions(connection):
+    '''Register the Python user defined functions in a SQLite connection'''
+    connection.create_aggregate("MEDIAN", 1, Median)
+    connection.create_aggregate("STDEV", 1, Stdev)
+    connection.create_function("iso8601fromids", 2, iso8601fromids)
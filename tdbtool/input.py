@@ -23,6 +23,27 @@ import sqlite3
 import logging
 import csv
 import traceback
+import collections
+import itertools
+import multiprocessing
+import io
+import mmap
+import glob
+import gzip
+import bz2
+import datetime as Datetime
+
+# lzma is not available in Python 2
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# NumPy is only needed by the numpy differences engine
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # -------------
 # Local imports
@@ -31,15 +52,240 @@ import traceback
 import tdbtool.s4a
 from .      import __version__
 from .      import DUP_SEQ_NUMBER, SINGLE, PAIR, TSTAMP_FORMAT
-from .utils import shift_generator, previous_iterable, candidate_names_iterable, paging
+from .utils import shift_generator, candidate_names_iterable, paging, packet_generator
+from .utils import window_functions_available
+from .profiling import profiled
 
 # ----------------
 # Module constants
 # ----------------
 
 ROWS_PER_COMMIT = 50000
+ROWS_PER_BATCH  = 10000
+CHUNK_SIZE      = 8*1024*1024   # Bytes per parallel parsing task
+READ_BUFFER     = 1024*1024     # Bytes per read from (compressed) input streams
+STDIN           = '-'
+QUOTE           = b'"'          # Lines with quotes are tokenised by csv.reader
+
+# Compressed formats detection
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+COMPRESSION_MAGIC      = ((b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'))
 MIN_TIMESTAMP   = '0001-01-01T:00:00:00Z'
 
+LOAD_COUNTERS_SQL = '''
+    SELECT max_rank, max_tstamp FROM housekeeping_t
+    WHERE name == :name
+'''
+
+SAVE_COUNTERS_SQL = '''
+    INSERT OR REPLACE INTO housekeeping_t(name, max_rank, max_tstamp)
+    VALUES (:name, :max_rank, :max_tstamp)
+'''
+
+MAX_TSTAMPS_SQL = '''
+    SELECT name, max_tstamp FROM housekeeping_t
+'''
+
+RETAINED_SQL = '''
+    SELECT p1.rank, p1.rejected, p1.tstamp, p1.name, p1.sequence_number, p1.frequency, p1.magnitude, p1.ambient_temperature, p1.sky_temperature, p1.signal_strength
+    FROM first_differences_t AS d
+    JOIN raw_readings_t AS r  ON r.name  == d.name  AND r.date_id == d.date_id AND r.time_id == d.time_id
+    JOIN raw_readings_t AS p1 ON p1.name == r.name  AND p1.rank == r.rank - 1
+    JOIN raw_readings_t AS p2 ON p2.name == p1.name AND p2.rank == p1.rank - 1
+    WHERE d.name      == :name
+    AND   d.delta_seq > 1
+    AND   d.delta_T   < :period
+    AND   p1.rejected IS NULL
+    AND   p2.rejected IS NULL
+    AND   p1.sequence_number == p2.sequence_number
+    ORDER BY r.tstamp ASC;
+'''
+
+DATES_SQL = '''
+    SELECT  date_id, count(*)
+    FROM    raw_readings_t
+    WHERE  name == :name
+    GROUP BY date_id
+    ORDER BY date_id ASC
+'''
+
+DAILY_READINGS_SQL = '''
+    SELECT time_id, seconds, sequence_number, rank, tstamp
+    FROM   raw_readings_t
+    WHERE  name = :name
+    AND    date_id = :date_id
+    ORDER BY time_id ASC
+'''
+
+INSERT_DIFFERENCES_SQL = '''
+    INSERT OR IGNORE INTO first_differences_t(name, date_id, time_id, rank, delta_seq, delta_T, period, N, control, tstamp)
+    VALUES(
+        :name,
+        :date_id,
+        :time_id,
+        :rank,
+        :deltaSeq,
+        :deltaT,
+        :period,
+        :N,
+        :ctrl,
+        :tstamp
+    )
+'''
+
+MARK_DUPLICATED_SEQNO_SQL = '''
+    UPDATE raw_readings_t
+    SET    rejected = :reason
+    WHERE  name    == :name
+    AND    date_id == :date_id
+    AND    time_id == :time_id
+    -- AND    sequence_number == :seqno
+'''
+
+MARK_RETAINED_SQL = '''
+    UPDATE raw_readings_t
+    SET    rejected = :reason
+    WHERE  name == :name
+    AND    rank IN (
+        SELECT p1.rank
+        FROM first_differences_t AS d
+        JOIN raw_readings_t AS r  ON r.name  == d.name  AND r.date_id == d.date_id AND r.time_id == d.time_id
+        JOIN raw_readings_t AS p1 ON p1.name == r.name  AND p1.rank == r.rank - 1
+        JOIN raw_readings_t AS p2 ON p2.name == p1.name AND p2.rank == p1.rank - 1
+        WHERE d.name      == :name
+        AND   d.delta_seq > 1
+        AND   d.delta_T   < :period
+        AND   p1.rejected IS NULL
+        AND   p2.rejected IS NULL
+        AND   p1.sequence_number == p2.sequence_number
+    )
+'''
+
+MARK_CORNER_CASES_SQL = '''
+    UPDATE raw_readings_t
+    SET    rejected = :reason
+    WHERE  name            == :name
+    AND    date_id         == :date_id
+'''
+
+INSERT_DUPLICATED_SQL = '''
+    INSERT OR IGNORE INTO duplicated_readings_t(rank, date_id, time_id, name, sequence_number, frequency, magnitude, ambient_temperature, sky_temperature, seconds, signal_strength, tstamp, line_number)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+'''
+
+UPDATE_DUPLICATED_FILE_SQL = '''
+    UPDATE duplicated_readings_t
+    SET    file = :file
+    WHERE  name    == :name
+    AND    date_id == :date_id
+    AND    time_id == :time_id
+'''
+
+INSERT_STAGING_SQL = '''
+    INSERT INTO slurp_staging_t(name, date_id, time_id)
+    VALUES (?,?,?)
+'''
+
+EXISTING_KEYS_SQL = '''
+    SELECT s.name, s.date_id, s.time_id
+    FROM slurp_staging_t AS s
+    JOIN raw_readings_t  AS r
+    WHERE r.name    == s.name
+    AND   r.date_id == s.date_id
+    AND   r.time_id == s.time_id
+'''
+
+CLEAR_STAGING_SQL = '''
+    DELETE FROM slurp_staging_t
+'''
+
+INSERT_READINGS_SQL = '''
+    INSERT INTO raw_readings_t(rank, date_id, time_id, name, sequence_number, frequency, magnitude, ambient_temperature, sky_temperature, seconds, signal_strength, tstamp, line_number)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+'''
+
+ALREADY_INGESTED_SQL = '''
+    SELECT rows
+    FROM ingested_files_t
+    WHERE path  == :path
+    AND   size  == :size
+    AND   mtime == :mtime
+'''
+
+RECORD_INGESTED_SQL = '''
+    INSERT OR REPLACE INTO ingested_files_t(path, size, mtime, rows, tstamp)
+    VALUES (:path, :size, :mtime, :rows, :tstamp)
+'''
+
+GLOBAL_PERIOD_SQL = '''
+    SELECT median_period
+    FROM   global_stats_t
+    WHERE name == :name
+'''
+
+MARK_CORNER_CASES_BY_NAME_SQL = '''
+    UPDATE raw_readings_t
+    SET    rejected = :reason
+    WHERE  name     == :name
+    AND    date_id IN (
+        SELECT date_id
+        FROM   raw_readings_t
+        WHERE  name == :name
+        GROUP BY date_id
+        HAVING COUNT(*) == :N)
+'''
+
+INSERT_DIFFERENCES_WINDOW_SQL = '''
+    INSERT OR IGNORE INTO first_differences_t(name, date_id, time_id, rank, delta_seq, delta_T, period, N, control, tstamp)
+    SELECT name, date_id, time_id, rank, delta_seq, delta_T, CAST(delta_T AS REAL) / delta_seq, N, control, tstamp
+    FROM (
+        SELECT name, date_id, time_id, rank, tstamp,
+            sequence_number - LAG(sequence_number) OVER w AS delta_seq,
+            seconds         - LAG(seconds)         OVER w AS delta_T,
+            rank            - LAG(rank)            OVER w AS control,
+            COUNT(*) OVER (PARTITION BY name, date_id)    AS N
+        FROM  raw_readings_t
+        WHERE name == :name
+        WINDOW w AS (PARTITION BY name, date_id ORDER BY time_id)
+    )
+    WHERE delta_seq != 0
+'''
+
+MARK_DUPLICATED_SEQNO_WINDOW_SQL = '''
+    UPDATE raw_readings_t
+    SET    rejected = :reason
+    WHERE  name     == :name
+    AND    rowid IN (
+        SELECT rid
+        FROM (
+            SELECT rowid AS rid,
+                sequence_number - LAG(sequence_number) OVER (PARTITION BY name, date_id ORDER BY time_id) AS delta_seq
+            FROM  raw_readings_t
+            WHERE name == :name
+        )
+        WHERE delta_seq == 0)
+'''
+
+READINGS_IN_TIME_ORDER_SQL = '''
+    SELECT date_id, time_id, seconds, sequence_number, rank, tstamp
+    FROM   raw_readings_t
+    WHERE  name == :name
+    ORDER BY date_id ASC, time_id ASC
+'''
+
+INSERT_DIFFERENCES_ROWS_SQL = '''
+    INSERT OR IGNORE INTO first_differences_t(name, date_id, time_id, rank, delta_seq, delta_T, period, N, control, tstamp)
+    VALUES(?,?,?,?,?,?,?,?,?,?)
+'''
+
+MARK_DUPLICATED_SEQNO_ROWS_SQL = '''
+    UPDATE raw_readings_t
+    SET    rejected = ?
+    WHERE  name    == ?
+    AND    date_id == ?
+    AND    time_id == ?
+'''
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -50,15 +296,18 @@ MIN_TIMESTAMP   = '0001-01-01T:00:00:00Z'
 # Module classes
 # --------------
 
-class datetime(tdbtool.s4a.datetime):
+class DecompressedStream(io.BufferedReader):
+    '''Buffered decompressor that also closes the compressed file object it reads from'''
 
+    def __init__(self, decompressor, source):
+        super(DecompressedStream, self).__init__(decompressor, READ_BUFFER)
+        self._source = source
 
-    def to_seconds(self):
-        '''
-        Return date and time database identifiers + seconds within the day
-        '''
-        return 3600*self.hour + 60*self.minute + self.second
-
+    def close(self):
+        try:
+            super(DecompressedStream, self).close()
+        finally:
+            self._source.close()
 
 
 class Counter(object):
@@ -89,6 +338,10 @@ class Counter(object):
     def persisted(self):
         return self._already_persisted 
 
+    def persist(self):
+        '''Behave from now on as if loaded from housekeeping_t, like a new run would'''
+        self._already_persisted = self._max_tstamp != MIN_TIMESTAMP
+
 
 
 class CounterFactory(object):
@@ -103,11 +356,7 @@ class CounterFactory(object):
         cursor = self._connection.cursor()
         row = {'name': name}
         try:
-            cursor.execute(
-                '''
-                SELECT max_rank, max_tstamp FROM housekeeping_t
-                WHERE name == :name
-                ''', row)
+            cursor.execute(LOAD_COUNTERS_SQL, row)
         except Exception as e:
             logging.info("[{0}] table does not exist".format(__name__))
             row['max_rank']   = 0
@@ -133,11 +382,8 @@ class CounterFactory(object):
                     'max_rank': self._pool[key].current()-1,
                     'max_tstamp' : self._pool[key].max_tstamp(),
                 }
-                cursor.execute(
-                    '''
-                    INSERT OR REPLACE INTO housekeeping_t(name, max_rank, max_tstamp) 
-                    VALUES (:name, :max_rank, :max_tstamp)
-                    ''', row)
+                cursor.execute(SAVE_COUNTERS_SQL, row)
+                self._pool[key].persist()
                 logging.info("[{0}] Saving counters {1}".format(__name__, row))
             except Exception as e:
                 logging.error("[{0}] Error saving counters".format(__name__))
@@ -145,6 +391,16 @@ class CounterFactory(object):
         
 
 
+    def maxTstamps(self):
+        '''Maximum timestamp per TESS-W, either from the counters in use or persisted in housekeeping_t'''
+        cursor = self._connection.cursor()
+        cursor.execute(MAX_TSTAMPS_SQL)
+        result = dict(cursor.fetchall())
+        for name, counter in self._pool.items():
+            result[name] = counter.max_tstamp()
+        return result
+
+
     def build(self, name):
         if name not in self._pool.keys():
             max_rank, max_tstamp, persisted = self.loadMax(name)
@@ -156,84 +412,330 @@ class CounterFactory(object):
 # Module global functions
 # -----------------------
 
-def csv_generator(filepath, factory, name):
-    '''An iterator that reads csv line by line and keeps memory usage down'''
-    with open(filepath, "r") as csvfile:
-        datareader = csv.reader(csvfile,delimiter=';')
-        dummy = next(datareader)  # drops the header row
-        line_number = 2
-        for srcrow in datareader:
-            if name is not None and name != srcrow[1]:
+def parse_srcrow(srcrow):
+    '''Converts a CSV row into a raw_readings_t row. Rank and line number are filled in later'''
+    row = []
+    date_id, time_id, seconds = tdbtool.s4a.ids_from_iso8601(srcrow[0], TSTAMP_FORMAT)
+    row.append(None)               # rank = 0
+    row.append(date_id)            # date_id = 1
+    row.append(time_id)            # time_id = 2
+    row.append(srcrow[1])          # name = 3
+    row.append(int(srcrow[2]))     # sequence number = 4
+    row.append(float(srcrow[3]))   # frequency = 5
+    row.append(float(srcrow[4]))   # magnitude = 6
+    row.append(float(srcrow[5]))   # tamb = 7
+    row.append(float(srcrow[6]))   # tsky = 8
+    row.append(seconds)            # number of seconds within the day = 9
+    try:
+        val = int(srcrow[7])
+    except Exception as e:
+        val = None
+    row.append(val)                # RSS  = 10
+    row.append(srcrow[0])          # ISO8601 timestamp = 11
+    row.append(None)               # original file line number  = 12
+    return row
+
+
+def detect_compression(filepath, stream):
+    '''Returns the compression format by file extension or else by magic bytes, None if plain'''
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in COMPRESSION_EXTENSIONS:
+        return COMPRESSION_EXTENSIONS[extension]
+    header = stream.peek(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def open_csv(filepath, offset=0):
+    '''
+    Opens a CSV file as a binary stream with large read buffers.
+    gzip, bz2 and xz files are decompressed on the fly. '-' reads from standard input.
+    A non zero offset positions a plain file at that byte offset.
+    '''
+    if filepath == STDIN:
+        stream = io.open(sys.stdin.fileno(), "rb", buffering=READ_BUFFER, closefd=False)
+    else:
+        stream = io.open(filepath, "rb", buffering=READ_BUFFER)
+    compression = detect_compression(filepath, stream)
+    if offset:
+        stream.seek(offset)
+    if compression is not None:
+        logging.info("[{0}] Decompressing {1} input from {2}".format(__name__, compression, filepath))
+    # Decompressors do not close a file object they were given
+    if compression == 'gzip':
+        stream = DecompressedStream(gzip.GzipFile(fileobj=stream, mode="rb"), stream)
+    elif compression == 'bz2':
+        stream = DecompressedStream(bz2.BZ2File(stream, mode="rb"), stream)
+    elif compression == 'xz':
+        if lzma is None:
+            stream.close()
+            raise IOError("xz compressed input is not supported by this Python version")
+        stream = DecompressedStream(lzma.LZMAFile(stream, mode="rb"), stream)
+    return stream
+
+
+def is_plain_file(filepath):
+    '''True if filepath is a regular, uncompressed file that can be split in byte ranges'''
+    if filepath == STDIN or not os.path.isfile(filepath):
+        return False
+    with io.open(filepath, "rb") as stream:
+        return detect_compression(filepath, stream) is None
+
+
+def encode_filters(names, max_tstamps):
+    '''Filter arguments to compare raw fields as bytes'''
+    if names is not None:
+        names = set(name.encode('utf-8') for name in names)
+    if max_tstamps is not None:
+        max_tstamps = dict((name.encode('utf-8'), tstamp.encode('utf-8')) for name, tstamp in max_tstamps.items())
+    return names, max_tstamps
+
+
+def wanted(fields, names, max_tstamps):
+    '''Name and timestamp filters over the first two fields of a line'''
+    if len(fields) < 2:
+        return False    # blank line
+    if names is not None and fields[1] not in names:
+        return False
+    if max_tstamps is not None and fields[0] < max_tstamps.get(fields[1], fields[0]):
+        return False
+    return True
+
+
+def block_lines(stream, size=READ_BUFFER):
+    '''Lines of a binary stream from its current position, split on b'\\n' a whole block at a time'''
+    tail = b''
+    while True:
+        block = stream.read(size)
+        if not block:
+            break
+        lines = (tail + block).split(b'\n')
+        tail  = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
+
+
+def split_lines(lines, names, max_tstamps, first_line=2):
+    '''
+    Tokenises raw CSV lines (bytes), dropping those rejected by the filters first.
+    Yields (file line number, row) pairs, lines being numbered from first_line.
+    Lines are split on ';' and only the timestamp and name fields are decoded,
+    numeric fields are converted from bytes (int() and float() ignore the trailing
+    end of line). Filters compare the raw name and timestamp fields, so a rejected
+    line costs a single partial split. Lines with quotes go through csv.reader
+    instead, with the default dialect and ';' as delimiter.
+    '''
+    bnames, btstamps = encode_filters(names, max_tstamps)
+    filtered = names is not None or max_tstamps is not None
+    for line_number, line in enumerate(lines, first_line):
+        if QUOTE in line:
+            srcrow = next(csv.reader([line.decode('utf-8')], delimiter=';'), [])
+            if wanted(srcrow, names, max_tstamps):
+                yield line_number, srcrow
+            continue
+        if filtered:
+            # Inlined wanted(), this runs for every line in the file
+            fields = line.split(b';', 2)
+            if len(fields) < 2:
                 continue
-            row = []
-            dt = datetime.from_iso8601(srcrow[0], TSTAMP_FORMAT)
-            #dateid, timeid, seconds = datetime.from_iso8601(srcrow[0],TSTAMP_FORMAT).to_dbase_ids()
-            date_id, time_id = dt.to_dbase_ids()   
-            counter = factory.build(srcrow[1])
-            row.append(counter.current())  # rank = 0
-            row.append(date_id)            # date_id = 1
-            row.append(time_id)            # time_id = 2
-            row.append(srcrow[1])          # name = 3
-            row.append(int(srcrow[2]))     # sequence number = 4
-            row.append(float(srcrow[3]))   # frequency = 5
-            row.append(float(srcrow[4]))   # magnitude = 6
-            row.append(float(srcrow[5]))   # tamb = 7
-            row.append(float(srcrow[6]))   # tsky = 8
-            row.append(dt.to_seconds())    # number of seconds within the day = 9
-            try:
-                val = int(srcrow[7])
-            except Exception as e:
-                val = None
-            row.append(val)                # RSS  = 10
-            row.append(srcrow[0])          # ISO8601 timestamp = 11
-            row.append(line_number)        # original file line number  = 12
-            line_number += 1
+            if bnames is not None and fields[1] not in bnames:
+                continue
+            if btstamps is not None and fields[0] < btstamps.get(fields[1], fields[0]):
+                continue
+        srcrow = line.split(b';')
+        if len(srcrow) < 2:
+            continue    # blank line
+        srcrow[0] = srcrow[0].decode('utf-8')
+        srcrow[1] = srcrow[1].decode('utf-8')
+        yield line_number, srcrow
+
+
+def parse_lines(lines, names, max_tstamps, first_line=2):
+    '''raw_readings_t rows from raw CSV lines, keeping their file line number'''
+    for line_number, srcrow in split_lines(lines, names, max_tstamps, first_line):
+        row = parse_srcrow(srcrow)
+        row[12] = line_number           # original file line number  = 12
+        yield row
+
+
+def first_line_number(filepath, offset):
+    '''File line number of the line starting at offset, counting the header row as line 1'''
+    if not offset:
+        return 2
+    count = 0
+    with io.open(filepath, "rb") as f:
+        while offset > 0:
+            block = f.read(min(offset, READ_BUFFER))
+            if not block:
+                break
+            count  += block.count(b'\n')
+            offset -= len(block)
+    return count + 1
+
+
+def bisect_offset(filepath, tstamp):
+    '''Byte offset of the first line not older than tstamp in a time sorted plain CSV file'''
+    btstamp = tstamp.encode('utf-8')
+    with io.open(filepath, "rb") as f:
+        f.readline()  # drops the header row
+        first = f.tell()
+        lo, hi = first, os.fstat(f.fileno()).st_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid > first:
+                f.seek(mid - 1)
+                f.readline()    # moves to the first line starting at or after mid
+            else:
+                f.seek(mid)
+            start = f.tell()
+            line  = f.readline()
+            if not line or line.split(b';', 1)[0] >= btstamp:
+                hi = mid
+            else:
+                lo = start + 1
+        if lo > first:
+            f.seek(lo - 1)
+            f.readline()
+        else:
+            f.seek(lo)
+        return f.tell()
+
+
+def rows_iterable(filepath, names, max_tstamps=None, offset=0):
+    '''Parses the whole CSV file in this process, tokenised by split_lines()'''
+    with open_csv(filepath, offset) as stream:
+        if not offset:
+            stream.readline()  # drops the header row
+        lines = itertools.chain.from_iterable(block_lines(stream))
+        for row in parse_lines(lines, names, max_tstamps, first_line_number(filepath, offset)):
             yield row
 
 
+def mmap_rows_iterable(filepath, names, max_tstamps=None, offset=0):
+    '''
+    Parses the whole CSV file in this process through a memory map.
+    Lines are split a block at a time straight over the mapped buffer
+    and tokenised by split_lines().
+    '''
+    with io.open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if offset:
+                buf.seek(offset)
+            else:
+                buf.readline()  # drops the header row
+            lines = itertools.chain.from_iterable(block_lines(buf))
+            for row in parse_lines(lines, names, max_tstamps, first_line_number(filepath, offset)):
+                yield row
+        finally:
+            buf.close()
+
+
+def byte_ranges(filepath, names, max_tstamps=None, offset=0, chunk_size=CHUNK_SIZE):
+    '''Splits a file from offset onwards in (filepath, start, end, names, max_tstamps) parsing tasks'''
+    size = os.path.getsize(filepath)
+    return [(filepath, start, min(start + chunk_size, size), names, max_tstamps) for start in range(offset, size, chunk_size)]
+
+
+def parse_byte_range(task):
+    '''
+    Parses the CSV lines starting within the [start, end) byte range.
+    Runs in a worker process. Returns the number of lines in the range
+    and their rows, numbered from 0 within the range.
+    '''
+    filepath, start, end, names, max_tstamps = task
+    with open(filepath, "rb") as f:
+        if start == 0:
+            f.readline()    # drops the header row
+        else:
+            f.seek(start - 1)
+            f.readline()    # skips the line owned by the previous range
+        if f.tell() >= end:
+            return 0, []
+        data = f.read(end - f.tell())
+        if not data.endswith(b'\n'):
+            data += f.readline()    # completes the last line we own
+    # Split before decoding: str.splitlines() would also break lines at \x0b, \x1c-\x1e, \x85 or \u2028
+    lines = data.split(b'\n')
+    if data.endswith(b'\n'):
+        lines.pop()
+    return len(lines), list(parse_lines(lines, names, max_tstamps, 0))
+
+
+def parallel_rows_iterable(filepath, names, workers, max_tstamps=None, offset=0):
+    '''Parses the CSV file in a pool of worker processes, yielding rows in file order'''
+    logging.info("[{0}] Parsing {1} with {2} workers".format(__name__, filepath, workers))
+    tasks   = collections.deque(byte_ranges(filepath, names, max_tstamps, offset))
+    pending = collections.deque()
+    line_number = first_line_number(filepath, offset)
+    pool = multiprocessing.Pool(workers)
+    try:
+        while tasks or pending:
+            # Keep a bounded number of parsed chunks in flight
+            while tasks and len(pending) < 2*workers:
+                pending.append(pool.apply_async(parse_byte_range, (tasks.popleft(),)))
+            count, rows = pending.popleft().get()
+            for row in rows:
+                row[12] += line_number
+                yield row
+            line_number += count
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def csv_generator(filepath, factory, names, workers=1, use_mmap=False, max_tstamps=None, offset=0):
+    '''
+    An iterator that reads csv line by line and keeps memory usage down.
+    names is an optional set of TESS-W names to filter.
+    max_tstamps optionally maps TESS-W names to the timestamp below which lines are dropped.
+    offset is an optional byte offset to start reading plain files from.
+    '''
+    if (workers > 1 or use_mmap) and not is_plain_file(filepath):
+        logging.warning("[{0}] {1} is not a plain file, parsing it as a single stream".format(__name__, filepath))
+        workers  = 1
+        use_mmap = False
+    if workers > 1:
+        iterable = parallel_rows_iterable(filepath, names, workers, max_tstamps, offset)
+    elif use_mmap:
+        iterable = mmap_rows_iterable(filepath, names, max_tstamps, offset)
+    else:
+        iterable = rows_iterable(filepath, names, max_tstamps, offset)
+    for row in iterable:
+        counter = factory.build(row[3])
+        row[0]  = counter.current()     # rank = 0
+        yield row
+
+
 def retained_iterable(connection, name, period):
+    '''
+    Readings retained by the photometer and sent again.
+    A reading r with a sequence number jump and a too short time difference
+    hints that the reading just before it (p1) is an isolated retained value.
+    p1 is confirmed if it repeats the sequence number of the reading before (p2).
+    '''
     row = {'name': name, 'period': period }
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT r.rank, r.rejected, r.tstamp, r.name, r.sequence_number, r.frequency, r.magnitude, r.ambient_temperature, r.sky_temperature, r.signal_strength
-        FROM raw_readings_t AS r
-        JOIN first_differences_t AS d
-        WHERE r.name    == d.name
-        AND   r.date_id == d.date_id
-        AND   r.time_id == d.time_id
-        AND   d.delta_seq > 1
-        AND   d.delta_T < :period
-        AND   r.name == :name
-        ORDER BY r.name ASC, r.tstamp ASC;
-        ''', row)
+    cursor.execute(RETAINED_SQL, row)
     return cursor
 
 
 def dates_iterable(connection, name):
     cursor = connection.cursor()
     row = {'name': name}
-    cursor.execute(
-         '''
-        SELECT  date_id, count(*)
-        FROM    raw_readings_t
-        WHERE  name == :name
-        GROUP BY date_id
-        ORDER BY date_id ASC
-        ''', row)
+    cursor.execute(DATES_SQL, row)
     return cursor   # return Cursor as an iterable
 
 
 def daily_iterable(connection, name, date_id):
     row = {'name': name, 'date_id': date_id}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT time_id, seconds, sequence_number, rank, tstamp
-        FROM   raw_readings_t
-        WHERE  name = :name
-        AND    date_id = :date_id
-        ''', row)
+    cursor.execute(DAILY_READINGS_SQL, row)
     return cursor   # return Cursor as an iterable
 
 
@@ -261,22 +763,7 @@ def compute_daily_differences(name, date_id, prev, cur, N):
 def write_daily_differences(connection, iterable):
     logging.debug("[{0}] Wriiting differences for {1} rows".format(__name__, len(iterable)))
     cursor = connection.cursor()
-    cursor.executemany(
-        '''
-        INSERT OR IGNORE INTO first_differences_t(name, date_id, time_id, rank, delta_seq, delta_T, period, N, control, tstamp)
-        VALUES(
-            :name,
-            :date_id,
-            :time_id,
-            :rank,
-            :deltaSeq,
-            :deltaT,
-            :period,
-            :N,
-            :ctrl,
-            :tstamp
-        )
-         ''', iterable)
+    cursor.executemany(INSERT_DIFFERENCES_SQL, iterable)
     connection.commit()
 
 
@@ -284,29 +771,16 @@ def mark_duplicated_seqno(connection, row):
     '''Marks the most recent rows with duplicated sequence number'''
     row['reason'] = DUP_SEQ_NUMBER
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        UPDATE raw_readings_t
-        SET    rejected = :reason
-        WHERE  name    == :name
-        AND    date_id == :date_id
-        AND    time_id == :time_id
-        -- AND    sequence_number == :seqno
-         ''', row)
+    cursor.execute(MARK_DUPLICATED_SEQNO_SQL, row)
     # Let the global commit do it
 
 
-def mark_duplicated_seqno2(connection, srcrow):
-    '''Marks a row with duplicated sequence number'''
-    row = {'name': srcrow[3], 'rank': srcrow[0], 'reason': DUP_SEQ_NUMBER}
+def mark_retained(connection, name, period):
+    '''Marks all confirmed retained readings with duplicated sequence number in one go'''
+    row = {'name': name, 'period': period, 'reason': DUP_SEQ_NUMBER}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        UPDATE raw_readings_t
-        SET    rejected = :reason
-        WHERE  name == :name
-        AND    rank == :rank
-         ''', row)
+    cursor.execute(MARK_RETAINED_SQL, row)
+    return cursor.rowcount
     # Let the global commit do it
 
 
@@ -320,48 +794,157 @@ def mark_corner_cases(connection, name, date_id, N):
     else:
         row['reason'] = PAIR
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        UPDATE raw_readings_t
-        SET    rejected = :reason
-        WHERE  name            == :name
-        AND    date_id         == :date_id
-         ''', row)
+    cursor.execute(MARK_CORNER_CASES_SQL, row)
     # Let the global commit do it
 
 
-def mark_duplicated_tstamp(connection, row, file_name):
+def mark_duplicated_tstamps(connection, iterable, file_name):
     '''Marks both rows with duplicated sequence num bers'''
     cursor = connection.cursor()
+    cursor.executemany(INSERT_DUPLICATED_SQL, iterable)
+    rows2 = [{ 'name': row[3], 'date_id': row[1], 'time_id': row[2], 'file': file_name} for row in iterable]
+    cursor.executemany(UPDATE_DUPLICATED_FILE_SQL, rows2)
+    # Let the global commit do it
+
+
+def create_staging_table(connection):
+    '''Temporary table holding the primary keys of the batch being ingested'''
+    cursor = connection.cursor()
     cursor.execute(
         '''
-        INSERT OR IGNORE INTO duplicated_readings_t(rank, date_id, time_id, name, sequence_number, frequency, magnitude, ambient_temperature, sky_temperature, seconds, signal_strength, tstamp, line_number) 
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        ''', row)
-    row2 = { 'name': row[3], 'date_id': row[1], 'time_id': row[2], 'file': file_name}
-    cursor.execute(
-        '''
-        UPDATE duplicated_readings_t
-        SET    file = :file
-        WHERE  name    == :name
-        AND    date_id == :date_id
-        AND    time_id == :time_id
-        ''', row2)
+        CREATE TEMP TABLE IF NOT EXISTS slurp_staging_t
+        (
+            name                TEXT    NOT NULL,
+            date_id             INTEGER NOT NULL,
+            time_id             INTEGER NOT NULL
+        )
+        ''')
+
+
+def existing_keys(connection, rows):
+    '''Returns the set of (name, date_id, time_id) keys in rows already present in raw_readings_t'''
+    cursor = connection.cursor()
+    cursor.executemany(INSERT_STAGING_SQL, ((row[3], row[1], row[2]) for row in rows))
+    cursor.execute(EXISTING_KEYS_SQL)
+    result = set(cursor.fetchall())
+    cursor.execute(CLEAR_STAGING_SQL)
+    return result
+
+
+def slurp_batch(connection, factory, rows, file_name, duplicates):
+    '''
+    Ingests a batch of CSV rows.
+    Conflicts against raw_readings_t are resolved in bulk beforehand, so that the per row
+    rank and duplicates bookkeeping is the same as inserting rows one by one.
+    '''
+    existing = existing_keys(connection, rows)
+    seen     = set()
+    accepted = []
+    dup_rows = []
+    for row in rows:
+        counter = factory.build(row[3])
+        if row[11] < counter.max_tstamp():
+            # Skip old data
+            continue
+        row[0] = counter.current()
+        key = (row[3], row[1], row[2])
+        if key in existing or key in seen:
+            if row[11] == counter.max_tstamp() and not counter.persisted():
+                dup_rows.append(row)
+                duplicates[row[3]] = duplicates.get(row[3],0) + 1
+            logging.debug("[{0}] Duplicated row on {2}, keeping counter for {1}".format(__name__, row[3], row[11]))
+        else:
+            seen.add(key)
+            counter.next()
+            counter.update_tstamp(row[11])
+            accepted.append(row)
+    cursor = connection.cursor()
+    cursor.executemany(INSERT_READINGS_SQL, accepted)
+    if len(dup_rows):
+        mark_duplicated_tstamps(connection, dup_rows, file_name)
     # Let the global commit do it
+    return len(accepted)
+
+
+def csv_files(options):
+    '''Expands --csv-file names or glob patterns and --csv-dir into a list of files to ingest'''
+    if options.csv_dir is not None:
+        paths = [os.path.join(options.csv_dir, f) for f in sorted(os.listdir(options.csv_dir))]
+        return [path for path in paths if os.path.isfile(path)]
+    files = []
+    for pattern in options.csv_file:
+        if pattern == STDIN:
+            files.append(pattern)
+            continue
+        paths = sorted(glob.glob(pattern))
+        if not len(paths):
+            raise IOError("No CSV file found at {0}".format(pattern))
+        files.extend(paths)
+    return files
+
+
+def file_signature(filepath):
+    stat = os.stat(filepath)
+    return {'path': os.path.abspath(filepath), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def already_ingested(connection, signature):
+    cursor = connection.cursor()
+    cursor.execute(ALREADY_INGESTED_SQL, signature)
+    return cursor.fetchone() is not None
+
+
+def record_ingested(connection, signature, rows):
+    row = dict(signature)
+    row['rows']   = rows
+    row['tstamp'] = Datetime.datetime.utcnow().strftime(TSTAMP_FORMAT)
+    cursor = connection.cursor()
+    cursor.execute(RECORD_INGESTED_SQL, row)
+    # Let the per file commit do it
+
+
+def name_set(name):
+    '''--name is a single name in pipelines and may be repeated in input slurp'''
+    if name is None:
+        return None
+    if isinstance(name, list):
+        return set(name)
+    return set([name])
+
+
+def input_slurp_file(connection, factory, filepath, options):
+    logging.info("[{0}] Starting ingestion from {1}".format(__name__, filepath))
+    duplicates = {}
+    count = 0
+    names = name_set(options.name)
+    max_tstamps = None
+    offset = 0
+    if options.incremental:
+        max_tstamps = factory.maxTstamps()
+        # Seeking is only safe when all wanted TESS-W are known
+        if options.sorted and names is not None and is_plain_file(filepath):
+            tstamp = min(max_tstamps.get(name, MIN_TIMESTAMP) for name in names)
+            if tstamp != MIN_TIMESTAMP:
+                offset = bisect_offset(filepath, tstamp)
+                logging.info("[{0}] Skipping {1} bytes older than {2} in {3}".format(__name__, offset, tstamp, filepath))
+    iterable = csv_generator(filepath, factory, names, options.workers, options.mmap, max_tstamps, offset)
+    for rows in packet_generator(iterable, ROWS_PER_BATCH):
+        count += slurp_batch(connection, factory, rows, filepath, duplicates)
+    logging.info("[{0}] Ended ingestion from {1} ({2} rows)".format(__name__, filepath, count))
+    logging.info("[{0}] Saving housekeeping data".format(__name__))
+    factory.saveMax()
+    logging.info("[{0}] Duplicates summary: {1}".format(__name__, duplicates))
+    return count
 
 
 def global_period_iterable(connection, name):
     cursor = connection.cursor()
     row = {'name': name}
-    cursor.execute(
-        '''
-        SELECT median_period
-        FROM   global_stats_t
-        WHERE name == :name
-        ''', row)
+    cursor.execute(GLOBAL_PERIOD_SQL, row)
     return cursor
 
 
+@profiled
 def input_differences_by_name(connection, name):
     logging.info("[{0}] Computing differences for {1}".format(__name__, name))
     rows = []
@@ -374,13 +957,12 @@ def input_differences_by_name(connection, name):
             if not all(points):
                 continue
             prev, cur = points
-            if len(rows) < ROWS_PER_COMMIT:
-                row = compute_daily_differences(name, date_id, prev, cur, N)
-                if 'period' in row:
-                    rows.append(row)
-                else:
-                    mark_duplicated_seqno(connection, row)
+            row = compute_daily_differences(name, date_id, prev, cur, N)
+            if 'period' in row:
+                rows.append(row)
             else:
+                mark_duplicated_seqno(connection, row)
+            if len(rows) == ROWS_PER_COMMIT:
                 write_daily_differences(connection, rows)
                 rows = []
     # Write trailing rows
@@ -389,79 +971,149 @@ def input_differences_by_name(connection, name):
     logging.info("[{0}] Done for {1}".format(__name__, name))
 
 
-def input_retained_by_name(connection, name):
+def mark_corner_cases_by_name(connection, name):
+    '''Marks daily readings for a given TESS-W on all days where N is 1 or 2'''
+    cursor = connection.cursor()
+    for N, reason in ((1, SINGLE), (2, PAIR)):
+        row = {'name': name, 'N': N, 'reason': reason}
+        cursor.execute(MARK_CORNER_CASES_BY_NAME_SQL, row)
+    # Let the global commit do it
+
+
+@profiled
+def input_differences_by_name_sql(connection, name):
+    '''Set based version of input_differences_by_name(), using window functions'''
+    logging.info("[{0}] Computing differences for {1}".format(__name__, name))
+    mark_corner_cases_by_name(connection, name)
+    row = {'name': name, 'reason': DUP_SEQ_NUMBER}
+    cursor = connection.cursor()
+    cursor.execute(INSERT_DIFFERENCES_WINDOW_SQL, row)
+    cursor.execute(MARK_DUPLICATED_SEQNO_WINDOW_SQL, row)
+    connection.commit()
+    logging.info("[{0}] Done for {1}".format(__name__, name))
+
+
+@profiled
+def input_differences_by_name_numpy(connection, name):
+    '''Vectorized version of input_differences_by_name(), using NumPy arrays in time order'''
+    logging.info("[{0}] Computing differences for {1}".format(__name__, name))
+    mark_corner_cases_by_name(connection, name)
+    row = {'name': name}
+    cursor = connection.cursor()
+    cursor.execute(READINGS_IN_TIME_ORDER_SQL, row)
+    rows = cursor.fetchall()
+    if len(rows) > 1:
+        columns  = list(zip(*rows))
+        date_id  = np.array(columns[0], dtype=np.int64)
+        time_id  = np.array(columns[1], dtype=np.int64)
+        seconds  = np.array(columns[2], dtype=np.int64)
+        seqno    = np.array(columns[3], dtype=np.int64)
+        rank     = np.array(columns[4], dtype=np.int64)
+        tstamp   = columns[5]
+        # Differences are computed between consecutive readings of the same day
+        same_day  = date_id[1:] == date_id[:-1]
+        delta_T   = seconds[1:] - seconds[:-1]
+        delta_seq = seqno[1:]   - seqno[:-1]
+        control   = rank[1:]    - rank[:-1]
+        # Readings are sorted by day, so per day counts can be repeated per reading
+        days, counts = np.unique(date_id, return_counts=True)
+        N = np.repeat(counts, counts)
+        good = same_day & (delta_seq != 0)
+        dups = same_day & (delta_seq == 0)
+        cur  = np.nonzero(good)[0] + 1  # index of the final point of each difference
+        period = delta_T[good] / delta_seq[good]
+        cursor.executemany(INSERT_DIFFERENCES_ROWS_SQL, zip(
+                [name]*len(cur),
+                date_id[cur].tolist(),
+                time_id[cur].tolist(),
+                rank[cur].tolist(),
+                delta_seq[good].tolist(),
+                delta_T[good].tolist(),
+                period.tolist(),
+                N[cur].tolist(),
+                control[good].tolist(),
+                [tstamp[i] for i in cur.tolist()]))
+        cur = np.nonzero(dups)[0] + 1
+        cursor.executemany(MARK_DUPLICATED_SEQNO_ROWS_SQL, zip([DUP_SEQ_NUMBER]*len(cur), [name]*len(cur), date_id[cur].tolist(), time_id[cur].tolist()))
+    connection.commit()
+    logging.info("[{0}] Done for {1}".format(__name__, name))
+
+
+def differences_engine(engine):
+    '''Returns the per TESS-W differences function for the requested engine'''
+    if engine == 'auto':
+        if window_functions_available():
+            engine = 'sql'
+        elif np is not None:
+            engine = 'numpy'
+        else:
+            engine = 'python'
+    elif engine == 'sql' and not window_functions_available():
+        logging.warning("[{0}] SQLite {1} lacks window functions, using the python engine".format(__name__, sqlite3.sqlite_version))
+        engine = 'python'
+    elif engine == 'numpy' and np is None:
+        logging.warning("[{0}] NumPy is not installed, using the python engine".format(__name__))
+        engine = 'python'
+    logging.info("[{0}] Using the {1} differences engine".format(__name__, engine))
+    return DIFFERENCES_ENGINES[engine]
+
+
+@profiled
+def input_retained_by_name(connection, name, test=False, limit=10):
     logging.info("[{0}] Detecting isolated retained readings for {1}".format(__name__, name))
-    for period in global_period_iterable(connection, name):
-        iterable1 = retained_iterable(connection, name, period[0])
-        iterable1 = previous_iterable(connection, iterable1)    # The candidate retained values are here
-        iterable2 = previous_iterable(connection, iterable1)    # we need this to confirm
-        merged = zip(iterable1, iterable2)
-        candidates = zip(iterable1, iterable2)
-        # Verified vcandidatos have the same sequence numbers
-        candidates = [ p[0] for p in candidates if p[0][4] == p[1][4] ]
-        logging.info("[{0}] Found {1} isolated candidates for {2}".format(__name__, len(candidates), name))
-        logging.debug("[{0}] candidates = {1}".format(__name__, candidates, name))
-        for row in candidates:
-            mark_duplicated_seqno2(connection, row)
+    for period in global_period_iterable(connection, name).fetchall():
+        if test:
+            iterable = retained_iterable(connection, name, period[0])
+            paging(iterable,["Rank", "Rejected", "Timestamp", "Name", "Seq. Number", "Frequency", "Magnitude", "Ambient Temp.", "Sky Temp.", "Signal Strength"], limit)
+        else:
+            count = mark_retained(connection, name, period[0])
+            logging.info("[{0}] Marked {1} isolated retained readings for {2}".format(__name__, count, name))
     connection.commit()
     logging.info("[{0}] Done for {1}".format(__name__, name))
 
 
+DIFFERENCES_ENGINES = {
+    'python': input_differences_by_name,
+    'sql'   : input_differences_by_name_sql,
+    'numpy' : input_differences_by_name_numpy,
+}
+
 # ==============
 # MAIN FUNCTIONS
 # ==============
 
 
 def input_slurp(connection, options):
-    logging.info("[{0}] Starting ingestion from {1}".format(__name__, options.csv_file))
-    duplicates = {}
-    cursor = connection.cursor()
     factory = CounterFactory(connection)
-    for row in csv_generator(options.csv_file, factory, options.name):
-        counter = factory.build(row[3])
-        if row[11] < counter.max_tstamp():
-            # Skip old data
-            continue
-        else:
-            counter.next()
-            try:
-                cursor.execute(
-                    '''
-                    INSERT INTO raw_readings_t(rank, date_id, time_id, name, sequence_number, frequency, magnitude, ambient_temperature, sky_temperature, seconds, signal_strength, tstamp, line_number) 
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-                    ''', row)
-            except sqlite3.IntegrityError as e:
-                if row[11] == counter.max_tstamp() and not counter.persisted():
-                    mark_duplicated_tstamp(connection, row, options.csv_file)
-                    duplicates[row[3]] = duplicates.get(row[3],0) + 1
-                oldv = counter.prev()
-                logging.debug("[{0}] Duplicated row on {3}, restoring counter for {1} to {2}".format(__name__, row[3], oldv, row[11]))
-            else:
-                counter.update_tstamp(row[11])
-    logging.info("[{0}] Ended ingestion from {1}".format(__name__, options.csv_file))
-    logging.info("[{0}] Saving housekeeping data".format(__name__))
-    factory.saveMax()
-    connection.commit()
-    logging.info("[{0}] Duplicates summary: {1}".format(__name__, duplicates))
+    create_staging_table(connection)
+    for filepath in csv_files(options):
+        # Files ingested with a --name filter are not recorded in the manifest
+        signature = None
+        if filepath != STDIN and options.name is None:
+            signature = file_signature(filepath)
+            if already_ingested(connection, signature):
+                logging.info("[{0}] Skipping already ingested {1}".format(__name__, filepath))
+                continue
+        count = input_slurp_file(connection, factory, filepath, options)
+        if signature is not None:
+            record_ingested(connection, signature, count)
+        connection.commit()
 
                 
 def input_differences(connection, options):
+    differences_by_name = differences_engine(options.engine)
     if options.name is not None:
-        input_differences_by_name(connection, options.name)
+        differences_by_name(connection, options.name)
     else:
         for name in candidate_names_iterable(connection):
-            input_differences_by_name(connection, name[0])
-
-
-def input_retained(connection, options):
-    input_retained_auto(connection, options)
+            differences_by_name(connection, name[0])
 
 
 def input_retained(connection, options):
     if options.name is not None:
-        input_retained_by_name(connection, options.name)
+        input_retained_by_name(connection, options.name, options.test, options.limit)
     else:
-        for name in candidate_names_iterable(connection):
-            input_retained_by_name(connection, name[0])
+        for name in candidate_names_iterable(connection).fetchall():
+            input_retained_by_name(connection, name[0], options.test, options.limit)
 
     
@@ -29,8 +29,10 @@ import collections
 import tdbtool.s4a
 from .      import __version__
 from .      import BEFORE
-from .utils import open_database, open_reference_database, mark_bad_rows
-from .utils import candidate_names_iterable, shift_generator
+from .utils import open_database, reference_uri, mark_bad_rows, URI_FILENAMES
+from .utils import shift_generator, update_from_available
+from .profiling import profiled
+from .parallel  import run_by_name
 
 # ----------------
 # Module constants
@@ -38,6 +40,83 @@ from .utils import candidate_names_iterable, shift_generator
 
 ROWS_PER_COMMIT = 50000
 
+GOOD_READINGS_SQL = '''
+    SELECT date_id, time_id
+    FROM  raw_readings_t
+    WHERE rejected IS NULL
+    AND name == :name
+    ORDER BY date_id ASC, time_id ASC
+'''
+
+MAC_INTERVALS_SQL = '''
+    SELECT mac_address, datetime(valid_since), datetime(valid_until)
+    FROM name_to_mac_t
+    WHERE name == :name
+    ORDER BY rowid
+'''
+
+TESS_INTERVALS_SQL = '''
+    SELECT tess_id, datetime(valid_since), datetime(valid_until)
+    FROM tess_t
+    WHERE mac_address == :mac
+    ORDER BY rowid
+'''
+
+UPDATE_TESS_ID_SQL = '''
+    UPDATE raw_readings_t
+    SET tess_id =  :tess_id
+    WHERE name  == :name
+    AND date_id == :date_id
+    AND time_id == :time_id
+'''
+
+# Temporary tables for the sql engine, created AS SELECT these
+MAC_INTERVAL_TABLE_SQL = '''
+    SELECT rowid AS seq, name, mac_address,
+           CAST(strftime('%Y%m%d%H%M%S', valid_since) AS INTEGER) AS since,
+           CAST(strftime('%Y%m%d%H%M%S', valid_until) AS INTEGER) AS until
+    FROM ref.name_to_mac_t
+'''
+
+TESS_INTERVAL_TABLE_SQL = '''
+    SELECT rowid AS seq, tess_id, mac_address,
+           CAST(strftime('%Y%m%d%H%M%S', valid_since) AS INTEGER) AS since,
+           CAST(strftime('%Y%m%d%H%M%S', valid_until) AS INTEGER) AS until
+    FROM ref.tess_t
+'''
+
+# MIN(m.seq) makes the bare m.mac_address column come from the first matching interval
+READING_MAC_TABLE_SQL = '''
+    SELECT r.rowid AS rid, r.date_id * 1000000 + r.time_id AS key, m.mac_address AS mac_address, MIN(m.seq)
+    FROM raw_readings_t AS r
+    JOIN mac_interval_t AS m ON m.name == r.name
+    WHERE r.rejected IS NULL
+    AND   (:name IS NULL OR r.name == :name)
+    AND   r.date_id * 1000000 + r.time_id BETWEEN m.since AND m.until
+    GROUP BY r.rowid
+'''
+
+UPDATE_TESS_IDS_SQL = '''
+    UPDATE raw_readings_t
+    SET tess_id = x.tess_id
+    FROM (
+        SELECT rm.rid AS rid, t.tess_id AS tess_id, MIN(t.seq)
+        FROM reading_mac_t AS rm
+        JOIN tess_interval_t AS t ON t.mac_address == rm.mac_address
+        WHERE rm.key BETWEEN t.since AND t.until
+        GROUP BY rm.rid
+    ) AS x
+    WHERE raw_readings_t.rowid == x.rid
+'''
+
+MARK_BEFORE_REGISTRY_SQL = '''
+    UPDATE raw_readings_t
+    SET rejected = :reason
+    WHERE rejected IS NULL
+    AND   (:name IS NULL OR name == :name)
+    AND   rowid NOT IN (SELECT rid FROM reading_mac_t)
+'''
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -47,6 +126,37 @@ ROWS_PER_COMMIT = 50000
 # Module classes
 # --------------
 
+class IntervalIndex(object):
+    '''
+    Closed [since, until] intervals with a payload, looked up with increasing keys.
+    Intervals are sorted by start once. A sweep then adds the intervals starting
+    before each key and drops the expired ones, so a time ordered pass over
+    N readings costs O(N + M) instead of one query per reading.
+    When intervals overlap, the one given first wins, like fetchone() on the table.
+    '''
+
+    def __init__(self, intervals):
+        self._intervals = sorted((since, order, until, payload) for order, (since, until, payload) in enumerate(intervals))
+        self.rewind()
+
+    def rewind(self):
+        self._next   = 0
+        self._active = []
+        self._last   = None
+
+    def find(self, key):
+        if self._last is not None and key < self._last:
+            self.rewind()
+        self._last = key
+        while self._next < len(self._intervals) and self._intervals[self._next][0] <= key:
+            since, order, until, payload = self._intervals[self._next]
+            self._active.append((order, until, payload))
+            self._next += 1
+        self._active = [item for item in self._active if item[1] >= key]
+        if not self._active:
+            return None
+        return min(self._active)[2]
+
 
 # -----------------------
 # Module global functions
@@ -58,81 +168,75 @@ def good_readings_iterable(connection, name):
     '''Used to find out tess_id values'''
     row = {'name': name}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT date_id, time_id
-        FROM  raw_readings_t
-        WHERE rejected IS NULL 
-        AND name == :name
-        ORDER BY date_id ASC, time_id ASC
-        ''', row)
+    cursor.execute(GOOD_READINGS_SQL, row)
     return cursor
 
 
-def get_mac(connection, name, tstamp):
-    '''Get the photometer MAC address at a given point in time'''
-    row = {'name': name, 'tstamp': tstamp}
+def tstamp_key(date_id, time_id):
+    '''YYYYMMDDHHMMSS integer key from date and time database identifiers'''
+    return date_id * 1000000 + time_id
+
+
+def datetime_key(tstamp):
+    '''YYYYMMDDHHMMSS integer key from a normalized "YYYY-MM-DD HH:MM:SS" datetime() string'''
+    return int(tstamp[0:4] + tstamp[5:7] + tstamp[8:10] + tstamp[11:13] + tstamp[14:16] + tstamp[17:19])
+
+
+def mac_intervals_iterable(connection, name):
+    '''MAC addresses a photometer name had over time'''
+    row = {'name': name}
     cursor = connection.cursor()
-    cursor.execute('''
-        SELECT mac_address
-        FROM name_to_mac_t
-        WHERE name == :name
-        AND datetime(:tstamp) BETWEEN datetime(valid_since) AND datetime(valid_until)
-        ''', row)
-    result = cursor.fetchone()
-    if result is not None:
-        result = result[0]
-    return result
-
-
-def find_tess_id(connection, mac_address, tstamp):
-    row = {'mac': mac_address, 'tstamp': tstamp}
+    cursor.execute(MAC_INTERVALS_SQL, row)
+    return cursor
+
+
+def tess_intervals_iterable(connection, mac_address):
+    '''tess_id versions of a photometer MAC address over time'''
+    row = {'mac': mac_address}
     cursor = connection.cursor()
-    cursor.execute('''
-        SELECT tess_id
-        FROM tess_t
-        WHERE mac_address == :mac
-        AND datetime(:tstamp) BETWEEN datetime(valid_since) AND datetime(valid_until)
-        ''', row)
-    return cursor.fetchone()[0]
-
-
-def get_tess_id(connection, name, date_id, time_id):
-    tstamp = tdbtool.s4a.datetime.from_dbase_ids(date_id, time_id).to_iso8601()
-    mac = get_mac(connection, name, tstamp)
-    if mac is None:
-        result = {'name': name, 'date_id': date_id, 'time_id': time_id, 'reason': BEFORE}
-    else:
-        tess_id = find_tess_id(connection, mac, tstamp)
-        result = {'name': name, 'date_id': date_id, 'time_id': time_id,'tess_id': tess_id}
-    return result
+    cursor.execute(TESS_INTERVALS_SQL, row)
+    return cursor
+
 
+def interval_index(iterable):
+    '''Builds an IntervalIndex from (payload, since, until) rows, skipping unparseable bounds'''
+    return IntervalIndex((datetime_key(since), datetime_key(until), payload) for payload, since, until in iterable if since and until)
+
+
+def registry_indexes(connection, name):
+    '''Preloads the name -> MAC and MAC -> tess_id registry intervals of a photometer'''
+    rows = mac_intervals_iterable(connection, name).fetchall()
+    macs = interval_index(rows)
+    tess = dict((row[0], interval_index(tess_intervals_iterable(connection, row[0]))) for row in rows)
+    return macs, tess
 
 
 def update_tess_id(connection, iterable):
     cursor = connection.cursor()
-    cursor.executemany('''
-        UPDATE raw_readings_t
-        SET tess_id =  :tess_id
-        WHERE name  == :name
-        AND date_id == :date_id
-        AND time_id == :time_id
-        ''', iterable)
+    cursor.executemany(UPDATE_TESS_ID_SQL, iterable)
     connection.commit()
 
 
 
+@profiled
 def metadata_instrument_by_name(connection, name, connection2):
     tess_ids = []
     bad_rows = []
     count    = 0
+    missing  = 0
     logging.debug("[{0}] adding instrument metadata to {1}".format(__name__, name))
+    macs, tess = registry_indexes(connection2, name)
     for row in good_readings_iterable(connection, name):
-        tess_id = get_tess_id(connection2, name, row[0], row[1])
-        if 'reason' in tess_id:
-            bad_rows.append(tess_id)
+        key = tstamp_key(row[0], row[1])
+        mac = macs.find(key)
+        if mac is None:
+            bad_rows.append({'name': name, 'date_id': row[0], 'time_id': row[1], 'reason': BEFORE})
             continue
-        tess_ids.append(tess_id)
+        tess_id = tess[mac].find(key)
+        if tess_id is None:
+            missing += 1
+            continue
+        tess_ids.append({'name': name, 'date_id': row[0], 'time_id': row[1], 'tess_id': tess_id})
         if len(tess_ids) == ROWS_PER_COMMIT:
             count += ROWS_PER_COMMIT
             update_tess_id(connection, tess_ids)
@@ -144,21 +248,80 @@ def metadata_instrument_by_name(connection, name, connection2):
 
     if len(bad_rows):
         mark_bad_rows(connection, bad_rows)
+    if missing:
+        logging.warning("[{0}] {1} readings of {2} have a MAC address without tess_id at that time".format(__name__, missing, name))
     logging.info("[{0}] Updated {1} tess ids for {2}.".format(__name__, count, name))
 
 
 
+def attach_reference_database(connection, path, profile):
+    '''Attaches the reference database read-only and copies its registry with integer YYYYMMDDHHMMSS bounds'''
+    logging.info("[{0}] Attaching reference database {1}".format(__name__, path))
+    if URI_FILENAMES:
+        source = reference_uri(path, profile)
+    else:
+        logging.warning("[{0}] URI filenames need Python 3.4, attaching {1} without mode=ro".format(__name__, path))
+        source = path
+    cursor = connection.cursor()
+    cursor.execute("ATTACH DATABASE :source AS ref", {'source': source})
+    cursor.execute("CREATE TEMP TABLE mac_interval_t AS " + MAC_INTERVAL_TABLE_SQL)
+    cursor.execute("CREATE INDEX temp.mac_interval_i ON mac_interval_t(name, since)")
+    cursor.execute("CREATE TEMP TABLE tess_interval_t AS " + TESS_INTERVAL_TABLE_SQL)
+    cursor.execute("CREATE INDEX temp.tess_interval_i ON tess_interval_t(mac_address, since)")
+
+
+def detach_reference_database(connection):
+    '''Undoes whatever attach_reference_database() got to do, even if it failed halfway'''
+    # Uncommitted work would keep ref locked
+    connection.rollback()
+    cursor = connection.cursor()
+    cursor.execute("DROP TABLE IF EXISTS temp.reading_mac_t")
+    cursor.execute("DROP TABLE IF EXISTS temp.mac_interval_t")
+    cursor.execute("DROP TABLE IF EXISTS temp.tess_interval_t")
+    cursor.execute("PRAGMA database_list")
+    if 'ref' in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("DETACH DATABASE ref")
+
+
+def metadata_instrument_sql(connection, name, path, profile):
+    '''
+    Set based engine: range joins over integer interval bounds resolve the MAC address
+    and tess_id of all pending readings. Among overlapping intervals, the first row in
+    rowid order wins, as with the Python engine.
+    '''
+    row = {'name': name, 'reason': BEFORE}
+    cursor = connection.cursor()
+    try:
+        attach_reference_database(connection, path, profile)
+        cursor.execute("CREATE TEMP TABLE reading_mac_t AS " + READING_MAC_TABLE_SQL, row)
+        cursor.execute(UPDATE_TESS_IDS_SQL)
+        count = cursor.rowcount
+        cursor.execute(MARK_BEFORE_REGISTRY_SQL, row)
+        before = cursor.rowcount
+        connection.commit()
+    finally:
+        detach_reference_database(connection)
+    logging.info("[{0}] Updated {1} tess ids, {2} readings before registry.".format(__name__, count, before))
+
+
+def instrument_engine(engine, name):
+    if engine == 'auto':
+        engine = 'sql' if name is None and update_from_available() else 'python'
+    elif engine == 'sql' and not update_from_available():
+        logging.warning("[{0}] UPDATE ... FROM not available in SQLite {1}, using the python engine".format(__name__, sqlite3.sqlite_version))
+        engine = 'python'
+    logging.info("[{0}] Using the {1} instrument engine".format(__name__, engine))
+    return engine
+
+
 # ==============
 # MAIN FUNCTIONS
 # ==============
 
 
 def metadata_instrument(connection, options):
+    if instrument_engine(options.engine, options.name) == 'sql':
+        metadata_instrument_sql(connection, options.name, options.dbase, options.ref_db_profile)
+        return
     logging.info("[{0}] Opening reference database {1}".format(__name__, options.dbase))
-    connection2 = open_reference_database(options.dbase)
-    if options.name is not None:
-        metadata_instrument_by_name(connection, options.name, connection2)
-    else:
-        for name in candidate_names_iterable(connection):
-            metadata_instrument_by_name(connection, name[0], connection2)
-
+    run_by_name(connection, options, metadata_instrument_by_name, reference=True)
@@ -18,6 +18,7 @@ from __future__ import generators    # needs to be at the top of your module
 import os
 import os.path
 import sys
+import math
 import sqlite3
 import logging
 import collections
@@ -31,6 +32,8 @@ from .      import __version__
 from .      import AMBIGUOUS_LOC
 from .utils import open_database, open_reference_database, mark_bad_rows
 from .utils import candidate_names_iterable, shift_generator, PeriodCachedDAO
+from .profiling import profiled
+from .parallel import run_by_name
 
 # ----------------
 # Module constants
@@ -40,6 +43,127 @@ ROWS_PER_COMMIT = 50000
 
 TEMP_REJECTED_LOCATION_ID = -100
 
+EXPRESS_FIND_SQL = '''
+    SELECT location_id
+    FROM location_daily_aggregate_t
+    WHERE tess_id == :tess_id
+    AND   date_id == :date_id
+    AND   same_location == 1
+'''
+
+SLOW_FIND_SQL = '''
+    SELECT location_id
+    FROM tess_readings_t AS r
+    WHERE tess_id == :tess_id
+    AND datetime(iso8601fromids(date_id, time_id))
+    BETWEEN datetime(:tstamp, :low)
+    AND datetime(:tstamp, :high)
+'''
+
+LOAD_DAY_SQL = '''
+    SELECT time_id, location_id
+    FROM tess_readings_t
+    WHERE tess_id == :tess_id
+    AND   date_id == :date_id
+    ORDER BY time_id ASC
+'''
+
+UPDATE_GAP_LOCATION_SQL = '''
+    UPDATE raw_readings_t
+    SET location_id = :new_location_id, rejected = :reason
+    WHERE location_id == :old_location_id
+    AND name == :name
+    AND datetime(trim(tstamp,'Z'))
+    BETWEEN datetime(:low)
+    AND datetime(:high)
+'''
+
+GAP_COUNT_SQL = '''
+    SELECT COUNT(*)
+    FROM raw_readings_t
+    WHERE location_id == :old_location_id
+    AND name == :name
+    AND datetime(trim(tstamp,'Z'))
+    BETWEEN datetime(:low)
+    AND datetime(:high)
+'''
+
+START_SITE_SQL = '''
+    SELECT site
+    FROM location_t
+    WHERE location_id == :start_loc_id
+'''
+
+END_SITE_SQL = '''
+    SELECT site
+    FROM location_t
+    WHERE location_id == :end_loc_id
+'''
+
+UPDATE_GAP_SITES_SQL = '''
+    UPDATE location_gaps_t
+    SET start_location = :start_site, end_location = :end_site
+    WHERE name == :name
+    AND start_date_id = :start_date_id
+    AND start_time_id = :start_time_id
+    AND end_date_id   = :end_date_id
+    AND end_time_id   = :end_time_id
+'''
+
+INSERT_GAP_SQL = '''
+    INSERT OR REPLACE INTO location_gaps_t (
+        name,
+        start_date_id,
+        start_time_id,
+        start_tstamp,
+        start_location_id,
+        end_date_id,
+        end_time_id,
+        end_tstamp,
+        end_location_id,
+        readings
+        ) VALUES (
+        :name,
+        :start_date_id,
+        :start_time_id,
+        :low,
+        :start_loc_id,
+        :end_date_id,
+        :end_time_id,
+        :high,
+        :end_loc_id,
+        :count
+        )
+'''
+
+GOOD_READINGS_SQL = '''
+    SELECT date_id, time_id, tess_id
+    FROM  raw_readings_t
+    WHERE rejected IS NULL
+    AND tess_id IS NOT NULL
+    AND location_id IS NULL
+    AND name == :name
+    ORDER BY date_id ASC, time_id ASC
+'''
+
+LOCATED_READINGS_SQL = '''
+    SELECT date_id, time_id, location_id
+    FROM  raw_readings_t
+    WHERE rejected IS NULL
+    AND tess_id IS NOT NULL
+    AND location_id IS NOT NULL
+    AND name == :name
+    ORDER BY date_id ASC, time_id ASC
+'''
+
+UPDATE_LOCATION_ID_SQL = '''
+    UPDATE raw_readings_t
+    SET location_id = :location_id
+    WHERE name  == :name
+    AND date_id == :date_id
+    AND time_id == :time_id
+'''
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -61,26 +185,24 @@ class LocationDAO(object):
     def __init__(self, connection, connection2):
         self.connection   = connection
         self.connection2  = connection2
+        self.dayKey       = None
+        self.daySeconds   = []
+        self.dayLocations = []
+        self.dayPointer   = 0
+        self.dayLow       = None
         
 
     def getLocationId(self, tess_id, date_id, time_id, period):
         location_id = self.expressFind(tess_id, date_id)
         if location_id is None :
-            tstamp = tdbtool.s4a.datetime.from_dbase_ids(date_id, time_id).to_iso8601()
-            location_id = self.slowFind(tess_id, tstamp, period)
+            location_id = self.dayFind(tess_id, date_id, time_id, period)
         return location_id
 
 
     def expressFind(self, tess_id, date_id):
         row = {'tess_id': tess_id, 'date_id': date_id}
         cursor = self.connection.cursor()
-        cursor.execute('''
-            SELECT location_id
-            FROM location_daily_aggregate_t
-            WHERE tess_id == :tess_id
-            AND   date_id == :date_id
-            AND   same_location == 1
-            ''', row)
+        cursor.execute(EXPRESS_FIND_SQL, row)
         return cursor.fetchone()
 
     def slowFind(self, tess_id, tstamp, period):
@@ -88,16 +210,47 @@ class LocationDAO(object):
         row['high'] = str(period/2)  + ' seconds'
         row['low']  = str(-period/2) + ' seconds'
         cursor = self.connection2.cursor()
-        cursor.execute('''
-            SELECT location_id
-            FROM tess_readings_t AS r
-            WHERE tess_id == :tess_id
-            AND datetime(iso8601fromids(date_id, time_id)) 
-            BETWEEN datetime(:tstamp, :low) 
-            AND datetime(:tstamp, :high)
-            ''', row)
+        cursor.execute(SLOW_FIND_SQL, row)
         return cursor.fetchone()
 
+    def loadDay(self, tess_id, date_id):
+        '''Fetches the whole day of reference readings once, sorted by time'''
+        row = {'tess_id': tess_id, 'date_id': date_id}
+        cursor = self.connection2.cursor()
+        cursor.execute(LOAD_DAY_SQL, row)
+        self.dayKey       = (tess_id, date_id)
+        self.daySeconds   = []
+        self.dayLocations = []
+        for ref_time_id, location_id in cursor:
+            self.daySeconds.append(3600*(ref_time_id // 10000) + 60*((ref_time_id // 100) % 100) + ref_time_id % 100)
+            self.dayLocations.append(location_id)
+        self.dayPointer = 0
+        self.dayLow     = None
+
+    def dayFind(self, tess_id, date_id, time_id, period):
+        '''
+        Same match as slowFind() over a preloaded day: the first reference reading within
+        [tstamp - period/2, tstamp + period/2], bounds truncated to whole seconds like datetime().
+        Readings come time ordered, so a single pointer sweeps the day (two-pointer merge).
+        Windows crossing midnight fall back to slowFind().
+        '''
+        seconds = 3600*(time_id // 10000) + 60*((time_id // 100) % 100) + time_id % 100
+        low  = int(math.floor(seconds - period/2.0))
+        high = int(math.floor(seconds + period/2.0))
+        if low < 0 or high >= 86400:
+            tstamp = tdbtool.s4a.iso8601_from_ids(date_id, time_id)
+            return self.slowFind(tess_id, tstamp, period)
+        if self.dayKey != (tess_id, date_id):
+            self.loadDay(tess_id, date_id)
+        if self.dayLow is not None and low < self.dayLow:
+            self.dayPointer = 0
+        self.dayLow = low
+        while self.dayPointer < len(self.daySeconds) and self.daySeconds[self.dayPointer] < low:
+            self.dayPointer += 1
+        if self.dayPointer < len(self.daySeconds) and self.daySeconds[self.dayPointer] <= high:
+            return (self.dayLocations[self.dayPointer],)
+        return None
+
     def __repr__(self):
         return "H: 0%, M: 100%"
 
@@ -120,14 +273,14 @@ class LocationCachedDAO(LocationDAO):
             self.hits[key] = self.hits.get(key, 0) + 1
             return self.cache[key]
         self.miss[key] = self.miss.get(key, 0) + 1
-        location_id = self.expressFind(tess_id, date_id)
+        # Days known not to be in the daily aggregate go straight to the day resolver
+        location_id = None if key in self.expressMiss else self.expressFind(tess_id, date_id)
         if location_id:
             self.expressHits[key] = self.expressHits.get(key, 0) + 1
             self.cache[key] = location_id
         else:
             self.expressMiss[key] = self.expressMiss.get(key, 0) + 1
-            tstamp = tdbtool.s4a.datetime.from_dbase_ids(date_id, time_id).to_iso8601()
-            location_id = self.slowFind(tess_id, tstamp, period)
+            location_id = self.dayFind(tess_id, date_id, time_id, period)
         return location_id
 
 
@@ -166,29 +319,11 @@ class LocationGap(object):
    
     def _updateLocation(self, row):
         cursor = self._connection.cursor()
-        cursor.execute(
-            '''
-            UPDATE raw_readings_t
-            SET location_id = :new_location_id, rejected = :reason
-            WHERE location_id == :old_location_id
-            AND name == :name
-            AND datetime(trim(tstamp,'Z'))
-            BETWEEN datetime(:low)
-            AND datetime(:high)
-            ''', row)
+        cursor.execute(UPDATE_GAP_LOCATION_SQL, row)
 
     def getCount(self, row):
         cursor = self._connection.cursor()
-        cursor.execute(
-                '''
-                SELECT COUNT(*)
-                FROM raw_readings_t
-                WHERE location_id == :old_location_id
-                AND name == :name
-                AND datetime(trim(tstamp,'Z'))
-                BETWEEN datetime(:low)
-                AND datetime(:high)
-                ''', row)
+        cursor.execute(GAP_COUNT_SQL, row)
         return cursor.fetchone()[0]
 
 
@@ -207,32 +342,13 @@ class LocationGap(object):
 
     def setLocationNames(self, row):
         cursor2 = self._connection2.cursor()
-        cursor2.execute(
-            '''
-            SELECT site
-            FROM location_t
-            WHERE location_id == :start_loc_id
-            ''', row)
+        cursor2.execute(START_SITE_SQL, row)
         row['start_site'] = cursor2.fetchone()[0]
-        cursor2.execute(
-            '''
-            SELECT site
-            FROM location_t
-            WHERE location_id == :end_loc_id
-            ''', row)
+        cursor2.execute(END_SITE_SQL, row)
         row['end_site'] = cursor2.fetchone()[0]
         logging.warning("[{0}] mismatching location for {1} are {2} and {3} respectively".format(__name__, row['name'], row['start_site'].encode('utf-8'), row['end_site'].encode('utf-8')))
         cursor = self._connection.cursor()
-        cursor.execute(
-            '''
-            UPDATE location_gaps_t
-            SET start_location = :start_site, end_location = :end_site
-            WHERE name == :name
-            AND start_date_id = :start_date_id
-            AND start_time_id = :start_time_id
-            AND end_date_id   = :end_date_id
-            AND end_time_id   = :end_time_id
-            ''', row)
+        cursor.execute(UPDATE_GAP_SITES_SQL, row)
 
 
     def logToDbase(self, row):
@@ -244,32 +360,7 @@ class LocationGap(object):
         row['end_loc_id']    = self._end_loc_id
         logging.warning("[{0}] mismatching location ids for {1} are {2} and {3} respectively".format(__name__, row['name'], row['start_loc_id'], row['end_loc_id']))
         cursor = self._connection.cursor()
-        cursor.execute(
-            '''
-            INSERT OR REPLACE INTO location_gaps_t (
-                name,
-                start_date_id,
-                start_time_id,
-                start_tstamp,
-                start_location_id,
-                end_date_id,
-                end_time_id,
-                end_tstamp,
-                end_location_id,
-                readings 
-                ) VALUES (
-                :name,
-                :start_date_id,
-                :start_time_id,
-                :low,
-                :start_loc_id,
-                :end_date_id,
-                :end_time_id,
-                :high,
-                :end_loc_id,
-                :count
-                )
-            ''', row)
+        cursor.execute(INSERT_GAP_SQL, row)
         self.setLocationNames(row)
 
 
@@ -278,8 +369,8 @@ class LocationGap(object):
                 
                 'old_location_id': TEMP_REJECTED_LOCATION_ID,
                 'name': self._name,
-                'low' : tdbtool.s4a.datetime.from_dbase_ids(self._start_date_id, self._start_time_id).to_iso8601(),
-                'high': tdbtool.s4a.datetime.from_dbase_ids(self._end_date_id, self._end_time_id).to_iso8601(),
+                'low' : tdbtool.s4a.iso8601_from_ids(self._start_date_id, self._start_time_id),
+                'high': tdbtool.s4a.iso8601_from_ids(self._end_date_id, self._end_time_id),
             }
         row['count'] = self.getCount(row)
         if self._start_loc_id == self._end_loc_id:
@@ -299,16 +390,7 @@ def good_readings_iterable(connection, name):
     '''Used to find out location_id values'''
     row = {'name': name}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT date_id, time_id, tess_id
-        FROM  raw_readings_t
-        WHERE rejected IS NULL
-        AND tess_id IS NOT NULL
-        AND location_id IS NULL 
-        AND name == :name
-        ORDER BY date_id ASC, time_id ASC
-        ''', row)
+    cursor.execute(GOOD_READINGS_SQL, row)
     return cursor
 
 
@@ -316,16 +398,7 @@ def good_readings_iterable2(connection, name):
     '''Used to detect gaps in location_id values'''
     row = {'name': name}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT date_id, time_id, location_id
-        FROM  raw_readings_t
-        WHERE rejected IS NULL
-        AND tess_id IS NOT NULL
-        AND location_id IS NOT NULL 
-        AND name == :name
-        ORDER BY date_id ASC, time_id ASC
-        ''', row)
+    cursor.execute(LOCATED_READINGS_SQL, row)
     return cursor
 
 
@@ -342,13 +415,7 @@ def format_row(name, date_id, time_id, tess_id, location_id):
 
 def update_location_id(connection, iterable):
     cursor = connection.cursor()
-    cursor.executemany('''
-        UPDATE raw_readings_t
-        SET location_id = :location_id
-        WHERE name  == :name
-        AND date_id == :date_id
-        AND time_id == :time_id
-        ''', iterable)
+    cursor.executemany(UPDATE_LOCATION_ID_SQL, iterable)
     connection.commit()
 
 
@@ -401,6 +468,7 @@ def metadata_location_by_name_step2(connection, name, connection2):
     logging.info("[{0}] Location metadata update finally done for {1}".format(__name__, name))
 
 
+@profiled
 def metadata_location_by_name(connection, name, connection2):
     metadata_location_by_name_step1(connection, name, connection2)
     # Close the detrected gaps
@@ -414,10 +482,5 @@ def metadata_location_by_name(connection, name, connection2):
 
 def metadata_location(connection, options):
     logging.info("[{0}] Opening reference database {1}".format(__name__, options.dbase))
-    connection2 = open_reference_database(options.dbase)
-    if options.name is not None:
-        metadata_location_by_name(connection, options.name, connection2)
-    else:
-        for name in candidate_names_iterable(connection):
-            metadata_location_by_name(connection, name[0], connection2)
+    run_by_name(connection, options, metadata_location_by_name, reference=True)
 
@@ -39,6 +39,29 @@ ROWS_PER_COMMIT = 50000
 
 FLAGS_SUBSCRIBER_IMPORTED = 2
 
+AGGREGATES_SQL = '''
+    SELECT tess_id, date_id, MIN(location_id), (MIN(location_id) == MAX(location_id))
+    FROM tess_readings_t
+    GROUP BY tess_id, date_id
+'''
+
+UPDATE_AGGREGATES_SQL = '''
+    INSERT OR REPLACE INTO location_daily_aggregate_t(tess_id, date_id, location_id, same_location)
+    VALUES(?,?,?,?)
+'''
+
+FLAGS_SQL = '''
+    UPDATE raw_readings_t
+    SET units_id = :value
+    WHERE rejected is NULL
+'''
+
+FLAGS_BY_NAME_SQL = '''
+    UPDATE raw_readings_t
+    SET units_id = :value
+    WHERE rejected is NULL
+    AND name == :name
+'''
 
 # -----------------------
 # Module global variables
@@ -57,22 +80,13 @@ FLAGS_SUBSCRIBER_IMPORTED = 2
 
 def aggregates_iterable(connection):
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT tess_id, date_id, MIN(location_id), (MIN(location_id) == MAX(location_id))
-        FROM tess_readings_t
-        GROUP BY tess_id, date_id
-        ''')
+    cursor.execute(AGGREGATES_SQL)
     return cursor
 
 
 def aggregates_update(connection, iterable):
     cursor = connection.cursor()
-    cursor.executemany(
-        '''
-        INSERT OR REPLACE INTO location_daily_aggregate_t(tess_id, date_id, location_id, same_location)
-        VALUES(?,?,?,?)
-        ''',iterable)
+    cursor.executemany(UPDATE_AGGREGATES_SQL,iterable)
     connection.commit()
 
 
@@ -85,22 +99,11 @@ def metadata_flags(connection, options):
     if options.name is None:
         logging.info("[{0}] setting flags metadata for all = 0x{1:02X}".format(__name__, FLAGS_SUBSCRIBER_IMPORTED))
         row = {'value': FLAGS_SUBSCRIBER_IMPORTED}
-        cursor.execute(
-            '''
-            UPDATE raw_readings_t
-            SET units_id = :value
-            WHERE rejected is NULL
-            ''', row)
+        cursor.execute(FLAGS_SQL, row)
     else:
         logging.info("[{0}] setting flags metadata to {1} = 0x{2:02X}".format(__name__, options.name, FLAGS_SUBSCRIBER_IMPORTED))
         row = {'name': options.name, 'value': FLAGS_SUBSCRIBER_IMPORTED}
-        cursor.execute(
-             '''
-            UPDATE raw_readings_t
-            SET units_id = :value
-            WHERE rejected is NULL
-            AND name == :name
-            ''', row)
+        cursor.execute(FLAGS_BY_NAME_SQL, row)
     connection.commit()
     logging.info("[{0}] Done!".format(__name__))
 
@@ -108,7 +111,7 @@ def metadata_flags(connection, options):
 
 def metadata_refresh(connection, options):
     logging.info("[{0}] Opening reference database {1}".format(__name__, options.dbase))
-    connection2 = open_reference_database(options.dbase)
+    connection2 = open_reference_database(options.dbase, options.ref_db_profile)
     logging.info("[{0}] Refresing metadata from reference database".format(__name__))
     aggregates_update(connection, aggregates_iterable(connection2))
     logging.info("[{0}] Done!".format(__name__))
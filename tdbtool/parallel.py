@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+# PER PHOTOMETER PARALLEL SCHEDULER WITH A SINGLE DATABASE WRITER
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import sqlite3
+import logging
+import traceback
+import multiprocessing
+
+# Python 2 compatibility
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# -------------
+# Local imports
+# -------------
+
+from .utils      import open_database, open_reference_database, candidate_names_iterable
+from .functions  import register_functions
+from .checkpoint import checkpoint
+from .profiling  import Probe, configure, enabled, bookkeeping, count_statements
+from .           import tracing
+
+# ----------------
+# Module constants
+# ----------------
+
+# Extra database profile for worker readers. Writes never happen there.
+WORKER_PROFILE = 'read-only'
+
+# Seconds between checks for dead workers while waiting for writes
+POLL_TIMEOUT = 1
+
+# Statements executed by the worker itself, everything else goes to the writer
+READ_STATEMENTS = ('SELECT', 'WITH', 'EXPLAIN')
+
+# QueuedCursor result while its last write waits for commit()
+QUEUED = 'queued'
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# --------------
+# Module classes
+# --------------
+
+class QueuedCursor(object):
+    '''
+    Cursor proxy for QueuedConnection. Reads run on the worker read-only
+    connection, writes are appended to the pending transaction.
+    The rowcount and lastrowid of a write come with the writer reply,
+    so they are only available after commit().
+    '''
+
+    def __init__(self, proxy):
+        self.proxy  = proxy
+        self.cursor = proxy.reader.cursor()
+        # None for reads, QUEUED or the writer (rowcount, lastrowid) for writes
+        self.result = None
+
+    def execute(self, sql, params=()):
+        if sql.lstrip().upper().startswith(READ_STATEMENTS):
+            self.cursor.execute(sql, params)
+            self.result = None
+        else:
+            self.proxy.queue(self, ('execute', sql, params))
+            count_statements()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        self.proxy.queue(self, ('executemany', sql, seq_of_params))
+        count_statements(len(seq_of_params))
+        return self
+
+    @property
+    def rowcount(self):
+        assert self.result is not QUEUED, "rowcount of a queued write is only known after commit()"
+        return self.cursor.rowcount if self.result is None else self.result[0]
+
+    @property
+    def lastrowid(self):
+        assert self.result is not QUEUED, "lastrowid of a queued write is only known after commit()"
+        return self.cursor.lastrowid if self.result is None else self.result[1]
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+
+class QueuedConnection(object):
+    '''
+    Connection proxy handed to the per name functions inside a worker process.
+    Writes are buffered until commit(), then shipped as one transaction to the
+    writer in the parent process. commit() waits for the writer acknowledge, so
+    a worker always reads its own committed writes, as with a plain connection.
+    '''
+
+    def __init__(self, reader, wid, writes, replies):
+        self.reader  = reader
+        self.wid     = wid
+        self.writes  = writes
+        self.replies = replies
+        self.pending = []
+        self.cursors = []   # cursor of each pending statement
+        # Rows changed by the writer on behalf of this worker
+        self.total_changes = 0
+
+    @property
+    def in_transaction(self):
+        return len(self.pending) > 0
+
+    def cursor(self):
+        return QueuedCursor(self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def queue(self, cursor, statement):
+        cursor.result = QUEUED
+        self.pending.append(statement)
+        self.cursors.append(cursor)
+
+    def discard(self, results):
+        for cursor, result in zip(self.cursors, results):
+            cursor.result = result
+        self.pending = []
+        self.cursors = []
+
+    def commit(self):
+        if not self.pending:
+            return
+        self.writes.put(('commit', self.wid, self.pending))
+        error, changes, results = self.replies.get()
+        self.total_changes += changes
+        if error is not None:
+            self.discard([(-1, None)] * len(self.cursors))
+            raise sqlite3.OperationalError(error)
+        self.discard(results)
+
+    def rollback(self):
+        self.discard([(-1, None)] * len(self.cursors))
+
+
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def worker(wid, by_name, reference, options, names, writes, replies):
+    '''Worker process main loop: runs by_name() for every name taken from the names queue'''
+    configure(options)
+    tracing.configure(options)
+    reader = open_database(options.extra_dbase, WORKER_PROFILE)
+    register_functions(reader)
+    connection  = QueuedConnection(reader, wid, writes, replies)
+    connection2 = open_reference_database(options.dbase, options.ref_db_profile) if reference else None
+    for name in iter(names.get, None):
+        probe = Probe(connection)
+        try:
+            if reference:
+                by_name(connection, name, connection2)
+            else:
+                by_name(connection, name)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            writes.put(('error', wid, "{0}: {1}".format(name, traceback.format_exc())))
+        else:
+            writes.put(('done', wid, (name, probe.stop())))
+    writes.put(('exit', wid, tracing.stats()))
+
+
+def apply_transaction(connection, statements):
+    '''Returns the error message, if any, the rows changed and (rowcount, lastrowid) per statement'''
+    before  = connection.total_changes
+    cursor  = connection.cursor()
+    results = []
+    try:
+        for method, sql, params in statements:
+            getattr(cursor, method)(sql, params)
+            results.append((cursor.rowcount, cursor.lastrowid))
+        connection.commit()
+    except sqlite3.Error as e:
+        connection.rollback()
+        return str(e), 0, []
+    return None, connection.total_changes - before, results
+
+
+def set_journal_mode(connection, mode):
+    '''Returns the previous journal mode'''
+    previous = connection.execute("PRAGMA journal_mode").fetchone()[0]
+    mode = connection.execute("PRAGMA journal_mode={0}".format(mode)).fetchone()[0]
+    logging.info("[{0}] Extra database journal mode is {1}".format(__name__, mode))
+    return previous
+
+
+def dead_workers(workers, exited):
+    '''Workers no longer alive that did not say goodbye'''
+    return [wid for wid, process in enumerate(workers) if wid not in exited and not process.is_alive()]
+
+
+def pending_names(connection, options, check, step):
+    names = [options.name] if options.name is not None else [row[0] for row in candidate_names_iterable(connection)]
+    if check is None:
+        return names
+    pending = [name for name in names if not check.done(step, name)]
+    if len(pending) < len(names):
+        logging.info("[{0}] Skipping {1} names already completed by {2} in run {3}".format(__name__, len(names) - len(pending), step, check.run_id))
+    return pending
+
+
+def run_by_name(connection, options, by_name, reference=False):
+    '''
+    Runs by_name(connection, name[, connection2]) for all candidate names.
+    With options.jobs > 1 names are spread over a pool of worker processes,
+    each one with its own read-only connections to both databases, while
+    this process stays as the only writer to the extra database.
+    Inside a pipeline run, each completed name is checkpointed.
+    '''
+    step  = by_name.__name__
+    check = checkpoint(connection, options)
+    names = pending_names(connection, options, check, step)
+    jobs  = getattr(options, 'jobs', 1)
+    if options.name is not None or jobs <= 1:
+        connection2 = open_reference_database(options.dbase, options.ref_db_profile) if reference else None
+        for i, name in enumerate(names, 1):
+            probe = Probe(connection)
+            if reference:
+                by_name(connection, name, connection2)
+            else:
+                by_name(connection, name)
+            if check is not None:
+                measure = probe.stop()
+                check.record(step, name, measure['started'], measure['seconds'], measure['rows'])
+                logging.info("[{0}] {1}: {2}/{3} names done".format(__name__, step, i, len(names)))
+        return
+    # Worker readers must not block on (nor be blocked by) the writer.
+    # WAL is only kept while the workers run, the database returns to its
+    # previous journal mode afterwards.
+    connection.commit()
+    previous = set_journal_mode(connection, 'WAL')
+    try:
+        errors = run_workers(connection, options, by_name, reference, check, step, names, jobs)
+    finally:
+        set_journal_mode(connection, previous)
+    if errors:
+        raise RuntimeError("{0} failed for {1} photometers".format(step, len(errors)))
+
+
+def run_workers(connection, options, by_name, reference, check, step, names, jobs):
+    '''Serves the worker writes until all of them exit. Returns the errors found'''
+    tasks = multiprocessing.Queue()
+    for name in names:
+        tasks.put(name)
+    writes  = multiprocessing.Queue()
+    replies = [multiprocessing.Queue() for wid in range(jobs)]
+    workers = [multiprocessing.Process(target=worker, args=(wid, by_name, reference, options, tasks, writes, replies[wid])) for wid in range(jobs)]
+    for wid in range(jobs):
+        tasks.put(None)
+    logging.info("[{0}] Running {1} with {2} workers".format(__name__, step, jobs))
+    for process in workers:
+        process.start()
+    errors = []
+    done   = 0
+    exited = set()
+    while len(exited) < jobs:
+        try:
+            message, wid, payload = writes.get(timeout=POLL_TIMEOUT)
+        except queue.Empty:
+            dead = dead_workers(workers, exited)
+            if dead:
+                for wid in dead:
+                    logging.error("[{0}] Worker {1} died unexpectedly".format(__name__, wid))
+                    errors.append("worker {0} died unexpectedly".format(wid))
+                for process in workers:
+                    if process.is_alive():
+                        process.terminate()
+                break
+            continue
+        if message == 'commit':
+            replies[wid].put(apply_transaction(connection, payload))
+        elif message == 'done':
+            done += 1
+            name, measure = payload
+            if enabled():
+                # The worker timings row went through this writer
+                bookkeeping()
+            if check is not None:
+                check.record(step, name, measure['started'], measure['seconds'], measure['rows'])
+                logging.info("[{0}] {1}: {2}/{3} names done".format(__name__, step, done, len(names)))
+        elif message == 'error':
+            logging.error("[{0}] Worker {1} failed on {2}".format(__name__, wid, payload))
+            errors.append(payload)
+        else:
+            tracing.merge(payload)
+            exited.add(wid)
+    for process in workers:
+        process.join()
+    return errors
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# PIPELINE STEP AND PER PHOTOMETER TIMINGS
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import sys
+import time
+import json
+import logging
+import functools
+import datetime as Datetime
+
+# resource is not available in Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# ----------------
+# Module constants
+# ----------------
+
+# Name recorded for whole steps
+ALL_NAMES = '*'
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# Command line options of this process, set by configure()
+_options = None
+
+# SQL statements executed by this process on connections with a counter
+_statements = 0
+
+# Rows written by the timings and checkpoint bookkeeping itself
+_bookkeeping = 0
+
+# --------------
+# Module classes
+# --------------
+
+class Probe(object):
+    '''
+    Measures a unit of work on a connection: wall time, rows changed,
+    SQL statements executed and the process peak RSS at its end.
+    '''
+
+    def __init__(self, connection):
+        self.connection  = connection
+        self.started     = time.time()
+        self.changes     = connection.total_changes
+        self.statements  = _statements
+        self.bookkeeping = _bookkeeping
+
+    def stop(self):
+        seconds = time.time() - self.started
+        rows    = self.connection.total_changes - self.changes - (_bookkeeping - self.bookkeeping)
+        return {
+            'started'        : self.started,
+            'seconds'        : seconds,
+            'rows'           : rows,
+            'rows_per_second': rows / seconds if seconds > 0 else None,
+            'statements'     : _statements - self.statements,
+            'peak_rss_kb'    : peak_rss(),
+        }
+
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def configure(options):
+    global _options
+    _options = options
+
+
+def enabled():
+    '''Timings are always kept for pipelines, and for any command given --timings'''
+    if _options is None:
+        return False
+    return getattr(_options, 'timings', None) is not None or getattr(_options, 'command', None) == 'pipeline'
+
+
+def count_statements(n=1):
+    global _statements
+    _statements += n
+
+
+def bookkeeping(n=1):
+    global _bookkeeping
+    _bookkeeping += n
+
+
+def statement_counter(statement):
+    count_statements()
+
+
+def install_counter(connection):
+    '''Counts statements through the trace callback, not available before Python 3.3'''
+    if enabled() and hasattr(connection, 'set_trace_callback'):
+        connection.set_trace_callback(statement_counter)
+
+
+def peak_rss():
+    '''Peak resident set size of this process in KiB, None if unknown'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes by macOS, in KiB by Linux
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def iso8601(seconds):
+    return Datetime.datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def record_timing(connection, step, name, measure):
+    '''
+    The timings row is only committed when the measured work was already committed.
+    Otherwise it joins the transaction left open, so it does not get split.
+    '''
+    pending = getattr(connection, 'in_transaction', False)
+    row = dict(measure)
+    row['run_id']  = getattr(_options, 'run_id', None)
+    row['step']    = step
+    row['name']    = name
+    row['started'] = iso8601(measure['started'])
+    connection.execute('''
+        INSERT INTO timings_t(run_id, step, name, started, seconds, rows, rows_per_second, statements, peak_rss_kb)
+        VALUES (:run_id, :step, :name, :started, :seconds, :rows, :rows_per_second, :statements, :peak_rss_kb)
+        ''', row)
+    if not pending:
+        connection.commit()
+    bookkeeping()
+    logging.info("[{0}] {1} {2}: {3:.2f} s, {4} rows, {5} statements, peak RSS {6} KiB".format(__name__,
+        step, name, row['seconds'], row['rows'], row['statements'], row['peak_rss_kb']))
+    path = getattr(_options, 'timings', None)
+    if path is not None:
+        # Single short lines in append mode, so worker processes can share the file
+        with open(path, 'a') as f:
+            f.write(json.dumps(row, sort_keys=True) + '\n')
+
+
+def profiled(func):
+    '''Records the timings of a func(connection, name, ...) per photometer function'''
+    @functools.wraps(func)
+    def wrapper(connection, name, *args, **kwargs):
+        if not enabled():
+            return func(connection, name, *args, **kwargs)
+        probe  = Probe(connection)
+        result = func(connection, name, *args, **kwargs)
+        record_timing(connection, func.__name__, name, probe.stop())
+        return result
+    return wrapper
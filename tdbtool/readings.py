@@ -18,9 +18,12 @@ from __future__ import generators    # needs to be at the top of your module
 import os
 import os.path
 import sys
+import math
+import bisect
 import sqlite3
 import logging
 import collections
+import datetime as Datetime
 
 # -------------
 # Local imports
@@ -30,7 +33,9 @@ import tdbtool.s4a
 from .      import __version__
 from .      import COINCIDENT, SHIFTED, AMBIGUOUS_TIME
 from .utils import open_database, open_reference_database, mark_bad_rows
-from .utils import candidate_names_iterable, PeriodDAO
+from .utils import candidate_names_iterable, PeriodCachedDAO
+from .profiling import profiled
+from .parallel import run_by_name
 
 # ----------------
 # Module constants
@@ -38,6 +43,44 @@ from .utils import candidate_names_iterable, PeriodDAO
 
 ROWS_PER_COMMIT = 10000
 
+# Reference readings older than this, relative to the current window,
+# are dropped from the merge buffer. Must exceed half the largest period.
+BUFFER_SLACK = 86400
+
+REFERENCE_STREAM_SQL = '''
+    SELECT date_id, time_id, sequence_number
+    FROM tess_readings_t
+    WHERE tess_id == :tess_id
+    AND   date_id BETWEEN :min_date_id AND :max_date_id
+    ORDER BY date_id ASC, time_id ASC
+'''
+
+GOOD_READINGS_SQL = '''
+    SELECT date_id, time_id, tess_id, sequence_number
+    FROM  raw_readings_t
+    WHERE rejected IS NULL
+    AND   accepted IS NULL
+    AND name == :name
+    ORDER BY date_id ASC, time_id ASC
+'''
+
+TESS_IDS_SQL = '''
+    SELECT tess_id, MIN(date_id), MAX(date_id)
+    FROM  raw_readings_t
+    WHERE rejected IS NULL
+    AND   accepted IS NULL
+    AND name == :name
+    GROUP BY tess_id
+'''
+
+MARK_OK_SQL = '''
+    UPDATE raw_readings_t
+    SET accepted = :flag
+    WHERE name  == :name
+    AND date_id == :date_id
+    AND time_id == :time_id
+'''
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -47,7 +90,38 @@ ROWS_PER_COMMIT = 10000
 # Module classes
 # --------------
 
-
+class ReferenceStream(object):
+    '''
+    Time ordered reference readings of one tess_id, read forward once.
+    Readings are buffered while they may fall in the window of a later
+    raw reading, so each window lookup is a bisection over a small buffer
+    and the whole comparison is a single merge pass over both sides.
+    '''
+
+    def __init__(self, connection, tess_id, min_date_id, max_date_id):
+        row = {'tess_id': tess_id, 'min_date_id': min_date_id, 'max_date_id': max_date_id}
+        self.cursor = connection.cursor()
+        self.cursor.execute(REFERENCE_STREAM_SQL, row)
+        self.times     = []
+        self.seqs      = []
+        self.exhausted = False
+
+    def find(self, low, high):
+        '''Sequence numbers of the reference readings in [low, high] absolute seconds'''
+        while not self.exhausted and (not self.times or self.times[-1] <= high):
+            row = self.cursor.fetchone()
+            if row is None:
+                self.exhausted = True
+                break
+            self.times.append(absolute_seconds(row[0], row[1]))
+            self.seqs.append(row[2])
+        if self.times and self.times[0] < low - BUFFER_SLACK:
+            i = bisect.bisect_left(self.times, low - BUFFER_SLACK)
+            del self.times[:i]
+            del self.seqs[:i]
+        i = bisect.bisect_left(self.times, low)
+        j = bisect.bisect_right(self.times, high)
+        return self.seqs[i:j]
 
 
 # -----------------------
@@ -59,58 +133,76 @@ def good_readings_iterable(connection, name):
     '''Used to find out location_id values'''
     row = {'name': name}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT date_id, time_id, tess_id, sequence_number
-        FROM  raw_readings_t
-        WHERE rejected IS NULL
-        AND   accepted IS NULL
-        AND name == :name
-        ORDER BY date_id ASC, time_id ASC
-        ''', row)
+    cursor.execute(GOOD_READINGS_SQL, row)
     return cursor
 
 
-def find_sequence_number(connection, tess_id, tstamp, period, seq_num):
-    row = {'tess_id': tess_id, 'tstamp': tstamp, 'seq_num': seq_num}
-    row['high'] = str(period/2)  + ' seconds'
-    row['low']  = str(-period/2) + ' seconds'
+_ordinals = {}
+
+def absolute_seconds(date_id, time_id):
+    '''Seconds since the proleptic Gregorian epoch for date and time database identifiers'''
+    ordinal = _ordinals.get(date_id)
+    if ordinal is None:
+        ordinal = Datetime.date(date_id // 10000, (date_id // 100) % 100, date_id % 100).toordinal()
+        _ordinals[date_id] = ordinal
+    return 86400*ordinal + 3600*(time_id // 10000) + 60*((time_id // 100) % 100) + time_id % 100
+
+
+def date_id_shift(date_id, days):
+    date = Datetime.date.fromordinal(Datetime.date(date_id // 10000, (date_id // 100) % 100, date_id % 100).toordinal() + days)
+    return date.year*10000 + date.month*100 + date.day
+
+
+def tess_ids_iterable(connection, name):
+    '''tess_ids of the readings pending comparison and their date span'''
+    row = {'name': name}
     cursor = connection.cursor()
-    cursor.execute('''
-        SELECT sequence_number, datetime(iso8601fromids(date_id, time_id)) as tstamp
-        FROM tess_readings_t
-        WHERE tess_id == :tess_id
-        AND tstamp BETWEEN datetime(:tstamp, :low) AND datetime(:tstamp, :high)
-        ORDER BY tstamp
-        ''', row)
-    return cursor.fetchall()
+    cursor.execute(TESS_IDS_SQL, row)
+    return cursor
+
+
+def reference_streams(connection, connection2, name):
+    # One day of margin for windows crossing midnight
+    return dict((tess_id, ReferenceStream(connection2, tess_id, date_id_shift(min_date_id, -1), date_id_shift(max_date_id, 1)))
+        for tess_id, min_date_id, max_date_id in tess_ids_iterable(connection, name).fetchall())
+
+
+def classify(seq_num, result):
+    '''Rejection reason for a reading given the reference sequence numbers in its window, None if OK'''
+    if not result:
+        return None
+    if len(result) > 1:
+        return AMBIGUOUS_TIME
+    if result[0] != seq_num:
+        return SHIFTED
+    return COINCIDENT
 
 
 def mark_ok_rows(connection, ok_rows):
     name = ok_rows[0]['name']
     cursor = connection.cursor()
-    cursor.executemany('''
-        UPDATE raw_readings_t
-        SET accepted = :flag
-        WHERE name  == :name
-        AND date_id == :date_id
-        AND time_id == :time_id
-        ''', ok_rows)
+    cursor.executemany(MARK_OK_SQL, ok_rows)
     connection.commit()
 
 
+@profiled
 def readings_compare_by_name(connection, name, connection2):
     dup_sequence_ids = []
     ok_sequence_ids  = []
     bad_count    = 0
     good_count   = 0
-    periodDAO = PeriodDAO(connection)
+    periodDAO = PeriodCachedDAO(connection)
+    streams   = reference_streams(connection, connection2, name)
     logging.info("[{0}] Comparing readings in reference database for {1}".format(__name__, name))
     for date_id, time_id, tess_id, seq_num in good_readings_iterable(connection, name):
-        period = periodDAO.getPeriod(name, date_id)
-        tstamp = tdbtool.s4a.datetime.from_dbase_ids(date_id, time_id).to_iso8601()
-        result = find_sequence_number(connection2, tess_id, tstamp, period, seq_num)
-        if  not result:
+        period  = periodDAO.getPeriod(name, date_id)
+        seconds = absolute_seconds(date_id, time_id)
+        # Window bounds truncated to whole seconds, as datetime(:tstamp, '+N seconds') does
+        low     = int(math.floor(seconds - period/2.0))
+        high    = int(math.floor(seconds + period/2.0))
+        result  = streams[tess_id].find(low, high) if tess_id in streams else []
+        reason  = classify(seq_num, result)
+        if reason is None:
             good_row = {'name': name, 'date_id': date_id, 'time_id': time_id, 'flag': 1}
             ok_sequence_ids.append(good_row)
             if len(ok_sequence_ids) == ROWS_PER_COMMIT:
@@ -119,14 +211,8 @@ def readings_compare_by_name(connection, name, connection2):
                 mark_ok_rows(connection, ok_sequence_ids)
                 ok_sequence_ids = []
             continue
-        if len(result) > 1:
-            logging.warn("[{0}] Search returned {1} readings.".format(__name__, name, len(result)))
-            reason = TIMESTAMP_SHIFTED
-        elif result[0][0] != seq_num:
-            #logging.debug("[{0}] Sequence numbers mismatch in {1}. {2} (Ref) = {3}, {4} (CSV) = {5}.".format(__name__, name, result[0][1], result[0][0], tstamp, seq_num))
-            reason = SHIFTED
-        else:
-            reason = COINCIDENT
+        if reason == AMBIGUOUS_TIME:
+            logging.debug("[{0}] Search for {1} returned {2} readings.".format(__name__, name, len(result)))
         bad_row = {'name': name, 'date_id': date_id, 'time_id': time_id, 'reason': reason}
         dup_sequence_ids.append(bad_row)
         if len(dup_sequence_ids) == ROWS_PER_COMMIT:
@@ -141,7 +227,6 @@ def readings_compare_by_name(connection, name, connection2):
     if len(dup_sequence_ids):
         bad_count += len(dup_sequence_ids)
         mark_bad_rows(connection, dup_sequence_ids)
-    logging.debug("[{0}] PeriodDAO stats for {1} => {2}".format(__name__, name, periodDAO))
     logging.info("[{0}] Accepted  {1} readings for {2}.".format(__name__, good_count, name))
     logging.info("[{0}] Discarded {1} readings for {2}.".format(__name__, bad_count, name))
     
@@ -153,10 +238,5 @@ def readings_compare_by_name(connection, name, connection2):
 
 def readings_compare(connection, options):
     logging.info("[{0}] Opening reference database {1}".format(__name__, options.dbase))
-    connection2 = open_reference_database(options.dbase)
-    if options.name is not None:
-        readings_compare_by_name(connection, options.name, connection2)
-    else:
-        for name in candidate_names_iterable(connection):
-            readings_compare_by_name(connection, name[0], connection2)
+    run_by_name(connection, options, readings_compare_by_name, reference=True)
 
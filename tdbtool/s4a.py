@@ -39,6 +39,12 @@ except:
 
 TSTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
+# Fixed ISO8601 layouts decoded by slicing and their string lengths
+FIXED_FORMATS = {"%Y-%m-%dT%H:%M:%S": 19, "%Y-%m-%dT%H:%M:%SZ": 20}
+
+# Days per month in non leap years
+DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
 # -----------------------
 # Module global variables
 # -----------------------
@@ -51,6 +57,50 @@ def utf8(s):
     return  unicode(s, 'utf8') if sys.version_info[0] < 3 else s
 
 
+def ids_from_iso8601(timestamp, fmt=TSTAMP_FORMAT):
+    '''
+    Returns date_id, time_id and seconds within the day from an ISO8601 string.
+    Strings in one of the FIXED_FORMATS layouts are decoded by slicing.
+    Anything else is strictly validated by strptime with the given format,
+    raising ValueError if it does not match.
+    '''
+    n = FIXED_FORMATS.get(fmt)
+    if n is not None and len(timestamp) == n and (n == 19 or timestamp[19] == 'Z') \
+        and timestamp[4] == '-' and timestamp[7] == '-' \
+        and timestamp[10] == 'T' and timestamp[13] == ':' and timestamp[16] == ':':
+        digits = timestamp[0:4] + timestamp[5:7] + timestamp[8:10] + timestamp[11:13] + timestamp[14:16] + timestamp[17:19]
+        if digits.isdigit():
+            try:
+                date_id = int(digits[0:8])
+                time_id = int(digits[8:14])
+            except ValueError:
+                pass
+            else:
+                year  = date_id // 10000
+                month = (date_id // 100) % 100
+                day   = date_id % 100
+                hour  = time_id // 10000
+                mins  = (time_id // 100) % 100
+                secs  = time_id % 100
+                if 1 <= month <= 12 and hour < 24 and mins < 60 and secs < 60:
+                    days = DAYS_IN_MONTH[month]
+                    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+                        days = 29
+                    if 1 <= day <= days and year > 0:
+                        return date_id, time_id, 3600*hour + 60*mins + secs
+    t = Datetime.datetime.strptime(timestamp, fmt)
+    return 10000*t.year + 100*t.month + t.day, 10000*t.hour + 100*t.minute + t.second, 3600*t.hour + 60*t.minute + t.second
+
+
+def iso8601_from_ids(date_id, time_id):
+    '''
+    Produces an ISO 8601 string, YYYY-MM-DDTHH:MM:SS, from date and time database identifiers
+    '''
+    return "%04d-%02d-%02dT%02d:%02d:%02d" % (
+        date_id // 10000, (date_id // 100) % 100, date_id % 100,
+        time_id // 10000, (time_id // 100) % 100, time_id % 100)
+
+
 
 # --------------
 # Module classes
@@ -68,10 +118,9 @@ class datetime(Datetime.datetime):
         Creates a datetime from an ISO8601 string of the format YYYY-MM-DDTHH:MM:SS
         '''
         try:
-            t = Datetime.datetime.strptime(timestamp, fmt)
+            return cls.strptime(timestamp, fmt)
         except Exception as e:
             return None
-        return cls(t.year, t.month, t.day, t.hour, t.minute, t.second)
 
     @classmethod
     def from_dbase_ids(cls, date_id, time_id):
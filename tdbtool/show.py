@@ -32,7 +32,7 @@ import tdbtool.s4a
 from .      import __version__
 from .      import DUP_SEQ_NUMBER, SINGLE, PAIR, DAYLIGHT, AMBIGUOUS_LOC, COINCIDENT, AMBIGUOUS_TIME, SHIFTED
 from .      import TSTAMP_FORMAT
-from .utils import paging, previous_iterable
+from .utils import paging
 
 # ----------------
 # Module constants
@@ -212,19 +212,21 @@ def show_global(connection, options):
     if options.name is None:
         cursor.execute(
             '''
-            SELECT name, median_period, N, method
-            FROM global_stats_t
-            ORDER BY name ASC
+            SELECT g.name, g.median_period, s.p5_period, s.p95_period, g.N, g.method
+            FROM global_stats_t AS g
+            LEFT JOIN period_sketch_t AS s USING (name)
+            ORDER BY g.name ASC
             ''')
     else:
-        row = {'name': name}
+        row = {'name': options.name}
         cursor.execute(
             '''
-            SELECT name, median_period, N, method
-            FROM global_stats_t
-            WHERE name == :name
-            ''')
-    paging(cursor,["Name","Median Period (s)", "Sample Count", "Compute method"], options.limit)
+            SELECT g.name, g.median_period, s.p5_period, s.p95_period, g.N, g.method
+            FROM global_stats_t AS g
+            LEFT JOIN period_sketch_t AS s USING (name)
+            WHERE g.name == :name
+            ''', row)
+    paging(cursor,["Name","Median Period (s)", "P5 Period (s)", "P95 Period (s)", "Sample Count", "Compute method"], options.limit)
 
 
 def show_differences(connection, options):
@@ -316,4 +318,25 @@ def show_count(connection, options):
         show_count_timestamp(connection, options.name)
     else:
         pass
-  
\ No newline at end of file
+  
+
+def show_timings(connection, options):
+    row = {'name': options.name, 'step': options.step, 'run_id': options.run}
+    cursor = connection.cursor()
+    if row['run_id'] is None:
+        # Last pipeline run and the commands run outside pipelines
+        cursor.execute("SELECT MAX(run_id) FROM timings_t")
+        row['run_id'] = cursor.fetchone()[0]
+        runs = "(run_id IS NULL OR run_id == :run_id)"
+    else:
+        runs = "run_id == :run_id"
+    cursor.execute(
+        '''
+        SELECT run_id, step, name, started, round(seconds,2), rows, round(rows_per_second,1), statements, peak_rss_kb
+        FROM timings_t
+        WHERE {0}
+        AND   (:name IS NULL OR name == :name)
+        AND   (:step IS NULL OR step == :step)
+        ORDER BY seconds DESC
+        '''.format(runs), row)
+    paging(cursor,["Run", "Step", "Name", "Started (UTC)", "Time (s)", "Rows", "Rows/s", "Statements", "Peak RSS (KiB)"], options.limit)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# MERGEABLE QUANTILE SKETCH
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+import math
+import json
+
+# ----------------
+# Module constants
+# ----------------
+
+# Top compactor capacity. Below this many items the sketch is exact.
+DEFAULT_K = 200
+
+# Capacity decay factor for lower compactors
+DECAY = 2.0/3.0
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+# --------------
+# Module classes
+# --------------
+
+class KLL(object):
+    '''
+    KLL quantile sketch (Karnin, Lang & Liberty).
+    A stack of compactors where an item at level h stands for 2**h original items.
+    When a compactor fills up it is sorted and every other item is promoted to the
+    next level. Updates are amortized O(1) and two sketches merge level by level.
+    Compaction alternates between odd and even items per level instead of tossing
+    a coin, so the sketch contents are reproducible between runs.
+    '''
+
+    def __init__(self, k=DEFAULT_K):
+        self.k          = k
+        self.N          = 0
+        self.compactors = [[]]
+        self.offsets    = [0]
+        self.size       = 0
+        self.maxSize    = self.capacity(0)
+
+    def capacity(self, h):
+        height = len(self.compactors)
+        return int(math.ceil(self.k * DECAY ** (height - h - 1))) + 1
+
+    def grow(self):
+        self.compactors.append([])
+        self.offsets.append(0)
+        self.maxSize = sum(self.capacity(h) for h in range(len(self.compactors)))
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        self.N    += 1
+        if self.size >= self.maxSize:
+            self.compress()
+
+    def compress(self):
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self.capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self.grow()
+                items = sorted(self.compactors[h])
+                # An odd item out stays at this level
+                leftover = [items.pop()] if len(items) % 2 else []
+                self.compactors[h+1].extend(items[self.offsets[h]::2])
+                self.compactors[h] = leftover
+                self.offsets[h] ^= 1
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.maxSize:
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for h, items in enumerate(other.compactors):
+            self.compactors[h].extend(items)
+        self.N   += other.N
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.maxSize:
+            self.compress()
+
+    def quantile(self, q):
+        '''
+        Estimated q-quantile (0 <= q <= 1), interpolating between neighbour ranks.
+        While no compaction happened, quantile(0.5) equals the exact MEDIAN()
+        '''
+        weighted = sorted((value, 2**h) for h, items in enumerate(self.compactors) for value in items)
+        if not weighted:
+            return None
+        total = sum(weight for value, weight in weighted)
+        rank  = q * (total - 1)
+        lower = int(math.floor(rank))
+        upper = int(math.ceil(rank))
+        values   = {}
+        cumulative = 0
+        for value, weight in weighted:
+            for r in (lower, upper):
+                if cumulative <= r < cumulative + weight:
+                    values[r] = value
+            if upper in values:
+                break
+            cumulative += weight
+        if lower == upper:
+            return values[lower]
+        return values[lower] + (rank - lower) * (values[upper] - values[lower])
+
+    def dumps(self):
+        return json.dumps({
+            'k'          : self.k,
+            'N'          : self.N,
+            'compactors' : self.compactors,
+            'offsets'    : self.offsets,
+        })
+
+    @classmethod
+    def loads(cls, text):
+        data   = json.loads(text)
+        sketch = cls(data['k'])
+        sketch.N          = data['N']
+        sketch.compactors = data['compactors']
+        sketch.offsets    = data['offsets']
+        sketch.size       = sum(len(c) for c in sketch.compactors)
+        sketch.maxSize    = sum(sketch.capacity(h) for h in range(len(sketch.compactors)))
+        return sketch
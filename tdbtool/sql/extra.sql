@@ -70,6 +70,16 @@ CREATE TABLE IF NOT EXISTS housekeeping_t
     PRIMARY KEY(name)
 );
 
+-- Files already ingested, to skip them on later runs
+CREATE TABLE IF NOT EXISTS ingested_files_t
+(
+    path                TEXT    NOT NULL, -- absolute file path
+    size                INTEGER NOT NULL, -- file size in bytes
+    mtime               REAL    NOT NULL, -- file modification time
+    rows                INTEGER NOT NULL, -- readings inserted from this file
+    tstamp              TEXT    NOT NULL, -- ISO8601 ingestion timestamp
+    PRIMARY KEY(path)
+);
 
 CREATE TABLE IF NOT EXISTS first_differences_t
 (
@@ -100,6 +110,28 @@ CREATE TABLE IF NOT EXISTS daily_stats_t
 	PRIMARY KEY (name, date_id)
 );
 
+-- Days with new first differences, pending daily statistics
+CREATE TABLE IF NOT EXISTS dirty_days_t
+(
+    name                TEXT    NOT NULL, -- TESS-W name
+    date_id             INTEGER NOT NULL,
+    PRIMARY KEY (name, date_id)
+);
+
+CREATE TRIGGER IF NOT EXISTS first_differences_dirty_days_tr
+AFTER INSERT ON first_differences_t
+BEGIN
+    INSERT OR IGNORE INTO dirty_days_t(name, date_id) VALUES (NEW.name, NEW.date_id);
+END;
+
+-- Days with new daily statistics, pending global statistics
+CREATE TABLE IF NOT EXISTS dirty_stats_t
+(
+    name                TEXT    NOT NULL, -- TESS-W name
+    date_id             INTEGER NOT NULL,
+    PRIMARY KEY (name, date_id)
+);
+
 CREATE TABLE IF NOT EXISTS global_stats_t
 ( 
     name                TEXT    NOT NULL, -- TESS-W name
@@ -109,6 +141,19 @@ CREATE TABLE IF NOT EXISTS global_stats_t
     PRIMARY KEY (name)
 );
 
+-- Mergeable quantile sketch of the daily median periods per TESS-W
+CREATE TABLE IF NOT EXISTS period_sketch_t
+( 
+    name                TEXT    NOT NULL, -- TESS-W name
+    max_date_id         INTEGER NOT NULL, -- last closed day folded into the sketch
+    N                   INTEGER NOT NULL, -- days in the estimates, including the open day
+    p5_period           REAL,             -- estimated 5% percentile
+    median_period       REAL,             -- estimated median
+    p95_period          REAL,             -- estimated 95% percentile
+    sketch              TEXT    NOT NULL, -- JSON serialized KLL sketch of the closed days
+    PRIMARY KEY (name)
+);
+
 CREATE TABLE IF NOT EXISTS location_daily_aggregate_t
 ( 
     tess_id             INTEGER NOT NULL, -- 
@@ -133,4 +178,40 @@ CREATE TABLE IF NOT EXISTS location_gaps_t
     end_location        TEXT            , -- location name
     readings            INTEGER NOT NULL, -- number of readings inside this gap
     PRIMARY KEY (name, start_date_id, start_time_id, end_date_id, end_time_id)
-);
\ No newline at end of file
+);
+-- Pipeline runs: a run stays 'running' until all its steps complete
+CREATE TABLE IF NOT EXISTS pipeline_status_t
+(
+    run_id              INTEGER NOT NULL, -- pipeline run, increasing
+    command             TEXT    NOT NULL, -- pipeline subcommand that started the run
+    started             TEXT    NOT NULL, -- ISO8601 UTC timestamp
+    finished            TEXT,             -- ISO8601 UTC timestamp, NULL while running
+    status              TEXT    NOT NULL, -- 'running' or 'finished'
+    PRIMARY KEY (run_id)
+);
+
+-- Pipeline checkpoints: completed (step, name) units per pipeline run
+CREATE TABLE IF NOT EXISTS pipeline_runs_t
+( 
+    run_id              INTEGER NOT NULL, -- pipeline run, increasing
+    step                TEXT    NOT NULL, -- pipeline step function
+    name                TEXT    NOT NULL, -- TESS-W name or '*' for the whole step
+    started             TEXT    NOT NULL, -- ISO8601 UTC timestamp
+    seconds             REAL    NOT NULL, -- elapsed time
+    rows                INTEGER NOT NULL, -- rows changed in the extra database
+    PRIMARY KEY (run_id, step, name)
+);
+
+-- Timings per pipeline step ('*') and per TESS-W name
+CREATE TABLE IF NOT EXISTS timings_t
+( 
+    run_id              INTEGER,          -- pipeline run, NULL outside pipelines
+    step                TEXT    NOT NULL, -- step or per name function
+    name                TEXT    NOT NULL, -- TESS-W name or '*' for the whole step
+    started             TEXT    NOT NULL, -- ISO8601 UTC timestamp
+    seconds             REAL    NOT NULL, -- wall time
+    rows                INTEGER NOT NULL, -- rows changed in the extra database
+    rows_per_second     REAL,             -- rows / seconds
+    statements          INTEGER NOT NULL, -- SQL statements executed
+    peak_rss_kb         INTEGER           -- process peak resident memory so far
+);
@@ -0,0 +1,33 @@
+-------------------------------------------
+-- Auxiliar database secondary indexes
+-- Created by 'tdbtool db optimize'
+-------------------------------------------
+
+-- Readings not rejected yet, per TESS-W in time order
+-- (daylight detection, instrument resolution, metadata flags)
+CREATE INDEX IF NOT EXISTS raw_readings_good_i
+ON raw_readings_t(name, date_id, time_id) WHERE rejected IS NULL;
+
+-- Readings pending comparison against the reference database
+CREATE INDEX IF NOT EXISTS raw_readings_pending_i
+ON raw_readings_t(name, date_id, time_id) WHERE rejected IS NULL AND accepted IS NULL;
+
+-- Readings with an instrument but no location yet
+CREATE INDEX IF NOT EXISTS raw_readings_unlocated_i
+ON raw_readings_t(name, date_id, time_id) WHERE rejected IS NULL AND tess_id IS NOT NULL AND location_id IS NULL;
+
+-- Location gaps fixing
+CREATE INDEX IF NOT EXISTS raw_readings_location_i
+ON raw_readings_t(name, location_id);
+
+-- Neighbour readings by insertion order (retained readings)
+CREATE INDEX IF NOT EXISTS raw_readings_name_rank_i
+ON raw_readings_t(name, rank);
+
+-- Counts by rejection reason
+CREATE INDEX IF NOT EXISTS raw_readings_rejected_i
+ON raw_readings_t(rejected, name);
+
+-- Sequence number jumps (retained readings candidates)
+CREATE INDEX IF NOT EXISTS first_differences_jump_i
+ON first_differences_t(name, delta_T) WHERE delta_seq > 1;
@@ -29,41 +29,292 @@ import traceback
 # -------------
 
 import tdbtool.s4a
-from .      import __version__
-from .      import DUP_SEQ_NUMBER, SINGLE, PAIR, TSTAMP_FORMAT
-from .utils import paging, previous_iterable, candidate_names_iterable
+from .       import __version__
+from .       import DUP_SEQ_NUMBER, SINGLE, PAIR, TSTAMP_FORMAT
+from .utils  import paging, candidate_names_iterable
+from .sketch import KLL
 
 # ----------------
 # Module constants
 # ----------------
 
+# Dirty (name, date_id) keys bookkeeping, as (all names, single name) statement pairs
+MARK_DIRTY_DAYS_SQL = '''
+    INSERT OR IGNORE INTO dirty_days_t(name, date_id)
+    SELECT DISTINCT name, date_id FROM first_differences_t
+'''
+
+MARK_DIRTY_DAYS_BY_NAME_SQL = '''
+    INSERT OR IGNORE INTO dirty_days_t(name, date_id)
+    SELECT DISTINCT name, date_id FROM first_differences_t WHERE name == :name
+'''
+
+MARK_DIRTY_STATS_SQL = '''
+    INSERT OR IGNORE INTO dirty_stats_t(name, date_id)
+    SELECT DISTINCT name, date_id FROM daily_stats_t
+'''
+
+MARK_DIRTY_STATS_BY_NAME_SQL = '''
+    INSERT OR IGNORE INTO dirty_stats_t(name, date_id)
+    SELECT DISTINCT name, date_id FROM daily_stats_t WHERE name == :name
+'''
+
+MARK_DIRTY_STATS_FROM_DAYS_SQL = '''
+    INSERT OR IGNORE INTO dirty_stats_t(name, date_id)
+    SELECT DISTINCT name, date_id FROM dirty_days_t
+'''
+
+MARK_DIRTY_STATS_FROM_DAYS_BY_NAME_SQL = '''
+    INSERT OR IGNORE INTO dirty_stats_t(name, date_id)
+    SELECT DISTINCT name, date_id FROM dirty_days_t WHERE name == :name
+'''
+
+CLEAR_DIRTY_DAYS_SQL = '''
+    DELETE FROM dirty_days_t
+'''
+
+CLEAR_DIRTY_DAYS_BY_NAME_SQL = '''
+    DELETE FROM dirty_days_t WHERE name == :name
+'''
+
+CLEAR_DIRTY_STATS_SQL = '''
+    DELETE FROM dirty_stats_t
+'''
+
+CLEAR_DIRTY_STATS_BY_NAME_SQL = '''
+    DELETE FROM dirty_stats_t WHERE name == :name
+'''
+
+# Days and photometers left pending by databases filled before the dirty tables existed
+ANY_DIRTY_DAYS_SQL = '''
+    SELECT EXISTS (SELECT 1 FROM dirty_days_t)
+'''
+
+ANY_DIRTY_DAYS_BY_NAME_SQL = '''
+    SELECT EXISTS (SELECT 1 FROM dirty_days_t WHERE name == :name)
+'''
+
+SEED_DIRTY_DAYS_SQL = '''
+    INSERT OR IGNORE INTO dirty_days_t(name, date_id)
+    SELECT DISTINCT d.name, d.date_id
+    FROM first_differences_t AS d
+    WHERE NOT EXISTS (SELECT 1 FROM daily_stats_t AS s WHERE s.name == d.name AND s.date_id == d.date_id)
+'''
+
+SEED_DIRTY_DAYS_BY_NAME_SQL = '''
+    INSERT OR IGNORE INTO dirty_days_t(name, date_id)
+    SELECT DISTINCT d.name, d.date_id
+    FROM first_differences_t AS d
+    WHERE d.name == :name
+    AND NOT EXISTS (SELECT 1 FROM daily_stats_t AS s WHERE s.name == d.name AND s.date_id == d.date_id)
+'''
+
+ANY_DIRTY_STATS_SQL = '''
+    SELECT EXISTS (SELECT 1 FROM dirty_stats_t)
+'''
+
+ANY_DIRTY_STATS_BY_NAME_SQL = '''
+    SELECT EXISTS (SELECT 1 FROM dirty_stats_t WHERE name == :name)
+'''
+
+SEED_DIRTY_STATS_SQL = '''
+    INSERT OR IGNORE INTO dirty_stats_t(name, date_id)
+    SELECT s.name, s.date_id
+    FROM daily_stats_t AS s
+    WHERE NOT EXISTS (SELECT 1 FROM global_stats_t AS g WHERE g.name == s.name)
+'''
+
+SEED_DIRTY_STATS_BY_NAME_SQL = '''
+    INSERT OR IGNORE INTO dirty_stats_t(name, date_id)
+    SELECT s.name, s.date_id
+    FROM daily_stats_t AS s
+    WHERE s.name == :name
+    AND NOT EXISTS (SELECT 1 FROM global_stats_t AS g WHERE g.name == s.name)
+'''
+
+MARK_DIRTY_DAYS             = (MARK_DIRTY_DAYS_SQL, MARK_DIRTY_DAYS_BY_NAME_SQL)
+MARK_DIRTY_STATS            = (MARK_DIRTY_STATS_SQL, MARK_DIRTY_STATS_BY_NAME_SQL)
+MARK_DIRTY_STATS_FROM_DAYS  = (MARK_DIRTY_STATS_FROM_DAYS_SQL, MARK_DIRTY_STATS_FROM_DAYS_BY_NAME_SQL)
+CLEAR_DIRTY_DAYS            = (CLEAR_DIRTY_DAYS_SQL, CLEAR_DIRTY_DAYS_BY_NAME_SQL)
+CLEAR_DIRTY_STATS           = (CLEAR_DIRTY_STATS_SQL, CLEAR_DIRTY_STATS_BY_NAME_SQL)
+ANY_DIRTY_DAYS              = (ANY_DIRTY_DAYS_SQL, ANY_DIRTY_DAYS_BY_NAME_SQL)
+SEED_DIRTY_DAYS             = (SEED_DIRTY_DAYS_SQL, SEED_DIRTY_DAYS_BY_NAME_SQL)
+ANY_DIRTY_STATS             = (ANY_DIRTY_STATS_SQL, ANY_DIRTY_STATS_BY_NAME_SQL)
+SEED_DIRTY_STATS            = (SEED_DIRTY_STATS_SQL, SEED_DIRTY_STATS_BY_NAME_SQL)
+
+DIRTY_NAMES_SQL = '''
+    SELECT name, MIN(date_id) FROM dirty_stats_t GROUP BY name
+'''
+
+DIRTY_NAMES_BY_NAME_SQL = '''
+    SELECT name, MIN(date_id) FROM dirty_stats_t WHERE name == :name GROUP BY name
+'''
+
+DAILY_MEDIANS_SQL = '''
+    SELECT date_id, median_period
+    FROM   daily_stats_t
+    WHERE  name == :name
+    AND    date_id > :date_id
+    AND    median_period IS NOT NULL
+    ORDER BY date_id ASC
+'''
+
+LOAD_SKETCH_SQL = '''
+    SELECT max_date_id, sketch FROM period_sketch_t WHERE name == :name
+'''
+
+SAVE_SKETCH_SQL = '''
+    INSERT OR REPLACE INTO period_sketch_t(name, max_date_id, N, p5_period, median_period, p95_period, sketch)
+    VALUES (:name, :max_date_id, :N, :p5, :median, :p95, :sketch)
+'''
+
+GLOBAL_STATS_SKETCH_SQL = '''
+    INSERT OR REPLACE INTO global_stats_t(name, median_period, method, N)
+    VALUES (:name, :median, :method, :N)
+'''
+
+GLOBAL_STATS_EXACT_SQL = '''
+    INSERT OR REPLACE INTO global_stats_t(name, median_period, method, N)
+    SELECT name, MEDIAN(median_period), :method, COUNT(*)
+    FROM  daily_stats_t
+    WHERE name IN (SELECT name FROM dirty_stats_t)
+    GROUP BY name
+'''
+
+GLOBAL_STATS_EXACT_BY_NAME_SQL = '''
+    INSERT OR REPLACE INTO global_stats_t(name, median_period, method, N)
+    SELECT name, MEDIAN(median_period), :method, COUNT(*)
+    FROM  daily_stats_t
+    WHERE name == :name
+    AND   name IN (SELECT name FROM dirty_stats_t)
+    GROUP BY name
+'''
+
+GLOBAL_STATS_MANUAL_SQL = '''
+    INSERT OR REPLACE INTO global_stats_t(name, median_period, method, N)
+    VALUES (:name, :period, :method, :N)
+'''
+
+DAILY_STATS_SQL = '''
+    INSERT OR REPLACE INTO daily_stats_t(name, date_id, mean_period, median_period, stddev_period, N, min_period, max_period)
+    SELECT d.name, d.date_id, AVG(d.delta_T), MEDIAN(d.delta_T), STDEV(d.delta_T), COUNT(*), MIN(d.delta_T), MAX(d.delta_T)
+    FROM  dirty_days_t AS k
+    JOIN  first_differences_t AS d ON d.name == k.name AND d.date_id == k.date_id
+    GROUP BY d.name, d.date_id
+'''
+
+DAILY_STATS_BY_NAME_SQL = '''
+    INSERT OR REPLACE INTO daily_stats_t(name, date_id, mean_period, median_period, stddev_period, N, min_period, max_period)
+    SELECT d.name, d.date_id, AVG(d.delta_T), MEDIAN(d.delta_T), STDEV(d.delta_T), COUNT(*), MIN(d.delta_T), MAX(d.delta_T)
+    FROM  dirty_days_t AS k
+    JOIN  first_differences_t AS d ON d.name == k.name AND d.date_id == k.date_id
+    WHERE k.name == :name
+    GROUP BY d.name, d.date_id
+'''
+
 # -----------------------
 # Module global variables
 # -----------------------
 
-def stats_global_auto(connection, name):
+def execute_by_name(connection, statements, name):
+    '''Runs the first statement of the pair for all names, the second one for a single name'''
     cursor = connection.cursor()
     if name is None:
-        logging.info("[{0}] computing global period statistics for all photometers".format(__name__))
+        cursor.execute(statements[0])
+    else:
+        cursor.execute(statements[1], {'name': name})
+    return cursor
+
+
+def seed_dirty(connection, pending, seed, name, what):
+    '''
+    Only the first_differences_t trigger and stats daily mark work as pending.
+    When nothing is pending, work left over by databases filled before the dirty
+    tables existed is marked now: days with differences but no daily statistics,
+    photometers with daily statistics but no global ones.
+    '''
+    if execute_by_name(connection, pending, name).fetchone()[0]:
+        return
+    cursor = execute_by_name(connection, seed, name)
+    if cursor.rowcount > 0:
+        logging.info("[{0}] {1} {2} were not marked as pending, marking them now".format(__name__, cursor.rowcount, what))
+
+
+def dirty_names_iterable(connection, name):
+    row = {'name': name}
+    cursor = connection.cursor()
+    if name is None:
+        cursor.execute(DIRTY_NAMES_SQL)
+    else:
+        cursor.execute(DIRTY_NAMES_BY_NAME_SQL, row)
+    return cursor   # return Cursor as an iterable
+
+
+def daily_medians_iterable(connection, name, date_id):
+    row = {'name': name, 'date_id': date_id}
+    cursor = connection.cursor()
+    cursor.execute(DAILY_MEDIANS_SQL, row)
+    return cursor   # return Cursor as an iterable
+
+
+def update_sketch(connection, name, min_date_id, rebuild):
+    '''
+    Folds the new daily medians of a TESS-W into its quantile sketch.
+    Only closed days (all but the newest one) are folded into the stored sketch,
+    as the newest day may still get new differences. The open day is added to
+    a copy when estimating quantiles, so it is folded again on every update.
+    Sketches cannot forget values, so a sketch is rebuilt from scratch
+    when a day already folded in got new daily statistics.
+    '''
+    row = {'name': name}
+    cursor = connection.cursor()
+    cursor.execute(LOAD_SKETCH_SQL, row)
+    result = cursor.fetchone()
+    if rebuild or result is None or min_date_id <= result[0]:
+        max_date_id, sketch = 0, KLL()
+    else:
+        max_date_id, sketch = result[0], KLL.loads(result[1])
+    days = daily_medians_iterable(connection, name, max_date_id).fetchall()
+    for date_id, median_period in days[:-1]:
+        sketch.update(median_period)
+        max_date_id = date_id
+    row['max_date_id'] = max_date_id
+    row['sketch']      = sketch.dumps()
+    for date_id, median_period in days[-1:]:
+        sketch = KLL.loads(row['sketch'])
+        sketch.update(median_period)
+    row['N']           = sketch.N
+    row['p5']          = sketch.quantile(0.05)
+    row['median']      = sketch.quantile(0.5)
+    row['p95']         = sketch.quantile(0.95)
+    cursor.execute(SAVE_SKETCH_SQL, row)
+    return row
+
+
+def stats_global_auto(connection, name, full=False, exact=False):
+    if full:
+        execute_by_name(connection, MARK_DIRTY_STATS, name)
+    else:
+        seed_dirty(connection, ANY_DIRTY_STATS, SEED_DIRTY_STATS, name, "days of photometers without global statistics")
+    logging.info("[{0}] updating period quantile sketches".format(__name__))
+    rows = [update_sketch(connection, dirty_name, min_date_id, full) for dirty_name, min_date_id in dirty_names_iterable(connection, name).fetchall()]
+    cursor = connection.cursor()
+    if not exact:
+        logging.info("[{0}] computing global period statistics from quantile sketches".format(__name__))
+        rows = [row for row in rows if row['N'] > 0]
+        for row in rows:
+            row['method'] = "Automatic"
+        cursor.executemany(GLOBAL_STATS_SKETCH_SQL, rows)
+    elif name is None:
+        logging.info("[{0}] computing global period statistics for photometers with new daily statistics".format(__name__))
         row = {'method': "Automatic"}
-        cursor.execute(
-            '''
-            INSERT OR REPLACE INTO global_stats_t(name, median_period, method, N)
-            SELECT name, MEDIAN(median_period), :method, COUNT(*)
-            FROM  daily_stats_t
-            GROUP BY name
-            ''', row)
+        cursor.execute(GLOBAL_STATS_EXACT_SQL, row)
     else:
         logging.info("[{0}] computing global period statistics for {1} photometer".format(__name__, name))
         row = {'name': name, 'method': "Automatic"}
-        cursor.execute(
-            '''
-            INSERT OR REPLACE INTO global_stats_t(name, median_period, method, N)
-            SELECT name, MEDIAN(median_period), :method, COUNT(*)
-            FROM  daily_stats_t
-            WHERE name == :name
-            GROUP BY name
-            ''', row)
+        cursor.execute(GLOBAL_STATS_EXACT_BY_NAME_SQL, row)
+    logging.info("[{0}] {1} photometers updated".format(__name__, len(rows)))
+    execute_by_name(connection, CLEAR_DIRTY_STATS, name)
     connection.commit()
     logging.info("[{0}] Done!".format(__name__))
 
@@ -72,11 +323,7 @@ def stats_global_manual(connection, name, period):
     logging.info("[{0}] setting global period statistics to {1} for {2} photometer".format(__name__, period, name))
     row = {'name': name, 'period': period, 'method': "Manual", 'N':0}
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        INSERT OR REPLACE INTO global_stats_t(name, median_period, method, N)
-        VALUES (:name, :period, :method, :N)
-        ''',row)
+    cursor.execute(GLOBAL_STATS_MANUAL_SQL,row)
     connection.commit()
     logging.info("[{0}] Done!".format(__name__))
 
@@ -86,31 +333,26 @@ def stats_global_manual(connection, name, period):
 # ==============
 
 def stats_daily(connection, options):
+    if options.full:
+        execute_by_name(connection, MARK_DIRTY_DAYS, options.name)
+    else:
+        seed_dirty(connection, ANY_DIRTY_DAYS, SEED_DIRTY_DAYS, options.name, "days with differences but no daily statistics")
     cursor = connection.cursor()
     if options.name is None:
-        logging.info("[{0}] computing daily period statistics".format(__name__))
-        cursor.execute(
-            '''
-            INSERT OR REPLACE INTO daily_stats_t(name, date_id, mean_period, median_period, stddev_period, N, min_period, max_period)
-            SELECT name, date_id, AVG(delta_T), MEDIAN(delta_T), STDEV(delta_T), COUNT(*), MIN(delta_T), MAX(delta_T)
-            FROM  first_differences_t
-            GROUP BY name, date_id
-            ''')
+        logging.info("[{0}] computing daily period statistics for days with new differences".format(__name__))
+        cursor.execute(DAILY_STATS_SQL)
     else:
-        logging.info("[{0}] computing daily period statistics for {1}".format(__name__, options.name))
+        logging.info("[{0}] computing daily period statistics for {1} days with new differences".format(__name__, options.name))
         row = {'name': options.name }
-        cursor.execute(
-            '''
-            INSERT OR REPLACE INTO daily_stats_t(name, date_id, mean_period, median_period, stddev_period, N, min_period, max_period)
-            SELECT name, date_id, AVG(delta_T), MEDIAN(delta_T), STDEV(delta_T), COUNT(*), MIN(delta_T), MAX(delta_T)
-            FROM  first_differences_t
-            WHERE name == :name
-            GROUP BY name, date_id
-            ''', row)
+        cursor.execute(DAILY_STATS_BY_NAME_SQL, row)
+    logging.info("[{0}] {1} days updated".format(__name__, cursor.rowcount))
+    # Days with new daily statistics are now pending global statistics
+    execute_by_name(connection, MARK_DIRTY_STATS_FROM_DAYS, options.name)
+    execute_by_name(connection, CLEAR_DIRTY_DAYS, options.name)
     connection.commit()
     logging.info("[{0}] Done!".format(__name__))
 
 
 
 def stats_global(connection, options):
-    stats_global_auto(connection, options.name)
+    stats_global_auto(connection, options.name, options.full, options.exact)
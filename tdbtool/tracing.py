@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# SQL STATEMENT TRACING AND HOT QUERY REPORT
+
+# ----------------------------------------------------------------------
+# Copyright (c) 2020 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+#--------------------
+# System wide imports
+# -------------------
+
+from __future__ import print_function
+
+import re
+import time
+import sqlite3
+
+#--------------
+# other imports
+# -------------
+
+import tabulate
+
+# -------------
+# Local imports
+# -------------
+
+from .profiling import enabled as profiling_enabled, count_statements
+
+# ----------------
+# Module constants
+# ----------------
+
+# SQLite virtual machine instructions between progress handler calls
+PROGRESS_OPS = 1000
+
+# Statement text width in the report
+STATEMENT_WIDTH = 90
+
+# String and numeric literals, named parameters and NULL are folded into '?',
+# so that SQL text from cursors and expanded SQL from the trace callback match.
+LITERALS = re.compile(r"'(?:[^']|'')*'|:\w+|\bNULL\b|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+
+# Negative values bound to parameters, already folded as '-?'
+SIGNED = re.compile(r"([=<>(,]\s*)-\?")
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+_enabled = False
+
+# Per statement [calls, seconds, rows, vm_ops]
+_stats = {}
+
+# Cursor statement being stepped by SQLite, for the progress handler
+_current = None
+
+# Python 2 cursors iterate with next()
+_cursor_next = getattr(sqlite3.Cursor, '__next__', None) or sqlite3.Cursor.next
+
+# Normalized text cache for cursor SQL (trace SQL is expanded, never cached)
+_keys = {}
+
+# --------------
+# Module classes
+# --------------
+
+class TracedCursor(sqlite3.Cursor):
+    '''Times every execute and fetch call and counts the rows returned per statement'''
+
+    def _timed(self, key, method, *args):
+        global _current
+        previous = _current
+        _current = key
+        started  = time.time()
+        try:
+            return method(*args)
+        finally:
+            _stats_for(key)[1] += time.time() - started
+            _current = previous
+
+    def execute(self, sql, params=()):
+        self._key = cursor_key(sql)
+        return self._timed(self._key, super(TracedCursor, self).execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self._key = cursor_key(sql)
+        return self._timed(self._key, super(TracedCursor, self).executemany, sql, seq_of_params)
+
+    def _fetched(self, rows):
+        _stats_for(self._key)[2] += rows
+
+    def fetchone(self):
+        row = self._timed(self._key, super(TracedCursor, self).fetchone)
+        if row is not None:
+            self._fetched(1)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(self._key, super(TracedCursor, self).fetchmany, size)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._key, super(TracedCursor, self).fetchall)
+        self._fetched(len(rows))
+        return rows
+
+    def __next__(self):
+        row = self._timed(self._key, _cursor_next, self)
+        self._fetched(1)
+        return row
+
+    # Python 2
+    next = __next__
+
+
+
+class TracedConnection(sqlite3.Connection):
+    '''Routes the execute() shortcuts through TracedCursor as well'''
+
+    def cursor(self, factory=TracedCursor):
+        return super(TracedConnection, self).cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+# -----------------------
+# Module global functions
+# -----------------------
+
+def configure(options):
+    '''Also clears the statistics a forked worker inherits from its parent'''
+    global _enabled, _current
+    _enabled = getattr(options, 'trace_sql', False)
+    _current = None
+    _stats.clear()
+
+
+def enabled():
+    return _enabled
+
+
+def normalize(sql):
+    return ' '.join(SIGNED.sub(r'\1?', LITERALS.sub('?', sql)).split())
+
+
+def cursor_key(sql):
+    key = _keys.get(sql)
+    if key is None:
+        key = normalize(sql)
+        _keys[sql] = key
+    return key
+
+
+def _stats_for(key):
+    stats = _stats.get(key)
+    if stats is None:
+        stats = [0, 0.0, 0, 0]
+        _stats[key] = stats
+    return stats
+
+
+def trace(statement):
+    '''Counts every statement SQLite runs, including BEGIN/COMMIT and executescript()'''
+    _stats_for(normalize(statement))[0] += 1
+    if profiling_enabled():
+        count_statements()
+
+
+def progress():
+    if _current is not None:
+        _stats_for(_current)[3] += PROGRESS_OPS
+    return 0
+
+
+def connection_factory():
+    return TracedConnection if _enabled else sqlite3.Connection
+
+
+def install_tracer(connection):
+    '''Trace callbacks are not available before Python 3.3'''
+    if _enabled and hasattr(connection, 'set_trace_callback'):
+        connection.set_trace_callback(trace)
+        connection.set_progress_handler(progress, PROGRESS_OPS)
+
+
+def stats():
+    return dict(_stats)
+
+
+def merge(other):
+    '''Adds the statistics from another process'''
+    for key, values in other.items():
+        stats = _stats_for(key)
+        for i, value in enumerate(values):
+            stats[i] += value
+
+
+def report(top):
+    rows = sorted(_stats.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    table = []
+    for key, (calls, seconds, nrows, ops) in rows:
+        text = key if len(key) <= STATEMENT_WIDTH else key[:STATEMENT_WIDTH-3] + '...'
+        mean = 1000.0 * seconds / calls if calls else None
+        table.append((text, calls, round(seconds, 3), None if mean is None else round(mean, 3), nrows, ops))
+    print(tabulate.tabulate(table, headers=["Statement", "Calls", "Time (s)", "Mean (ms)", "Rows", "VM ops"], tablefmt='grid'))
@@ -15,6 +15,7 @@
 import os
 import os.path
 import sys
+import logging
 import collections
 import sqlite3
 
@@ -24,6 +25,11 @@ try:
 except:
     raw_input = input 
 
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
 #--------------
 # other imports
 # -------------
@@ -35,6 +41,9 @@ import tabulate
 # -------------
 
 from .s4a import datetime
+from .functions import register_functions
+from .profiling import install_counter
+from .tracing   import connection_factory, install_tracer
 
 # ----------------
 # Module constants
@@ -43,6 +52,87 @@ from .s4a import datetime
 SQLITE_REGEXP_MODULE = "/usr/lib/sqlite3/pcre.so"
 SQLITE_MATH_MODULE   = "/usr/local/lib/libsqlitefunctions.so"
 
+# Pragmas set by connection profiles, in the order they must be applied
+# (page_size only takes effect before the journal mode becomes WAL)
+PROFILE_PRAGMAS = ('page_size', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store')
+
+# Named connection profiles. 'uri' holds the URI query parameters to open the file with.
+# Pragmas set to None keep the SQLite default or the value persisted in the database file.
+# A negative cache_size is expressed in KiB.
+CONNECTION_PROFILES = {
+    'safe': {
+        'uri'          : None,
+        'page_size'    : None,
+        'journal_mode' : None,
+        'synchronous'  : 'FULL',
+        'cache_size'   : None,
+        'mmap_size'    : None,
+        'temp_store'   : None,
+    },
+    'bulk-import': {
+        'uri'          : None,
+        'page_size'    : 8192,
+        'journal_mode' : 'WAL',
+        'synchronous'  : 'OFF',
+        'cache_size'   : -262144,     # 256 MiB
+        'mmap_size'    : 1073741824,  # 1 GiB
+        'temp_store'   : 'MEMORY',
+    },
+    'read-only': {
+        'uri'          : 'mode=ro',
+        'page_size'    : None,
+        'journal_mode' : None,
+        'synchronous'  : None,
+        'cache_size'   : -262144,
+        'mmap_size'    : 1073741824,
+        'temp_store'   : 'MEMORY',
+    },
+    # Only for reference database copies nobody else is writing to
+    'read-only-reference': {
+        'uri'          : 'mode=ro&immutable=1',
+        'page_size'    : None,
+        'journal_mode' : None,
+        'synchronous'  : None,
+        'cache_size'   : -262144,
+        'mmap_size'    : 1073741824,
+        'temp_store'   : 'MEMORY',
+    },
+}
+
+DEFAULT_PROFILE     = 'safe'
+DEFAULT_REF_PROFILE = 'read-only'
+
+# sqlite3.connect() accepts URI filenames (mode=ro, immutable=1) since Python 3.4
+URI_FILENAMES = sys.version_info >= (3, 4)
+
+DAILY_PERIOD_SQL = '''
+    SELECT median_period
+    FROM daily_stats_t
+    WHERE name == :name
+    AND date_id == :date_id
+'''
+
+GLOBAL_PERIOD_SQL = '''
+    SELECT median_period
+    FROM global_stats_t
+    WHERE name == :name
+'''
+
+MARK_BAD_ROWS_SQL = '''
+    UPDATE raw_readings_t
+    SET rejected = :reason
+    WHERE name  == :name
+    AND date_id == :date_id
+    AND time_id == :time_id
+'''
+
+CANDIDATE_NAMES_SQL = '''
+    SELECT DISTINCT name
+    FROM raw_readings_t
+    ORDER BY name ASC
+'''
+
+
 # ----------------
 # package constants
 # ----------------
@@ -73,23 +163,14 @@ class PeriodDAO(object):
     def get_daily_period(self, name, date_id):
         row = {'name': name, 'date_id': date_id}
         cursor = self.connection.cursor()
-        cursor.execute('''
-            SELECT median_period
-            FROM daily_stats_t
-            WHERE name == :name
-            AND date_id == :date_id
-            ''', row)
+        cursor.execute(DAILY_PERIOD_SQL, row)
         return cursor.fetchone()
 
 
     def get_global_period(self, name):
         row = {'name': name}
         cursor = self.connection.cursor()
-        cursor.execute('''
-            SELECT median_period
-            FROM global_stats_t
-            WHERE name == :name
-            ''', row)
+        cursor.execute(GLOBAL_PERIOD_SQL, row)
         return cursor.fetchone()
 
     def __repr__(self):
@@ -231,56 +312,94 @@ def paging(iterable, headers, maxsize=10, page_size=10):
 # ==============
 
 
-def open_database(dbase_path):
+def window_functions_available():
+    '''Window functions (LAG, ROW_NUMBER, ...) appeared in SQLite 3.25.0'''
+    return sqlite3.sqlite_version_info >= (3, 25, 0)
+
+
+def update_from_available():
+    '''UPDATE ... FROM appeared in SQLite 3.33.0'''
+    return sqlite3.sqlite_version_info >= (3, 33, 0)
+
+
+def apply_profile(connection, profile):
+    settings = CONNECTION_PROFILES[profile]
+    cursor = connection.cursor()
+    for pragma in PROFILE_PRAGMAS:
+        if settings[pragma] is not None:
+            cursor.execute("PRAGMA {0} = {1}".format(pragma, settings[pragma]))
+    actual = []
+    for pragma in PROFILE_PRAGMAS:
+        cursor.execute("PRAGMA {0}".format(pragma))
+        actual.append("{0}={1}".format(pragma, cursor.fetchone()[0]))
+    return actual
+
+
+def database_uri(dbase_path, query=None):
+    uri = "file:{0}".format(pathname2url(os.path.abspath(dbase_path)))
+    return uri if query is None else "{0}?{1}".format(uri, query)
+
+
+def reference_uri(path, profile=DEFAULT_REF_PROFILE):
+    '''URI for the reference database, always read-only whatever the profile'''
+    query = CONNECTION_PROFILES[profile]['uri']
+    if query is None:
+        query = 'mode=ro'
+    elif 'mode=ro' not in query.split('&'):
+        query = 'mode=ro&' + query
+    return database_uri(path, query)
+
+
+def open_database(dbase_path, profile=DEFAULT_PROFILE, uri=None):
+    '''
+    Databases are opened as URIs, so that databases attached later may be
+    given URI parameters as well (i.e. mode=ro). Before Python 3.4 they are
+    opened by path, read-only ones with PRAGMA query_only instead.
+    '''
     if not os.path.exists(dbase_path):
        raise IOError("No SQLite3 Database file found at {0}. Exiting ...".format(dbase_path))
-    return sqlite3.connect(dbase_path)
+    if uri is None:
+        uri = database_uri(dbase_path, CONNECTION_PROFILES[profile]['uri'])
+    if URI_FILENAMES:
+        connection = sqlite3.connect(uri, uri=True, factory=connection_factory())
+    else:
+        connection = sqlite3.connect(dbase_path, factory=connection_factory())
+        if 'mode=ro' in uri:
+            connection.execute("PRAGMA query_only = 1")
+    pragmas = apply_profile(connection, profile)
+    install_counter(connection)
+    install_tracer(connection)
+    logging.info("[{0}] {1} opened with profile {2}: {3}".format(__name__, dbase_path, profile, ' '.join(pragmas)))
+    return connection
 
-def open_reference_database(path):
-    connection = open_database(path)
-    connection.enable_load_extension(True)
-    connection.load_extension(SQLITE_REGEXP_MODULE)
-    connection.load_extension(SQLITE_MATH_MODULE)
+
+def load_regexp_extension(connection):
+    '''
+    Nothing issues REGEXP yet, so a Python built without extension loading
+    or a host without the module only gets a warning
+    '''
+    try:
+        connection.enable_load_extension(True)
+        connection.load_extension(SQLITE_REGEXP_MODULE)
+    except (AttributeError, sqlite3.OperationalError) as e:
+        logging.warning("[{0}] REGEXP extension {1} not loaded: {2}".format(__name__, SQLITE_REGEXP_MODULE, e))
+
+
+def open_reference_database(path, profile=DEFAULT_REF_PROFILE):
+    connection = open_database(path, profile, reference_uri(path, profile))
+    load_regexp_extension(connection)
+    register_functions(connection)
     return connection
 
 
 def mark_bad_rows(connection, bad_rows):
     name = bad_rows[0]['name']
     cursor = connection.cursor()
-    cursor.executemany('''
-        UPDATE raw_readings_t
-        SET rejected = :reason
-        WHERE name  == :name
-        AND date_id == :date_id
-        AND time_id == :time_id
-        ''', bad_rows)
+    cursor.executemany(MARK_BAD_ROWS_SQL, bad_rows)
     connection.commit()
 
 
 def candidate_names_iterable(connection):
     cursor = connection.cursor()
-    cursor.execute(
-        '''
-        SELECT DISTINCT name
-        FROM raw_readings_t 
-        ORDER BY name ASC
-        ''')
+    cursor.execute(CANDIDATE_NAMES_SQL)
     return cursor
-
-def previous_iterable(connection, iterable):
-    result = []
-    for srcrow in iterable:
-        row = {'rank': srcrow[0], 'name': srcrow[3]}
-        cursor = connection.cursor()
-        cursor.execute(
-            '''
-            SELECT r.rank, r.rejected, r.tstamp, r.name, r.sequence_number, r.frequency, r.magnitude, r.ambient_temperature, r.sky_temperature, r.signal_strength
-            FROM raw_readings_t AS r
-            WHERE r.rank == :rank - 1
-            AND   r.name == :name
-            AND   r.rejected IS NULL
-            ''', row)
-        temp = cursor.fetchone()
-        if temp is not None:
-            result.append(temp)
-    return result